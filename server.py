@@ -10,9 +10,3804 @@ import socketserver
 import os
 import sys
 import json
+import copy
+import hashlib
+import socket
+import threading
 from urllib.parse import urlparse, parse_qs
 
-class MIDINameHandler(http.server.SimpleHTTPRequestHandler):
+# Optional brotli support for compressed responses
+try:
+    import brotli
+    BROTLI_AVAILABLE = True
+except ImportError:
+    BROTLI_AVAILABLE = False
+
+PATCHFILES_DIR = 'patchfiles'
+CATALOG_CACHE_FILE = 'midnam_catalog.snapshot'
+CATALOG_INDEX_VERSION = 6
+
+# Worker processes used when a catalog rebuild has many files to parse
+CATALOG_BUILD_WORKERS = int(os.environ.get('MIDNAM_CATALOG_WORKERS', os.cpu_count() or 1))
+PARALLEL_MIN_FILES = 64
+# Backups kept per saved file (0 = no count limit) and their maximum age (0 = no age limit)
+BACKUP_KEEP = int(os.environ.get('MIDNAM_BACKUP_KEEP', 20))
+BACKUP_MAX_AGE_DAYS = float(os.environ.get('MIDNAM_BACKUP_MAX_AGE_DAYS', 0))
+BACKUP_TIME_FORMATS = ('%Y-%m-%d-%H-%M-%S-%f', '%Y-%m-%d-%H-%M-%S')
+# Content-addressed store of saved revisions (see RevisionStore)
+REVISIONS_DIR = os.environ.get('MIDNAM_REVISIONS_DIR', '.midnam_revisions')
+# Chunk size bounds and boundary mask (about one cut per 32 tags past the minimum)
+REVISION_CHUNK_MIN = 512
+REVISION_CHUNK_MAX = 16 * 1024
+REVISION_CHUNK_MASK = 0x1F
+# Optional SQLite mirror of the catalog for /catalog/ queries (see CatalogStore)
+CATALOG_DB = os.environ.get('MIDNAM_CATALOG_DB')
+# Most devices or patches one /midnam_catalog or /catalog/ ?limit= page returns
+CATALOG_PAGE_MAX = 1000
+# Seconds between tree scans when inotify is unavailable, and how long the
+# watcher waits for a burst of events to settle before applying it
+WATCH_POLL_INTERVAL = float(os.environ.get('MIDNAM_WATCH_INTERVAL', 1.0))
+WATCH_DEBOUNCE = 0.1
+# Results of the last bulk validation, used to skip unchanged files that passed
+VALIDATION_CACHE_FILE = 'midnam_validation_cache.json'
+VALIDATION_CACHE_VERSION = 1
+# Batch analysis answers an interactive request, so it goes parallel sooner
+ANALYZE_PARALLEL_MIN_FILES = 8
+
+# Budget for the shared parsed-document cache, and the estimated memory cost
+# of one parsed element on top of the raw document bytes
+DOCUMENT_CACHE_BYTES = int(os.environ.get('MIDNAM_DOCUMENT_CACHE_MB', 64)) * 1024 * 1024
+PARSED_ELEMENT_COST = 250
+
+# Compressed response bodies: smallest body worth compressing, cache budget
+COMPRESS_MIN_BYTES = 1024
+COMPRESSED_CACHE_BYTES = 16 * 1024 * 1024
+
+# Request handling: worker threads, idle keep-alive timeout and shutdown grace (seconds)
+DEFAULT_MAX_WORKERS = 32
+KEEPALIVE_TIMEOUT = 15
+SHUTDOWN_GRACE = 10
+
+
+def extract_device_info(root_elem, file_path):
+    """Extract device information from MIDINameDocument"""
+    try:
+        # The root element should be MIDINameDocument
+        if root_elem.tag != 'MIDINameDocument':
+            return None
+        
+        midnam_doc = root_elem
+        
+        # Try to find MasterDeviceNames first
+        master_device = midnam_doc.find('.//MasterDeviceNames')
+        if master_device is not None:
+            # Extract manufacturer and model
+            manufacturer_elem = master_device.find('Manufacturer')
+            model_elem = master_device.find('Model')
+            
+            if manufacturer_elem is None or model_elem is None:
+                return None
+            
+            manufacturer = manufacturer_elem.text or ''
+            model = model_elem.text or ''
+            
+            # Try to extract family and device IDs from DeviceID elements
+            family_id = None
+            device_id = None
+            
+            device_id_elem = master_device.find('DeviceID')
+            if device_id_elem is not None:
+                family_id = device_id_elem.get('Family')
+                device_id = device_id_elem.get('Member')
+            
+            return {
+                'manufacturer': manufacturer.strip(),
+                'model': model.strip(),
+                'family_id': family_id,
+                'device_id': device_id,
+                'file_path': file_path,
+                'type': 'master'
+            }
+        
+        # Try to find ExtendingDeviceNames
+        extending_device = midnam_doc.find('.//ExtendingDeviceNames')
+        if extending_device is not None:
+            # Extract manufacturer
+            manufacturer_elem = extending_device.find('Manufacturer')
+            if manufacturer_elem is None:
+                return None
+            
+            manufacturer = manufacturer_elem.text or ''
+            
+            # Get all models
+            model_elems = extending_device.findall('Model')
+            if not model_elems:
+                return None
+            
+            # Use the first model as the primary model
+            model = model_elems[0].text or ''
+            
+            return {
+                'manufacturer': manufacturer.strip(),
+                'model': model.strip(),
+                'family_id': None,
+                'device_id': None,
+                'file_path': file_path,
+                'type': 'extending',
+                'all_models': [m.text.strip() for m in model_elems if m.text]
+            }
+        
+        return None
+        
+    except Exception as e:
+        print(f"Error extracting device info from {file_path}: {e}")
+        return None
+
+
+def read_middev_manufacturer_ids(file_path):
+    """Return the manufacturer name to three-byte ID entries of one .middev file"""
+    import xml.etree.ElementTree as ET
+    
+    manufacturer_ids = {}
+    try:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            content = f.read()
+        
+        # Parse XML
+        root_elem = ET.fromstring(content)
+        
+        # Find all MIDIDeviceType elements
+        for device_type in root_elem.findall('.//MIDIDeviceType'):
+            manufacturer_name = device_type.get('Manufacturer')
+            inquiry_response = device_type.find('InquiryResponse')
+            
+            if manufacturer_name and inquiry_response is not None:
+                manufacturer_id = inquiry_response.get('Manufacturer')
+                if manufacturer_id:
+                    # Must be hex; shown in three-byte format (e.g., "06" -> "00 00 06")
+                    try:
+                        int(manufacturer_id, 16)
+                        three_byte_id = f"00 00 {manufacturer_id.zfill(2).upper()}"
+                        manufacturer_ids[manufacturer_name] = three_byte_id
+                    except ValueError:
+                        print(f"Invalid hex manufacturer ID: {manufacturer_id}")
+        
+    except Exception as e:
+        print(f"Error parsing {file_path}: {e}")
+    
+    return manufacturer_ids
+
+
+def index_middev_file(file_path):
+    """Content hash and manufacturer IDs of one .middev file, for the catalog index"""
+    try:
+        with open(file_path, 'rb') as f:
+            content_hash = hashlib.sha1(f.read()).hexdigest()
+    except OSError:
+        return None
+    return {'hash': content_hash, 'ids': read_middev_manufacturer_ids(file_path)}
+
+
+def iter_in_pool(func, items, workers, min_items=PARALLEL_MIN_FILES):
+    """Map func over items, in a process pool when there is enough work for one.
+
+    Results are yielded in input order as soon as they are ready. Small
+    batches run inline because starting worker processes costs more than
+    parsing a handful of files. func and the results are pickled, so func
+    must be a top-level function.
+    """
+    workers = min(workers, len(items))
+    if workers <= 1 or len(items) < min_items:
+        for item in items:
+            yield func(item)
+        return
+    
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    
+    # The server runs request and watcher threads; a plain fork would copy
+    # whatever locks they hold into the workers. forkserver (spawn where it
+    # does not exist) starts them from a clean single-threaded process.
+    method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    chunksize = max(1, len(items) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(method)) as pool:
+        yield from pool.map(func, items, chunksize=chunksize)
+
+
+def run_in_pool(func, items, workers, min_items=PARALLEL_MIN_FILES):
+    """iter_in_pool() collected into a list"""
+    return list(iter_in_pool(func, items, workers, min_items))
+
+
+# Elements whose Name attribute goes into the search index, and their kind
+SEARCH_NAME_KINDS = {'PatchBank': 'bank', 'Patch': 'patch', 'Note': 'note', 'Control': 'control'}
+
+# Devices listed per search result; file_count tells how many files use the name
+SEARCH_MAX_DEVICES = 20
+# Results returned by /search when ?limit= is not given, and at most
+SEARCH_DEFAULT_RESULTS = 50
+SEARCH_MAX_RESULTS = 500
+
+
+def collect_midnam_names(named):
+    """Distinct bank, patch, note and control names of (tag, Name) pairs, per kind"""
+    names = {}
+    for tag, name in named:
+        kind = SEARCH_NAME_KINDS.get(tag)
+        if kind and name:
+            names.setdefault(kind, set()).add(name)
+    return {kind: sorted(values) for kind, values in names.items()}
+
+
+class MidnamSummaryReader:
+    """Device header plus the analysis summary in one streaming pass.
+
+    Reads the whole document, but clears every element as soon as it closes,
+    so no tree is built. The device header comes from the Manufacturer, Model
+    and DeviceID children of the first MasterDeviceNames and the first
+    ExtendingDeviceNames, wherever they are; a MasterDeviceNames anywhere in
+    the document wins, so device_info matches extract_device_info(). Header
+    bookkeeping stops as soon as the master header is complete or closed.
+    The summary matches analyze_midnam_root(). With rows=True it also
+    collects the CatalogStore rows, see table_rows().
+    """
+
+    def __init__(self, file_path, rows=False):
+        import xml.etree.ElementTree as ET
+        
+        self.file_path = file_path
+        self.parser = ET.XMLPullParser(events=('start', 'end'))
+        self.done = False
+        self.failed = False
+        self.header_done = False
+        self.device_info = None
+        self.depth = 0
+        # Header tag -> raw text of its Manufacturer/Model children and
+        # attributes of its DeviceID children; open headers with their depth
+        self.headers = {}
+        self.open_headers = {}
+        self.banks = []
+        self.open_banks = []
+        self.total_patches = 0
+        self.total_note_lists = 0
+        self.in_master = False
+        self.master_depth = None
+        self.master_texts = {}
+        # (seen, text) of the first Author child of the root / anywhere below it
+        self.direct_author = None
+        self.first_author = None
+        # Start elements carrying searchable names, see collect_midnam_names()
+        self.named = []
+        # Patch rows per bank and note rows per NoteNameList, when collecting rows;
+        # open_patches holds [number, name, program change, still looking for one]
+        self.rows = rows
+        self.bank_patches = []
+        self.open_patches = []
+        self.note_lists = []
+        self.open_note_lists = []
+
+    def feed(self, data):
+        """Feed the next chunk; returns True once parsing has stopped (on a parse error)"""
+        import xml.etree.ElementTree as ET
+        
+        if self.done:
+            return True
+        try:
+            self.parser.feed(data)
+            for event, elem in self.parser.read_events():
+                self.handle(event, elem)
+        except ET.ParseError as e:
+            print(f"Error parsing {self.file_path}: {e}")
+            self.failed = True
+            self.close()
+        return self.done
+
+    def close(self):
+        """End of input (or a parse error): settle whatever has been read"""
+        import xml.etree.ElementTree as ET
+        
+        if not self.done:
+            # Reached the end of the file while still parsing: catch truncation
+            try:
+                self.parser.close()
+            except ET.ParseError as e:
+                print(f"Error parsing {self.file_path}: {e}")
+                self.failed = True
+        if not self.header_done:
+            self.finish_header()
+        if self.failed:
+            # extract_device_info() never sees a document that does not parse
+            self.device_info = None
+        self.done = True
+
+    def handle(self, event, elem):
+        tag = elem.tag
+        
+        if event == 'start':
+            self.depth += 1
+            if not self.header_done:
+                self.handle_header(event, elem)
+            if tag in SEARCH_NAME_KINDS:
+                self.named.append((tag, elem.get('Name')))
+            if self.rows:
+                self.collect_row(elem)
+            if tag == 'PatchBank':
+                self.open_banks.append(len(self.banks))
+                self.banks.append({'name': elem.get('Name', 'Unnamed Bank'), 'patch_count': 0})
+            elif tag == 'Patch':
+                self.total_patches += 1
+                for index in self.open_banks:
+                    self.banks[index]['patch_count'] += 1
+            elif tag == 'NoteNameList':
+                self.total_note_lists += 1
+            elif tag == 'MasterDeviceNames' and self.master_depth is None:
+                self.in_master = True
+                self.master_depth = self.depth
+            return
+        
+        if not self.header_done:
+            self.handle_header(event, elem)
+        depth = self.depth
+        if self.rows:
+            self.finish_row(elem)
+        if tag == 'PatchBank':
+            self.open_banks.pop()
+        elif tag == 'Author' and depth >= 2:
+            if self.first_author is None:
+                self.first_author = elem.text
+            if depth == 2 and self.direct_author is None:
+                self.direct_author = elem.text
+        elif self.in_master and depth == self.master_depth + 1 and tag in ('Manufacturer', 'Model'):
+            self.master_texts.setdefault(tag, elem.text)
+        elif self.in_master and depth == self.master_depth:
+            self.in_master = False
+        elem.clear()
+        self.depth -= 1
+
+    def collect_row(self, elem):
+        """Start of an element, when collecting rows (before open_banks is updated)"""
+        tag = elem.tag
+        if tag == 'PatchBank':
+            self.bank_patches.append([])
+        elif tag == 'Patch':
+            program = elem.get('ProgramChange')
+            self.open_patches.append([elem.get('Number'), elem.get('Name'), program or None, not program])
+        elif tag == 'ProgramChange':
+            # The first ProgramChange below a Patch without the attribute
+            for patch in self.open_patches:
+                if patch[3]:
+                    patch[2] = elem.get('Number')
+                    patch[3] = False
+        elif tag == 'NoteNameList':
+            self.open_note_lists.append(len(self.note_lists))
+            self.note_lists.append((elem.get('Name'), []))
+        elif tag == 'Note':
+            number = elem.get('Number')
+            for index in self.open_note_lists:
+                name, notes = self.note_lists[index]
+                notes.append((name, int(number) if number and number.isdigit() else None, elem.get('Name')))
+
+    def finish_row(self, elem):
+        """End of an element, when collecting rows (before open_banks is updated)"""
+        if elem.tag == 'Patch':
+            number, name, program, _ = self.open_patches.pop()
+            program = int(program) if program and program.isdigit() else None
+            for index in self.open_banks:
+                self.bank_patches[index].append((self.banks[index]['name'], number, name, program))
+        elif elem.tag == 'NoteNameList':
+            self.open_note_lists.pop()
+
+    def table_rows(self):
+        """The rows midnam_table_rows() gives for the parsed tree"""
+        return {
+            'banks': [(position, bank['name'], bank['patch_count']) for position, bank in enumerate(self.banks)],
+            'patches': [row for patches in self.bank_patches for row in patches],
+            'notes': [row for name, notes in self.note_lists for row in notes]
+        }
+
+    def handle_header(self, event, elem):
+        """Collect the device header fields; elem is at self.depth"""
+        if event == 'start':
+            if self.depth == 1 and elem.tag != 'MIDINameDocument':
+                self.finish_header()
+            elif elem.tag in ('MasterDeviceNames', 'ExtendingDeviceNames') and elem.tag not in self.headers:
+                self.headers[elem.tag] = {'Manufacturer': [], 'Model': [], 'DeviceID': []}
+                self.open_headers[elem.tag] = self.depth
+            return
+        
+        for header, depth in list(self.open_headers.items()):
+            fields = self.headers[header]
+            if self.depth == depth + 1 and elem.tag in fields:
+                fields[elem.tag].append(dict(elem.attrib) if elem.tag == 'DeviceID' else elem.text)
+                if header == 'MasterDeviceNames' and all(fields.values()):
+                    # Only the first of each is used; later ones change nothing
+                    self.finish_header()
+                    return
+            elif self.depth == depth:
+                del self.open_headers[header]
+                if header == 'MasterDeviceNames':
+                    self.finish_header()
+                    return
+
+    def finish_header(self):
+        """Build the device info from the collected header"""
+        self.header_done = True
+        if 'MasterDeviceNames' in self.headers:
+            header = 'MasterDeviceNames'
+        elif 'ExtendingDeviceNames' in self.headers:
+            header = 'ExtendingDeviceNames'
+        else:
+            return
+        
+        fields = self.headers[header]
+        manufacturers = fields['Manufacturer']
+        models = fields['Model']
+        if not manufacturers or not models:
+            return
+        
+        manufacturer = (manufacturers[0] or '').strip()
+        
+        if header == 'MasterDeviceNames':
+            family_id = None
+            device_id = None
+            if fields['DeviceID']:
+                family_id = fields['DeviceID'][0].get('Family')
+                device_id = fields['DeviceID'][0].get('Member')
+            
+            self.device_info = {
+                'manufacturer': manufacturer,
+                'model': (models[0] or '').strip(),
+                'family_id': family_id,
+                'device_id': device_id,
+                'file_path': self.file_path,
+                'type': 'master'
+            }
+        else:
+            self.device_info = {
+                'manufacturer': manufacturer,
+                'model': (models[0] or '').strip(),
+                'family_id': None,
+                'device_id': None,
+                'file_path': self.file_path,
+                'type': 'extending',
+                'all_models': [m.strip() for m in models if m]
+            }
+
+    def summary(self):
+        author = "Unknown"
+        if self.direct_author:
+            author = self.direct_author.strip()
+        elif self.first_author:
+            author = self.first_author.strip()
+        
+        return {
+            'manufacturer': self.master_texts.get('Manufacturer') or "Unknown",
+            'model': self.master_texts.get('Model') or "Unknown",
+            'author': author,
+            'total_banks': len(self.banks),
+            'total_patches': self.total_patches,
+            'total_note_lists': self.total_note_lists,
+            'bank_details': self.banks
+        }
+
+    def names(self):
+        return collect_midnam_names(self.named)
+
+
+def analyze_midnam_root(root):
+    """Bank, patch and note list counts plus device and author of a parsed document"""
+    # Find MIDINameDocument
+    midnam_doc = root.find('.//MIDINameDocument')
+    if midnam_doc is None:
+        midnam_doc = root
+    
+    # Count banks and patches
+    banks = midnam_doc.findall('.//PatchBank')
+    patches = midnam_doc.findall('.//Patch')
+    note_lists = midnam_doc.findall('.//NoteNameList')
+    
+    # Extract device info
+    manufacturer = "Unknown"
+    model = "Unknown"
+    
+    master_device = midnam_doc.find('.//MasterDeviceNames')
+    if master_device is not None:
+        manufacturer_elem = master_device.find('Manufacturer')
+        model_elem = master_device.find('Model')
+        if manufacturer_elem is not None:
+            manufacturer = manufacturer_elem.text or "Unknown"
+        if model_elem is not None:
+            model = model_elem.text or "Unknown"
+    
+    # Extract Author information - try multiple approaches
+    author = "Unknown"
+    author_elem = midnam_doc.find('Author')
+    if author_elem is not None and author_elem.text:
+        author = author_elem.text.strip()
+    else:
+        # Try alternative approach - look for Author anywhere in the document
+        author_elem = root.find('.//Author')
+        if author_elem is not None and author_elem.text:
+            author = author_elem.text.strip()
+    
+    # Count patches per bank
+    bank_patch_counts = []
+    for bank in banks:
+        bank_name = bank.get('Name', 'Unnamed Bank')
+        bank_patches = bank.findall('.//Patch')
+        bank_patch_counts.append({
+            'name': bank_name,
+            'patch_count': len(bank_patches)
+        })
+    
+    return {
+        'manufacturer': manufacturer,
+        'model': model,
+        'author': author,
+        'total_banks': len(banks),
+        'total_patches': len(patches),
+        'total_note_lists': len(note_lists),
+        'bank_details': bank_patch_counts
+    }
+
+
+class FileRecord:
+    """Catalog index entry of one .midnam file.
+
+    analysis and names are held in memory only until the record is saved to
+    the catalog snapshot; from then on details is their (offset, length) in
+    the snapshot's details file, read back by MidnamCatalogIndex.details().
+    """
+
+    __slots__ = ('size', 'mtime', 'hash', 'device', 'analysis', 'names', 'details', 'rows')
+
+    def __init__(self, size, mtime, hash, device, analysis=None, names=None, details=None, rows=None):
+        self.size = size
+        self.mtime = mtime
+        self.hash = hash
+        self.device = device
+        self.analysis = analysis
+        self.names = names
+        self.details = details
+        # CatalogStore rows, only from indexing until the store has them
+        self.rows = rows
+
+    def core(self):
+        """The fields stored in the snapshot itself: (size, mtime, hash, device, details)"""
+        return (self.size, self.mtime, self.hash, self.device, self.details)
+
+
+def index_midnam_file(file_path, chunk_size=64 * 1024, feed_size=16 * 1024, rows=False):
+    """Read one .midnam file into an index record.
+
+    A single streaming pass hashes the file, extracts the device header and
+    computes the analysis summary (plus the CatalogStore rows with rows=True),
+    without building a tree. Returns None when the file cannot be read. Runs
+    in catalog build worker processes, so it must stay a picklable
+    module-level function.
+    """
+    content_hash = hashlib.sha1()
+    size = 0
+    reader = MidnamSummaryReader(file_path, rows)
+    
+    try:
+        with open(file_path, 'rb') as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                size += len(chunk)
+                content_hash.update(chunk)
+                offset = 0
+                while not reader.done and offset < len(chunk):
+                    reader.feed(chunk[offset:offset + feed_size])
+                    offset += feed_size
+    except OSError as e:
+        print(f"Error reading {file_path}: {e}")
+        return None
+    
+    reader.close()
+    
+    return FileRecord(
+        size, None, content_hash.hexdigest(), reader.device_info,
+        # A document that failed to parse gets analysed on request instead
+        analysis=None if reader.failed else reader.summary(),
+        names={} if reader.failed else reader.names(),
+        rows=reader.table_rows() if rows and not reader.failed else None
+    )
+
+
+def midnam_table_rows(root):
+    """Bank, patch and note rows of a parsed .midnam document for the SQLite catalog store.
+
+    Returns {'banks': [(position, name, patch_count)], 'patches': [(bank,
+    number, name, program_change)], 'notes': [(list, number, name)]}.
+    Files read by the indexer get the same rows from MidnamSummaryReader.
+    """
+    rows = {'banks': [], 'patches': [], 'notes': []}
+    for position, bank in enumerate(root.iter('PatchBank')):
+        bank_name = bank.get('Name', 'Unnamed Bank')
+        patches = list(bank.iter('Patch'))
+        rows['banks'].append((position, bank_name, len(patches)))
+        for patch in patches:
+            program = patch.find('.//ProgramChange')
+            program_change = patch.get('ProgramChange') or (program.get('Number') if program is not None else None)
+            rows['patches'].append((bank_name, patch.get('Number'), patch.get('Name'),
+                                    int(program_change) if program_change and program_change.isdigit() else None))
+    for note_list in root.iter('NoteNameList'):
+        for note in note_list.iter('Note'):
+            number = note.get('Number')
+            rows['notes'].append((note_list.get('Name'), int(number) if number and number.isdigit() else None,
+                                  note.get('Name')))
+    return rows
+
+
+def summarize_midnam_file(file_path):
+    """Size, mtime and analysis of one file, for batch analysis workers"""
+    try:
+        mtime = os.path.getmtime(file_path)
+    except OSError:
+        return None
+    record = index_midnam_file(file_path)
+    if record is None:
+        return None
+    return {'size': record.size, 'mtime': mtime, 'analysis': record.analysis}
+
+
+# DTDs the validator knows, by DOCTYPE system identifier file name
+DTD_FILES = {
+    'midnam.dtd': 'midnam.dtd',
+    'MIDINameDocument10.dtd': 'dtd/MIDINameDocument10.dtd',
+    'MIDIDeviceTypes.dtd': 'dtd/MIDIDeviceTypes.dtd'
+}
+# DTD used when a document has no DOCTYPE, by root element
+DEFAULT_DTDS = {
+    'MIDINameDocument': 'MIDINameDocument10.dtd',
+    'MIDIDeviceTypes': 'MIDIDeviceTypes.dtd'
+}
+
+
+class ElementRule:
+    """Compiled DTD declaration of one element: content model plus attributes"""
+
+    def __init__(self, name, model):
+        self.name = name
+        self.model = model
+        # 'empty', 'any', 'mixed', 'children' or 'unchecked' (unresolved entity)
+        self.kind = None
+        self.pattern = None
+        self.allowed = set()
+        self.attributes = {}
+
+
+class DTDSchema:
+    """Structural rules compiled from a DTD file.
+
+    Content models become regular expressions over the sequence of child
+    tags, so checking an element is one fullmatch() no matter how large the
+    model. Parameter entities declared in the file are expanded; models that
+    depend on external entities which are not available (the MIDIEvents DTD
+    referenced by MIDINameDocument10.dtd) are left unchecked.
+    """
+
+    def __init__(self, path):
+        import re
+        
+        self.path = path
+        with open(path, 'r', encoding='utf-8') as f:
+            text = re.sub(r'<!--.*?-->', '', f.read(), flags=re.S)
+        
+        entities = {}
+        for name, value in re.findall(r'<!ENTITY\s+%\s+(\S+)\s+(?:"([^"]*)"|\'[^\']*\'|PUBLIC|SYSTEM)', text):
+            if value:
+                entities[name] = value
+        
+        def expand(declaration):
+            for _ in range(10):
+                expanded = re.sub(r'%([\w.-]+);', lambda m: entities.get(m.group(1), m.group(0)), declaration)
+                if expanded == declaration:
+                    break
+                declaration = expanded
+            return declaration
+        
+        self.elements = {}
+        for name, model in re.findall(r'<!ELEMENT\s+(\S+)\s+(.*?)>', text, flags=re.S):
+            rule = ElementRule(name, ' '.join(expand(model).split()))
+            self.compile_model(rule)
+            self.elements[name] = rule
+        
+        for name, body in re.findall(r'<!ATTLIST\s+(\S+)\s+(.*?)>', text, flags=re.S):
+            rule = self.elements.get(name)
+            if rule is None:
+                rule = self.elements[name] = ElementRule(name, 'ANY')
+                rule.kind = 'unchecked'
+            attr_pattern = r'(\S+)\s+(\([^)]*\)|\S+)\s+(#REQUIRED|#IMPLIED|#FIXED\s+"[^"]*"|"[^"]*"|\'[^\']*\')'
+            for attr_name, attr_type, default in re.findall(attr_pattern, expand(body)):
+                values = None
+                if attr_type.startswith('('):
+                    values = {v.strip() for v in attr_type[1:-1].split('|')}
+                    attr_type = 'ENUM'
+                fixed = None
+                if default.startswith('#FIXED'):
+                    fixed = default.split('"')[1]
+                rule.attributes[attr_name] = {
+                    'type': attr_type,
+                    'values': values,
+                    'required': default == '#REQUIRED',
+                    'fixed': fixed
+                }
+
+    def compile_model(self, rule):
+        import re
+        
+        model = rule.model
+        if '%' in model:
+            rule.kind = 'unchecked'
+        elif model == 'EMPTY':
+            rule.kind = 'empty'
+        elif model == 'ANY':
+            rule.kind = 'any'
+        elif '#PCDATA' in model:
+            rule.kind = 'mixed'
+            rule.allowed = set(re.findall(r'[A-Za-z_][\w.:-]*', model.replace('#PCDATA', '')))
+        else:
+            rule.kind = 'children'
+            parts = []
+            for token in re.findall(r'[A-Za-z_][\w.:-]*|[(),|?*+]', model):
+                if token == '(':
+                    parts.append('(?:')
+                elif token == ',':
+                    continue
+                elif token in ')|?*+':
+                    parts.append(token)
+                else:
+                    parts.append('(?:<' + re.escape(token) + '>)')
+            rule.pattern = re.compile(''.join(parts))
+
+    def validate(self, root, errors):
+        """Append 'Line N: ...' messages for every structural problem under root"""
+        import re
+        
+        nmtoken = re.compile(r'[\w.:-]+$')
+        stack = [(root, None)]
+        while stack:
+            node, parent_rule = stack.pop()
+            rule = self.elements.get(node.tag)
+            if rule is None:
+                # Children of unchecked models may come from an external DTD
+                if parent_rule is None or parent_rule.kind != 'unchecked':
+                    errors.append(f"Line {node.line}: Element <{node.tag}> is not declared in the DTD")
+                continue
+            
+            for attr_name in node.attrib:
+                if attr_name not in rule.attributes and rule.kind != 'unchecked':
+                    errors.append(f"Line {node.line}: Attribute {attr_name} is not declared for <{node.tag}>")
+            for attr_name, attr in rule.attributes.items():
+                value = node.attrib.get(attr_name)
+                if value is None:
+                    if attr['required']:
+                        errors.append(f"Line {node.line}: <{node.tag}> is missing required attribute {attr_name}")
+                elif attr['values'] is not None and value not in attr['values']:
+                    errors.append(f"Line {node.line}: Attribute {attr_name}=\"{value}\" of <{node.tag}> "
+                                  f"must be one of {' | '.join(sorted(attr['values']))}")
+                elif attr['type'] == 'NMTOKEN' and not nmtoken.match(value):
+                    errors.append(f"Line {node.line}: Attribute {attr_name}=\"{value}\" of <{node.tag}> is not a name token")
+                elif attr['fixed'] is not None and value != attr['fixed']:
+                    errors.append(f"Line {node.line}: Attribute {attr_name} of <{node.tag}> must be \"{attr['fixed']}\"")
+            
+            if rule.kind == 'empty':
+                if node.children or node.has_text:
+                    errors.append(f"Line {node.line}: <{node.tag}> must be empty")
+            elif rule.kind == 'mixed':
+                for child in node.children:
+                    if child.tag not in rule.allowed:
+                        errors.append(f"Line {child.line}: <{child.tag}> is not allowed inside <{node.tag}>")
+            elif rule.kind == 'children':
+                if node.has_text:
+                    errors.append(f"Line {node.line}: <{node.tag}> must not contain text")
+                sequence = ''.join(f'<{child.tag}>' for child in node.children)
+                if not rule.pattern.fullmatch(sequence):
+                    errors.append(f"Line {node.line}: Content of <{node.tag}> does not match {rule.model}")
+            
+            for child in reversed(node.children):
+                stack.append((child, rule))
+
+
+class ValidationNode:
+    """Element with the line it starts on, as built by parse_with_lines()"""
+
+    def __init__(self, tag, attrib, line):
+        self.tag = tag
+        self.attrib = attrib
+        self.line = line
+        self.children = []
+        self.has_text = False
+
+
+def parse_with_lines(xml_data):
+    """Parse XML into ValidationNodes; returns (root, DOCTYPE system id)"""
+    import xml.parsers.expat
+    
+    parser = xml.parsers.expat.ParserCreate()
+    state = {'root': None, 'system_id': None}
+    stack = []
+    
+    def start(tag, attrib):
+        node = ValidationNode(tag, attrib, parser.CurrentLineNumber)
+        if stack:
+            stack[-1].children.append(node)
+        else:
+            state['root'] = node
+        stack.append(node)
+    
+    def end(tag):
+        stack.pop()
+    
+    def text(data):
+        if stack and not stack[-1].has_text and data.strip():
+            stack[-1].has_text = True
+    
+    def doctype(name, system_id, public_id, has_internal_subset):
+        state['system_id'] = system_id
+    
+    parser.StartElementHandler = start
+    parser.EndElementHandler = end
+    parser.CharacterDataHandler = text
+    parser.StartDoctypeDeclHandler = doctype
+    if isinstance(xml_data, str):
+        xml_data = xml_data.encode('utf-8')
+    parser.Parse(xml_data, True)
+    return state['root'], state['system_id']
+
+
+DTD_SCHEMAS = {}
+DTD_SCHEMAS_LOCK = threading.Lock()
+
+
+def get_dtd_schema(name):
+    """Compiled schema for a known DTD name, compiled on first use and cached"""
+    with DTD_SCHEMAS_LOCK:
+        if name not in DTD_SCHEMAS:
+            DTD_SCHEMAS[name] = DTDSchema(DTD_FILES[name])
+        return DTD_SCHEMAS[name]
+
+
+def load_dtd_schemas():
+    """Compile every known DTD up front (called at server start)"""
+    for name in DTD_FILES:
+        try:
+            get_dtd_schema(name)
+        except Exception as e:
+            print(f"Error compiling DTD {name}: {e}")
+
+
+def check_unique_numbers(root, errors):
+    """Set-based duplicate checks for Note, Patch and ProgramChange numbers"""
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        stack.extend(node.children)
+        
+        if node.tag == 'NoteNameList':
+            seen = set()
+            notes = [c for c in node.children if c.tag == 'Note']
+            for group in node.children:
+                if group.tag == 'NoteGroup':
+                    notes.extend(c for c in group.children if c.tag == 'Note')
+            for note in notes:
+                num = note.attrib.get('Number')
+                name = note.attrib.get('Name')
+                if not num or not name:
+                    errors.append(f"Line {note.line}: Missing number or name in {node.attrib.get('Name')}")
+                    continue
+                if num in seen:
+                    errors.append(f"Line {note.line}: Duplicate note number {num} in {node.attrib.get('Name')}")
+                seen.add(num)
+                if not num.isdigit() or int(num) > 127:
+                    errors.append(f"Line {note.line}: Note number {num} in {node.attrib.get('Name')} is outside 0-127")
+        
+        elif node.tag == 'PatchNameList':
+            numbers = set()
+            commands = set()
+            for patch in node.children:
+                if patch.tag != 'Patch':
+                    continue
+                num = patch.attrib.get('Number')
+                if num is not None:
+                    if num in numbers:
+                        errors.append(f"Line {patch.line}: Duplicate patch number {num} in {node.attrib.get('Name')}")
+                    numbers.add(num)
+                
+                # Two patches selected by the same bank select + program change
+                for midi_commands in patch.children:
+                    if midi_commands.tag != 'PatchMIDICommands':
+                        continue
+                    key = tuple((c.tag, tuple(sorted(c.attrib.items()))) for c in midi_commands.children)
+                    program = [c for c in midi_commands.children if c.tag == 'ProgramChange']
+                    if not program:
+                        continue
+                    if key in commands:
+                        errors.append(f"Line {program[0].line}: Duplicate program change "
+                                      f"{program[0].attrib.get('Number')} in {node.attrib.get('Name')}")
+                    commands.add(key)
+
+
+def validate_midnam(xml_data):
+    """Validate a MIDI name or device types document.
+
+    Returns a list of error strings prefixed with their line number; an empty
+    list means the document is valid against its DTD and has no duplicate
+    note, patch or program change numbers.
+    """
+    import xml.parsers.expat
+    
+    try:
+        root, system_id = parse_with_lines(xml_data)
+    except xml.parsers.expat.ExpatError as e:
+        return [f"XML Parse Error: {xml.parsers.expat.ErrorString(e.code)}: line {e.lineno}, column {e.offset}"]
+    
+    errors = []
+    dtd_name = os.path.basename(system_id) if system_id else DEFAULT_DTDS.get(root.tag)
+    if dtd_name in DTD_FILES:
+        get_dtd_schema(dtd_name).validate(root, errors)
+    elif system_id:
+        errors.append(f"Line 1: Unknown DTD {system_id}")
+    else:
+        errors.append(f"Line {root.line}: Unknown document type <{root.tag}>")
+    
+    check_unique_numbers(root, errors)
+    return errors
+
+
+def validate_midnam_file(task):
+    """Validate one file for the bulk validator (runs in a worker process).
+
+    task is (file_path, hash it had when it last passed or None). A file whose
+    content still has that hash is reported as skipped without being parsed.
+    """
+    file_path, passed_hash = task
+    try:
+        with open(file_path, 'rb') as f:
+            data = f.read()
+    except OSError as e:
+        return {'path': file_path, 'valid': False, 'errors': [f"Error reading file: {e}"], 'hash': None}
+    
+    content_hash = hashlib.sha1(data).hexdigest()
+    if content_hash == passed_hash:
+        return {'path': file_path, 'valid': True, 'errors': [], 'hash': content_hash, 'skipped': True}
+    
+    errors = validate_midnam(data)
+    return {'path': file_path, 'valid': not errors, 'errors': errors, 'hash': content_hash}
+
+
+class BulkValidator:
+    """Validates every .midnam and .middev under the patchfiles directory.
+
+    Files that passed last time are remembered by (mtime, size, hash): an
+    unchanged mtime skips the file outright, and a changed mtime with the same
+    content hash skips it after hashing. The record is invalidated when the
+    DTDs change.
+    """
+
+    def __init__(self, patchfiles_dir=PATCHFILES_DIR, cache_file=VALIDATION_CACHE_FILE, workers=None):
+        self.patchfiles_dir = patchfiles_dir
+        self.cache_file = cache_file
+        self.workers = workers or CATALOG_BUILD_WORKERS
+        # relative path -> {'mtime': ns, 'size': bytes, 'hash': sha1} of files that passed
+        self.passed = {}
+        self.loaded = False
+        self.lock = threading.Lock()
+
+    def rules_fingerprint(self):
+        """Hash of the DTDs, so editing one revalidates everything"""
+        digest = hashlib.sha1(str(VALIDATION_CACHE_VERSION).encode())
+        for name in sorted(DTD_FILES):
+            try:
+                with open(DTD_FILES[name], 'rb') as f:
+                    digest.update(f.read())
+            except OSError:
+                pass
+        return digest.hexdigest()
+
+    def load(self):
+        """Load the results of the previous run, if they match the current DTDs"""
+        self.loaded = True
+        if not os.path.exists(self.cache_file):
+            return
+        try:
+            with open(self.cache_file, 'r') as f:
+                cache_data = json.load(f)
+            if cache_data.get('rules') == self.rules_fingerprint():
+                self.passed = cache_data.get('passed', {})
+        except Exception as e:
+            print(f"Ignoring unreadable validation cache: {e}")
+            self.passed = {}
+
+    def save(self):
+        """Persist the files that passed"""
+        import time
+        try:
+            with open(self.cache_file, 'w') as f:
+                json.dump({
+                    'rules': self.rules_fingerprint(),
+                    'timestamp': time.time(),
+                    'passed': self.passed
+                }, f, indent=2)
+        except Exception as e:
+            print(f"Error writing validation cache: {e}")
+
+    def clear(self):
+        with self.lock:
+            self.passed = {}
+            self.loaded = True
+
+    def scan(self):
+        """Stat every .midnam and .middev file under the patchfiles directory"""
+        stats = {}
+        for root, dirs, files in os.walk(self.patchfiles_dir):
+            for file in files:
+                if file.endswith('.midnam') or file.endswith('.middev'):
+                    file_path = os.path.join(root, file).replace('\\', '/')
+                    try:
+                        st = os.stat(file_path)
+                    except OSError:
+                        continue
+                    stats[file_path] = (st.st_size, st.st_mtime_ns)
+        return dict(sorted(stats.items()))
+
+    def run(self, force=False):
+        """Validate the tree, yielding one result per file and then a summary.
+
+        Each result is {'path', 'valid', 'errors'} plus 'skipped': True for
+        files that passed last time and have not changed. With force every
+        file is validated again.
+        """
+        import time
+        
+        start = time.time()
+        with self.lock:
+            if not self.loaded:
+                self.load()
+            passed = {} if force else dict(self.passed)
+        
+        stats = self.scan()
+        results = []
+        tasks = []
+        for path, (size, mtime_ns) in stats.items():
+            record = passed.get(path)
+            if record and record['mtime'] == mtime_ns and record['size'] == size:
+                results.append({'path': path, 'valid': True, 'errors': [], 'skipped': True})
+            else:
+                tasks.append((path, record['hash'] if record else None))
+        
+        counts = {'total': len(stats), 'validated': 0, 'skipped': 0, 'passed': 0, 'failed': 0}
+        now_passed = {}
+        
+        def report(result):
+            path = result['path']
+            if result.get('skipped'):
+                counts['skipped'] += 1
+            else:
+                counts['validated'] += 1
+            if result['valid']:
+                counts['passed'] += 1
+                size, mtime_ns = stats[path]
+                content_hash = result.get('hash') or passed[path]['hash']
+                now_passed[path] = {'mtime': mtime_ns, 'size': size, 'hash': content_hash}
+            else:
+                counts['failed'] += 1
+            result.pop('hash', None)
+            return result
+        
+        for result in results:
+            yield report(result)
+        for result in iter_in_pool(validate_midnam_file, tasks, self.workers, ANALYZE_PARALLEL_MIN_FILES):
+            yield report(result)
+        
+        with self.lock:
+            self.passed = now_passed
+            self.save()
+        
+        counts['seconds'] = round(time.time() - start, 3)
+        yield {'summary': counts}
+
+
+BULK_VALIDATOR = BulkValidator()
+
+
+# Header for documents written without a source DOCTYPE to copy
+MIDNAM_DOCTYPE = '<!DOCTYPE MIDINameDocument SYSTEM "midnam.dtd">'
+
+
+def read_doctype(file_path, limit=4096):
+    """The DOCTYPE declaration at the top of an XML file, or None"""
+    import re
+    
+    try:
+        with open(file_path, 'rb') as f:
+            head = f.read(limit)
+    except OSError:
+        return None
+    match = re.search(rb'<!DOCTYPE[^>\[]*>', head)
+    return match.group(0).decode('utf-8', 'replace') if match else None
+
+
+class AtomicFile:
+    """Binary file that replaces path only once everything is written and synced.
+
+    Use as a context manager: data goes to a temp file in the same directory,
+    which on success is fsynced, given the old file's permissions and renamed
+    over path (then the directory is fsynced too). A crash or exception at any
+    point leaves the previous file untouched.
+    """
+
+    def __init__(self, path):
+        import tempfile
+        
+        self.path = path
+        self.directory = os.path.dirname(path) or '.'
+        fd, self.temp_path = tempfile.mkstemp(dir=self.directory, prefix='.' + os.path.basename(path) + '.',
+                                              suffix='.tmp')
+        self.file = os.fdopen(fd, 'wb')
+
+    def __enter__(self):
+        return self.file
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                self.file.flush()
+                os.fsync(self.file.fileno())
+            self.file.close()
+            if exc_type is None:
+                try:
+                    mode = os.stat(self.path).st_mode & 0o777
+                except OSError:
+                    mode = 0o644
+                os.chmod(self.temp_path, mode)
+                os.replace(self.temp_path, self.path)
+        except BaseException:
+            self.discard()
+            raise
+        if exc_type is not None:
+            self.discard()
+            return False
+        self.sync_directory()
+        return False
+
+    def discard(self):
+        try:
+            os.remove(self.temp_path)
+        except OSError:
+            pass
+
+    def sync_directory(self):
+        """Make the rename itself durable (not possible on every platform)"""
+        try:
+            fd = os.open(self.directory, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+
+class EditableDocument:
+    """A document parsed so that serialize() gives back what was read.
+
+    Unlike the shared trees in DOCUMENT_CACHE, the tree keeps comments and
+    processing instructions, the prolog (XML declaration, DOCTYPE, leading
+    comments) is kept as raw bytes, and every namespace declaration is
+    remembered on the element that made it, so prefixes survive instead of
+    becoming ns0:. Used by /patch_file.
+    """
+
+    def __init__(self, content):
+        import re
+        import xml.etree.ElementTree as ET
+
+        class Builder(ET.TreeBuilder):
+            def __init__(self):
+                super().__init__(insert_comments=True, insert_pis=True)
+                self.pending = []
+                self.declarations = {}
+
+            def start_ns(self, prefix, uri):
+                self.pending.append((prefix or '', uri))
+
+            def start(self, tag, attrs):
+                element = super().start(tag, attrs)
+                if self.pending:
+                    self.declarations[element] = self.pending
+                    self.pending = []
+                return element
+
+        self.content = content
+        builder = Builder()
+        parser = ET.XMLParser(target=builder)
+        parser.feed(content)
+        self.root = parser.close()
+        self.declarations = builder.declarations
+        prolog = re.match(rb'(?:\s+|<\?.*?\?>|<!--.*?-->|<!DOCTYPE[^>\[]*(?:\[.*?\])?\s*>)*', content, re.DOTALL)
+        self.prolog = prolog.group(0)
+        self.epilog = content[len(content.rstrip()):]
+
+    def serialize(self):
+        """The document as bytes, in the encoding of its prolog (UTF-8)"""
+        parts = [self.prolog]
+        self.write_element(parts.append, self.root, {'xml': 'http://www.w3.org/XML/1998/namespace'})
+        parts.append(self.epilog)
+        return b''.join(part if isinstance(part, bytes) else part.encode('utf-8') for part in parts)
+
+    def write_element(self, write, element, bindings):
+        """Write element and its subtree; bindings maps prefix -> namespace in scope"""
+        import xml.etree.ElementTree as ET
+        from xml.sax.saxutils import escape
+
+        if element.tag is ET.Comment:
+            write(f'<!--{element.text or ""}-->')
+        elif element.tag is ET.ProcessingInstruction:
+            write(f'<?{element.text or ""}?>')
+        else:
+            bindings = dict(bindings)
+            declared = []
+            for prefix, uri in self.declarations.get(element, ()):
+                bindings[prefix] = uri
+                declared.append((prefix, uri))
+
+            def qualify(name, attribute=False):
+                if not name.startswith('{'):
+                    if not attribute and bindings.get(''):
+                        # An unqualified element added under a default namespace
+                        bindings[''] = ''
+                        declared.append(('', ''))
+                    return name
+                uri, local = name[1:].split('}', 1)
+                for prefix, bound in bindings.items():
+                    if bound == uri and (prefix or not attribute):
+                        return f'{prefix}:{local}' if prefix else local
+                # Added content using a namespace the document never declared
+                prefix = '' if not attribute else next(
+                    f'ns{n}' for n in range(len(bindings) + 1) if f'ns{n}' not in bindings)
+                bindings[prefix] = uri
+                declared.append((prefix, uri))
+                return f'{prefix}:{local}' if prefix else local
+
+            tag = qualify(element.tag)
+            attributes = [(qualify(name, True), value) for name, value in element.items()]
+            namespaces = [(f'xmlns:{prefix}' if prefix else 'xmlns', uri) for prefix, uri in declared]
+            write('<' + tag)
+            for name, value in namespaces + attributes:
+                value = escape(value, {'"': '&quot;', '\n': '&#10;', '\r': '&#13;', '\t': '&#09;'})
+                write(f' {name}="{value}"')
+            if element.text or len(element):
+                write('>')
+                if element.text:
+                    write(escape(element.text))
+                for child in element:
+                    self.write_element(write, child, bindings)
+                write(f'</{tag}>')
+            else:
+                write('/>')
+        if element.tail:
+            write(escape(element.tail))
+
+
+def write_xml_document(root, output_file, doctype=MIDNAM_DOCTYPE):
+    """Write root to output_file with XML declaration and DOCTYPE, atomically.
+
+    The tree is serialized element by element straight into an AtomicFile,
+    so no full document string is built and readers never see a half-written
+    file.
+    """
+    import xml.etree.ElementTree as ET
+    
+    with AtomicFile(output_file) as f:
+        f.write(b'<?xml version="1.0" encoding="UTF-8"?>\n')
+        if doctype:
+            f.write(doctype.encode('utf-8') + b'\n')
+        ET.ElementTree(root).write(f, encoding='utf-8', xml_declaration=False)
+
+
+def split_chunks(data):
+    """Split a document into content-defined chunks.
+
+    Boundaries fall after a '>' or newline whose preceding segment hashes to
+    a fixed pattern, so they depend only on nearby content: renaming one Note
+    changes the chunk holding it and leaves every other chunk identical.
+    """
+    import re
+    import zlib
+    
+    chunks = []
+    start = 0
+    segment_start = 0
+    for match in re.finditer(rb'[>\n]', data):
+        end = match.end()
+        segment = data[segment_start:end]
+        segment_start = end
+        size = end - start
+        if size >= REVISION_CHUNK_MAX or (size >= REVISION_CHUNK_MIN and
+                                          zlib.crc32(segment) & REVISION_CHUNK_MASK == 0):
+            chunks.append(data[start:end])
+            start = end
+    if start < len(data):
+        chunks.append(data[start:])
+    return chunks
+
+
+class RevisionStore:
+    """Saved versions of documents, stored as deduplicated compressed chunks.
+
+    Each document is split with split_chunks() and every chunk is stored once
+    under objects/ by its sha1, zlib compressed. A revision is the sha1 of
+    the whole document plus the object listing its chunks, so a save costs
+    the chunks it changed and storage follows the size of the edits rather
+    than the number of saves. Per-file revision lists live under files/.
+    """
+
+    def __init__(self, root=REVISIONS_DIR):
+        self.root = root
+        self.lock = threading.Lock()
+
+    def object_path(self, object_id):
+        return os.path.join(self.root, 'objects', object_id[:2], object_id[2:])
+
+    def put_object(self, data):
+        import zlib
+        
+        object_id = hashlib.sha1(data).hexdigest()
+        path = self.object_path(object_id)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with AtomicFile(path) as f:
+                f.write(zlib.compress(data))
+        return object_id
+
+    def get_object(self, object_id):
+        import zlib
+        
+        with open(self.object_path(object_id), 'rb') as f:
+            return zlib.decompress(f.read())
+
+    @staticmethod
+    def normalize(file_path):
+        return os.path.normpath(file_path).replace('\\', '/')
+
+    def manifest_path(self, file_path):
+        key = hashlib.sha1(self.normalize(file_path).encode('utf-8')).hexdigest()
+        return os.path.join(self.root, 'files', key + '.json')
+
+    def revisions(self, file_path):
+        """Revisions of file_path, oldest first: [{'id', 'time', 'size', 'chunks'}]"""
+        try:
+            with open(self.manifest_path(file_path), 'r') as f:
+                return json.load(f).get('revisions', [])
+        except (OSError, ValueError):
+            return []
+
+    def record(self, file_path, data):
+        """Store data as the newest revision of file_path; returns its id"""
+        import time
+        
+        revision_id = hashlib.sha1(data).hexdigest()
+        with self.lock:
+            revisions = self.revisions(file_path)
+            if revisions and revisions[-1]['id'] == revision_id:
+                return revision_id
+            
+            chunk_ids = [self.put_object(chunk) for chunk in split_chunks(data)]
+            revisions.append({
+                'id': revision_id,
+                'time': time.time(),
+                'size': len(data),
+                'chunks': self.put_object('\n'.join(chunk_ids).encode('ascii'))
+            })
+            manifest_path = self.manifest_path(file_path)
+            os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+            with AtomicFile(manifest_path) as f:
+                f.write(json.dumps({'path': self.normalize(file_path), 'revisions': revisions}).encode('utf-8'))
+        return revision_id
+
+    def find(self, file_path, revision_id):
+        """The newest revision whose id starts with revision_id (at least 6 characters)"""
+        if not revision_id or len(revision_id) < 6:
+            return None
+        for revision in reversed(self.revisions(file_path)):
+            if revision['id'].startswith(revision_id):
+                return revision
+        return None
+
+    def content(self, revision):
+        """Reassemble a revision's document and check it against its id"""
+        chunk_ids = self.get_object(revision['chunks']).decode('ascii').split('\n')
+        data = b''.join(self.get_object(chunk_id) for chunk_id in chunk_ids if chunk_id)
+        if hashlib.sha1(data).hexdigest() != revision['id']:
+            raise ValueError(f"Revision {revision['id']} is corrupt")
+        return data
+
+    def diff(self, file_path, from_data, to_data, from_label, to_label):
+        """Unified diff between two versions of file_path"""
+        import difflib
+        
+        name = self.normalize(file_path)
+        return ''.join(difflib.unified_diff(
+            from_data.decode('utf-8', 'replace').splitlines(keepends=True),
+            to_data.decode('utf-8', 'replace').splitlines(keepends=True),
+            fromfile=f'{name}@{from_label}',
+            tofile=f'{name}@{to_label}'
+        ))
+
+    def stats(self):
+        """Number and on-disk size of stored objects"""
+        count = 0
+        size = 0
+        for root, dirs, files in os.walk(os.path.join(self.root, 'objects')):
+            for file in files:
+                count += 1
+                size += os.path.getsize(os.path.join(root, file))
+        return {'objects': count, 'bytes': size}
+
+
+REVISIONS = RevisionStore()
+
+
+class FileSaver:
+    """Saves files atomically, keeping earlier versions.
+
+    With a RevisionStore (the default) the previous and new content are
+    recorded as revisions there. Without one, the current content is kept as
+    '<file>.backup.<timestamp>' (a hard link to the old inode where the
+    filesystem allows, a copy otherwise); no backup is made when an existing
+    one already holds that content, and after each save the oldest backups
+    beyond keep, or older than max_age_days, are removed. Saving the content
+    a file already has does not touch it at all.
+    """
+
+    def __init__(self, keep=BACKUP_KEEP, max_age_days=BACKUP_MAX_AGE_DAYS, revisions=None):
+        self.keep = keep
+        self.max_age_days = max_age_days
+        self.revisions = revisions
+        # backup path -> (size, mtime_ns, sha1), so backups are hashed once
+        self.hashes = {}
+        # One save at a time: backup, replace and prune must not interleave
+        self.lock = threading.Lock()
+
+    def file_hash(self, path):
+        st = os.stat(path)
+        cached = self.hashes.get(path)
+        if cached and cached[0] == st.st_size and cached[1] == st.st_mtime_ns:
+            return cached[2]
+        digest = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(64 * 1024), b''):
+                digest.update(chunk)
+        self.hashes[path] = (st.st_size, st.st_mtime_ns, digest.hexdigest())
+        return digest.hexdigest()
+
+    def list_backups(self, file_path):
+        """[(created, backup path)] for file_path, newest first"""
+        from datetime import datetime
+        
+        directory = os.path.dirname(file_path) or '.'
+        prefix = os.path.basename(file_path) + '.backup.'
+        backups = []
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            return backups
+        for name in names:
+            if not name.startswith(prefix):
+                continue
+            path = os.path.join(directory, name)
+            created = None
+            for time_format in BACKUP_TIME_FORMATS:
+                try:
+                    created = datetime.strptime(name[len(prefix):], time_format).timestamp()
+                    break
+                except ValueError:
+                    continue
+            if created is None:
+                try:
+                    created = os.stat(path).st_mtime
+                except OSError:
+                    continue
+            backups.append((created, path))
+        backups.sort(reverse=True)
+        return backups
+
+    def backup(self, file_path, current_hash):
+        """Keep the current content of file_path unless a backup already has it"""
+        import shutil
+        from datetime import datetime
+        
+        for created, path in self.list_backups(file_path):
+            try:
+                if self.file_hash(path) == current_hash:
+                    return None
+            except OSError:
+                continue
+        
+        backup_name = f'{file_path}.backup.{datetime.now().strftime(BACKUP_TIME_FORMATS[0])}'
+        try:
+            # The save replaces file_path with a new inode, so a link preserves the old one
+            os.link(file_path, backup_name)
+        except OSError:
+            shutil.copy2(file_path, backup_name)
+        return backup_name
+
+    def prune(self, file_path):
+        """Remove backups beyond the retention limits; returns the removed paths"""
+        import time
+        
+        removed = []
+        cutoff = time.time() - self.max_age_days * 86400 if self.max_age_days > 0 else None
+        for position, (created, path) in enumerate(self.list_backups(file_path)):
+            if (self.keep > 0 and position >= self.keep) or (cutoff is not None and created < cutoff):
+                try:
+                    os.remove(path)
+                    removed.append(path)
+                except OSError:
+                    pass
+                self.hashes.pop(path, None)
+        return removed
+
+    def save(self, file_path, data):
+        """Replace file_path with data (bytes).
+
+        Returns {'backup', 'revision', 'unchanged', 'pruned'}: the backup file
+        or revision id that now holds data, depending on the mode.
+        """
+        new_hash = hashlib.sha1(data).hexdigest()
+        with self.lock:
+            backup_name = None
+            if os.path.exists(file_path):
+                current_hash = self.file_hash(file_path)
+                if current_hash == new_hash:
+                    return {'backup': None, 'revision': None, 'unchanged': True, 'pruned': []}
+                if self.revisions is not None:
+                    # Files edited before the store existed start with their current content
+                    history = self.revisions.revisions(file_path)
+                    if not history or history[-1]['id'] != current_hash:
+                        with open(file_path, 'rb') as f:
+                            self.revisions.record(file_path, f.read())
+                else:
+                    backup_name = self.backup(file_path, current_hash)
+            
+            with AtomicFile(file_path) as f:
+                f.write(data)
+            self.hashes.pop(file_path, None)
+            
+            if self.revisions is not None:
+                revision = self.revisions.record(file_path, data)
+                return {'backup': None, 'revision': revision, 'unchanged': False, 'pruned': []}
+            return {'backup': backup_name, 'revision': None, 'unchanged': False, 'pruned': self.prune(file_path)}
+
+
+FILE_SAVER = FileSaver(revisions=REVISIONS)
+
+
+class PatchError(ValueError):
+    """An operation of a /patch_file request that cannot be applied"""
+
+
+def find_target(root, target):
+    """Resolve a patch target to (parent, element).
+
+    target is a list of steps like {"tag": "NoteNameList", "Name": "Drums"};
+    each step matches the first descendant of the previous match with that
+    tag and attribute values.
+    """
+    if not target:
+        return None, root
+    parent, current = None, root
+    for step in target:
+        step = dict(step)
+        tag = step.pop('tag', None)
+        found = None
+        for candidate_parent in current.iter():
+            for child in candidate_parent:
+                if not isinstance(child.tag, str):
+                    continue  # comment or processing instruction
+                if (tag is None or child.tag == tag) and all(child.get(k) == str(v) for k, v in step.items()):
+                    found = (candidate_parent, child)
+                    break
+            if found:
+                break
+        if found is None:
+            raise PatchError(f"No element matches {tag} {step}")
+        parent, current = found
+    return parent, current
+
+
+def apply_patch_operations(root, operations):
+    """Apply /patch_file operations to root in order; raises PatchError.
+
+    Operations:
+      {"op": "set", "target": [...], "attrs": {"Name": "Kick"}, "text": "..."}
+          (an attribute value of null removes it)
+      {"op": "add", "target": [...], "xml": "<Patch .../>", "index": n}
+          (index is optional; the element is appended by default)
+      {"op": "remove", "target": [...]}
+    """
+    import xml.etree.ElementTree as ET
+    
+    for number, operation in enumerate(operations):
+        try:
+            op = operation.get('op')
+            parent, element = find_target(root, operation.get('target') or [])
+            if op == 'set':
+                for name, value in (operation.get('attrs') or {}).items():
+                    if value is None:
+                        element.attrib.pop(name, None)
+                    else:
+                        element.set(name, str(value))
+                if 'text' in operation:
+                    element.text = operation['text']
+            elif op == 'add':
+                new_element = ET.fromstring(operation['xml'])
+                children = len(element)
+                index = operation.get('index')
+                index = children if index is None else min(int(index), children)
+                # Reuse the existing indentation so the file stays readable
+                if children:
+                    sibling_gap = element[0].tail if children > 1 else element.text
+                    if index == children:
+                        new_element.tail = element[-1].tail
+                        element[-1].tail = sibling_gap
+                    else:
+                        new_element.tail = sibling_gap
+                element.insert(index, new_element)
+            elif op == 'remove':
+                if parent is None:
+                    raise PatchError("Cannot remove the document element")
+                position = list(parent).index(element)
+                if position == len(parent) - 1 and position > 0:
+                    parent[position - 1].tail = element.tail
+                parent.remove(element)
+            else:
+                raise PatchError(f"Unknown op {op!r}")
+        except PatchError as e:
+            raise PatchError(f"Operation {number}: {e}")
+        except (KeyError, TypeError, AttributeError, ValueError, ET.ParseError) as e:
+            raise PatchError(f"Operation {number}: invalid operation ({e})")
+
+
+# Serializes read-modify-write of /patch_file so concurrent patches are not lost
+PATCH_LOCK = threading.Lock()
+
+
+# How merge_midnam_files resolves an incoming item that already exists
+MERGE_CONFLICT_MODES = ('keep', 'overwrite', 'rename')
+# Name lists and the items they hold, keyed by these attributes
+MERGE_LIST_ITEMS = {
+    'PatchNameList': ('Patch', ('Number',)),
+    'NoteNameList': ('Note', ('Number',)),
+    'ControlNameList': ('Control', ('Type', 'Number')),
+    'ValueNameList': ('Value', ('Number',))
+}
+# Name-set references that have to follow a renamed list or channel name set
+MERGE_REFERENCES = {
+    'UsesPatchNameList': ('PatchNameList', 'Name'),
+    'UsesNoteNameList': ('NoteNameList', 'Name'),
+    'UsesControlNameList': ('ControlNameList', 'Name'),
+    'UsesValueNameList': ('ValueNameList', 'Name'),
+    'ChannelNameSetAssign': ('ChannelNameSet', 'NameSet')
+}
+# Child order the DTD requires inside a ChannelNameSet
+CHANNEL_SET_ORDER = ('AvailableForChannels', 'NoteNameList', 'UsesNoteNameList',
+                     'ControlNameList', 'UsesControlNameList', 'PatchBank')
+
+
+class MidnamMerger:
+    """Merges MIDINameDocuments into a copy of a base document.
+
+    Channel name sets, patch banks, name lists and their items are found
+    through dict indexes (by name, and by Number for items) that are built
+    once and kept up to date as elements are added, so each incoming element
+    costs one lookup and merging many large files is linear in their size.
+
+    conflict decides what happens when an incoming element already exists:
+    'keep' leaves the base version, 'overwrite' replaces it, and 'rename' adds
+    incoming banks, name lists and channel name sets under a new name instead
+    of merging them (identical copies are still dropped). In every mode a
+    copied name list whose Name is already used gets a new one, so list
+    names stay unique.
+    """
+
+    def __init__(self, base_root, conflict='keep'):
+        if conflict not in MERGE_CONFLICT_MODES:
+            raise ValueError(f"Unknown conflict mode {conflict!r}")
+        self.root = copy.deepcopy(base_root)
+        self.conflict = conflict
+        self.container = self.find_container(self.root)
+        self.stats = {'added': 0, 'overwritten': 0, 'kept': 0, 'renamed': 0}
+        
+        # (tag, name) -> document-level name list; name -> ChannelNameSet
+        self.lists = {}
+        self.channel_sets = {}
+        for child in self.container:
+            if child.tag in MERGE_LIST_ITEMS:
+                self.lists.setdefault((child.tag, child.get('Name')), child)
+            elif child.tag == 'ChannelNameSet':
+                self.channel_sets.setdefault(child.get('Name'), child)
+        # id(element) -> (element, lazily built index of its banks or list items);
+        # the element is kept so its id cannot be reused while indexed
+        self.indexes = {}
+        # Serialized source element -> name it was added under, in 'rename' mode
+        self.fingerprints = {}
+        # Names of every name list in the merged tree, inline ones included,
+        # so that copied lists never end up sharing a Name
+        self.list_names = {tag: {element.get('Name') for element in self.root.iter(tag)}
+                           for tag in MERGE_LIST_ITEMS}
+
+    @staticmethod
+    def find_container(root):
+        """The MasterDeviceNames/ExtendingDeviceNames element holding a document's names"""
+        for child in root:
+            if child.tag in ('MasterDeviceNames', 'ExtendingDeviceNames'):
+                return child
+        return root
+
+    def unique_name(self, name, taken):
+        number = 2
+        while f"{name} ({number})" in taken:
+            number += 1
+        return f"{name} ({number})"
+
+    def item_key(self, tag, item):
+        key_attrs = MERGE_LIST_ITEMS[tag][1]
+        return tuple(item.get(attr, '7bit' if attr == 'Type' else None) for attr in key_attrs)
+
+    def item_index(self, name_list):
+        """key -> (parent, position) of the items of a name list, NoteGroups included.
+
+        Lists only ever grow by appending, so positions stay valid and an
+        overwrite is a single slice assignment.
+        """
+        entry = self.indexes.get(id(name_list))
+        if entry is None:
+            item_tag = MERGE_LIST_ITEMS[name_list.tag][0]
+            index = {}
+            for position, child in enumerate(name_list):
+                if child.tag == item_tag:
+                    index.setdefault(self.item_key(name_list.tag, child), (name_list, position))
+                elif child.tag == 'NoteGroup':
+                    for note_position, note in enumerate(child):
+                        if note.tag == 'Note':
+                            index.setdefault(self.item_key(name_list.tag, note), (child, note_position))
+            entry = self.indexes[id(name_list)] = (name_list, index)
+        return entry[1]
+
+    def bank_index(self, channel_set):
+        """name -> PatchBank for one channel name set"""
+        entry = self.indexes.get(id(channel_set))
+        if entry is None:
+            index = {}
+            for bank in channel_set.findall('PatchBank'):
+                index.setdefault(bank.get('Name'), bank)
+            entry = self.indexes[id(channel_set)] = (channel_set, index)
+        return entry[1]
+
+    def resolve_list(self, parent, tag, lists):
+        """The inline tag child of parent, or the document-level list it references"""
+        inline = parent.find(tag)
+        if inline is not None:
+            return inline
+        uses = parent.find('Uses' + tag)
+        if uses is not None:
+            return lists.get((tag, uses.get('Name')))
+        return None
+
+    def merge(self, source_root):
+        """Merge one document (left untouched) into the merged tree"""
+        source = self.find_container(source_root)
+        source_lists = {}
+        for child in source:
+            if child.tag in MERGE_LIST_ITEMS:
+                source_lists.setdefault((child.tag, child.get('Name')), child)
+        self.source_lists = source_lists
+        # (tag, old name) -> new name for elements renamed from this source
+        self.renames = {}
+        self.copied = []
+        # (id(base list), id(source list)) pairs already merged: a list a
+        # channel name set uses is reached both from the set and on its own
+        self.merged_lists = set()
+        
+        for child in source:
+            if child.tag == 'ChannelNameSet':
+                self.merge_channel_set(child)
+            elif child.tag in MERGE_LIST_ITEMS:
+                self.merge_named_list(child)
+        
+        if self.renames:
+            for element in self.copied:
+                for ref in element.iter():
+                    target = MERGE_REFERENCES.get(ref.tag)
+                    if target is not None:
+                        new_name = self.renames.get((target[0], ref.get(target[1])))
+                        if new_name is not None:
+                            ref.set(target[1], new_name)
+
+    def add(self, parent, element, position=None):
+        """Insert a copy of a source element and remember it for reference fixes.
+
+        Name lists in the copy whose Name is already used in the merged tree
+        are renamed (and references to them follow), so callers read the
+        final name back from the returned element.
+        """
+        element = copy.deepcopy(element)
+        if position is None:
+            parent.append(element)
+        else:
+            parent.insert(position, element)
+        self.copied.append(element)
+        self.stats['added'] += 1
+        for name_list in element.iter():
+            taken = self.list_names.get(name_list.tag)
+            if taken is None:
+                continue
+            name = name_list.get('Name')
+            if name in taken:
+                new_name = self.unique_name(name, taken)
+                name_list.set('Name', new_name)
+                self.renames.setdefault((name_list.tag, name), new_name)
+                self.stats['renamed'] += 1
+                name = new_name
+            taken.add(name)
+        return element
+
+    def renamed_copy(self, existing, incoming):
+        """For 'rename': the name incoming already has in the merge, if it is a duplicate.
+
+        Catches both an identical base element and a source element merged
+        (and possibly renamed) earlier.
+        """
+        import xml.etree.ElementTree as ET
+        
+        fingerprint = ET.tostring(incoming)
+        if fingerprint in self.fingerprints:
+            return self.fingerprints[fingerprint]
+        if existing is not None and ET.tostring(existing) == fingerprint:
+            return existing.get('Name')
+        return None
+
+    def remember(self, incoming, name):
+        if self.conflict == 'rename':
+            import xml.etree.ElementTree as ET
+            self.fingerprints[ET.tostring(incoming)] = name
+
+    def merge_named_list(self, source_list):
+        """Merge a document-level PatchNameList/NoteNameList/ControlNameList/ValueNameList"""
+        key = (source_list.tag, source_list.get('Name'))
+        existing = self.lists.get(key)
+        if self.conflict == 'rename':
+            duplicate_of = self.renamed_copy(existing, source_list)
+            if duplicate_of is not None:
+                if duplicate_of != key[1]:
+                    self.renames[key] = duplicate_of
+                return
+        
+        if existing is None or self.conflict == 'rename':
+            # A name that is already taken is renamed by add()
+            added = self.add(self.container, source_list)
+            self.lists[(source_list.tag, added.get('Name'))] = added
+            self.remember(source_list, added.get('Name'))
+        else:
+            self.merge_items(existing, source_list)
+
+    def merge_items(self, base_list, source_list):
+        """Merge the items of two name lists of the same kind, item by item"""
+        if (id(base_list), id(source_list)) in self.merged_lists:
+            return
+        self.merged_lists.add((id(base_list), id(source_list)))
+        index = self.item_index(base_list)
+        item_tag = MERGE_LIST_ITEMS[base_list.tag][0]
+        groups = None
+        
+        for child in source_list:
+            if child.tag == item_tag:
+                self.merge_item(base_list, base_list, child, index)
+            elif child.tag == 'NoteGroup':
+                # Notes of a group go to the base group of the same name
+                if groups is None:
+                    groups = {g.get('Name'): g for g in base_list.findall('NoteGroup')}
+                group = groups.get(child.get('Name'))
+                if group is None:
+                    group = copy.deepcopy(child)
+                    for note in list(group):
+                        group.remove(note)
+                    base_list.append(group)
+                    groups[child.get('Name')] = group
+                for note in child.findall('Note'):
+                    self.merge_item(base_list, group, note, index)
+
+    def merge_item(self, base_list, parent, item, index):
+        key = self.item_key(base_list.tag, item)
+        existing = index.get(key)
+        if existing is None:
+            index[key] = (parent, len(parent))
+            self.add(parent, item)
+        elif self.conflict == 'overwrite':
+            existing_parent, position = existing
+            new_item = copy.deepcopy(item)
+            existing_parent[position] = new_item
+            self.copied.append(new_item)
+            self.stats['overwritten'] += 1
+        else:
+            # Items are keyed by number; 'rename' has nothing to rename here
+            self.stats['kept'] += 1
+
+    def merge_channel_set(self, source_set):
+        name = source_set.get('Name')
+        existing = self.channel_sets.get(name)
+        if self.conflict == 'rename':
+            duplicate_of = self.renamed_copy(existing, source_set)
+            if duplicate_of is not None:
+                if duplicate_of != name:
+                    self.renames[('ChannelNameSet', name)] = duplicate_of
+                return
+            if existing is not None:
+                self.renames[('ChannelNameSet', name)] = self.unique_name(name, self.channel_sets)
+                name = self.renames[('ChannelNameSet', name)]
+                self.stats['renamed'] += 1
+                existing = None
+        
+        if existing is None:
+            # ChannelNameSets come before the document-level name lists
+            position = len(self.container)
+            for i, child in enumerate(self.container):
+                if child.tag in MERGE_LIST_ITEMS:
+                    position = i
+                    break
+            added = self.add(self.container, source_set, position)
+            added.set('Name', name)
+            self.channel_sets[name] = added
+            self.remember(source_set, name)
+            return
+        
+        for tag in ('NoteNameList', 'ControlNameList'):
+            self.merge_channel_list(existing, source_set, tag)
+        
+        banks = self.bank_index(existing)
+        for bank in source_set.findall('PatchBank'):
+            self.merge_bank(existing, banks, bank)
+
+    def merge_channel_list(self, base_set, source_set, tag):
+        """Merge the note or control list a channel name set uses"""
+        source_list = self.resolve_list(source_set, tag, self.source_lists)
+        if source_list is None:
+            return
+        base_list = self.resolve_list(base_set, tag, self.lists)
+        if base_list is not None:
+            self.merge_items(base_list, source_list)
+            return
+        if base_set.find('Uses' + tag) is not None:
+            return
+        
+        # The base set has no such list: take the source's inline list or reference
+        incoming = source_set.find(tag)
+        if incoming is None:
+            incoming = source_set.find('Uses' + tag)
+        rank = CHANNEL_SET_ORDER.index(incoming.tag)
+        position = len(base_set)
+        for i, child in enumerate(base_set):
+            if child.tag in CHANNEL_SET_ORDER and CHANNEL_SET_ORDER.index(child.tag) > rank:
+                position = i
+                break
+        self.add(base_set, incoming, position)
+
+    def merge_bank(self, channel_set, banks, bank):
+        name = bank.get('Name')
+        existing = banks.get(name)
+        if existing is not None and self.conflict == 'rename':
+            if self.renamed_copy(existing, bank) is not None:
+                return
+            name = self.unique_name(name, banks)
+            self.stats['renamed'] += 1
+            existing = None
+        
+        if existing is None:
+            added = self.add(channel_set, bank)
+            if name is not None:
+                added.set('Name', name)
+            banks[name] = added
+            return
+        
+        base_patches = self.resolve_list(existing, 'PatchNameList', self.lists)
+        source_patches = self.resolve_list(bank, 'PatchNameList', self.source_lists)
+        if base_patches is not None and source_patches is not None:
+            self.merge_items(base_patches, source_patches)
+        elif self.conflict == 'overwrite':
+            new_bank = copy.deepcopy(bank)
+            channel_set[list(channel_set).index(existing)] = new_bank
+            self.copied.append(new_bank)
+            banks[name] = new_bank
+            self.stats['overwritten'] += 1
+        else:
+            self.stats['kept'] += 1
+
+
+class CachedDocument:
+    """One cached file: its raw bytes plus the parsed tree once requested"""
+
+    def __init__(self, path, size, mtime, content):
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        self.content = content
+        self.root = None
+        self.cost = len(content)
+
+    @property
+    def modified(self):
+        """Modification time in seconds, as os.path.getmtime() reports it"""
+        return self.mtime / 1e9
+
+
+class ParsedDocumentCache:
+    """Process-wide LRU cache of midnam/middev documents shared by all endpoints.
+
+    Entries are keyed by normalized path and validated against the file's
+    (mtime, size) on every lookup, so a file changed behind the server's back
+    is simply re-read. Writers in this server also invalidate explicitly.
+    The byte budget counts the raw document plus an estimate for the parsed
+    tree. Cached trees are shared between requests and must not be mutated;
+    take a copy.deepcopy() first.
+    """
+
+    def __init__(self, max_bytes=DOCUMENT_CACHE_BYTES):
+        from collections import OrderedDict
+        
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        """Return the CachedDocument for path, reading the file if needed"""
+        key = os.path.normpath(path)
+        st = os.stat(key)
+        
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry.mtime == st.st_mtime_ns and entry.size == st.st_size:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self.misses += 1
+        
+        with open(key, 'rb') as f:
+            content = f.read()
+        
+        entry = CachedDocument(key, st.st_size, st.st_mtime_ns, content)
+        with self.lock:
+            self.remove(key)
+            if entry.cost <= self.max_bytes:
+                self.entries[key] = entry
+                self.total_bytes += entry.cost
+                self.evict()
+        return entry
+
+    def get_root(self, path):
+        """Return the parsed root element of path (shared, do not mutate)"""
+        return self.parse(self.get(path))
+
+    def parse(self, entry):
+        """Parse a cached entry once and account for the tree in the budget"""
+        import xml.etree.ElementTree as ET
+        
+        if entry.root is None:
+            root = ET.fromstring(entry.content)
+            extra = sum(1 for _ in root.iter()) * PARSED_ELEMENT_COST
+            with self.lock:
+                if entry.root is None:
+                    entry.root = root
+                    entry.cost += extra
+                    if self.entries.get(entry.path) is entry:
+                        self.total_bytes += extra
+                        self.evict()
+        return entry.root
+
+    def put(self, path, content, root=None):
+        """Cache a document the server just wrote, with its already built tree if any"""
+        key = os.path.normpath(path)
+        st = os.stat(key)
+        entry = CachedDocument(key, st.st_size, st.st_mtime_ns, content)
+        if root is not None:
+            entry.root = root
+            entry.cost += sum(1 for _ in root.iter()) * PARSED_ELEMENT_COST
+        with self.lock:
+            self.remove(key)
+            if entry.cost <= self.max_bytes:
+                self.entries[key] = entry
+                self.total_bytes += entry.cost
+                self.evict()
+        return entry
+
+    def peek(self, path, size, mtime):
+        """Return the cached entry if it matches the given stat, without counting"""
+        with self.lock:
+            entry = self.entries.get(os.path.normpath(path))
+            if entry is not None and entry.size == size and entry.mtime == mtime:
+                return entry
+            return None
+
+    def invalidate(self, path):
+        """Drop path from the cache after the server wrote or deleted it"""
+        with self.lock:
+            self.remove(os.path.normpath(path))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= entry.cost
+
+    def evict(self):
+        while self.total_bytes > self.max_bytes and self.entries:
+            key, entry = self.entries.popitem(last=False)
+            self.total_bytes -= entry.cost
+            self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else None
+            }
+
+
+DOCUMENT_CACHE = ParsedDocumentCache()
+
+
+def compress_body(body, encoding):
+    """Compress a response body with the given content coding"""
+    import gzip
+    
+    if encoding == 'br':
+        return brotli.compress(body, quality=9)
+    # mtime=0 keeps the output identical for identical input
+    return gzip.compress(body, compresslevel=9, mtime=0)
+
+
+class CompressedBodyCache:
+    """LRU cache of compressed response bodies, one per (resource, version, coding).
+
+    The version is the resource's ETag, so a popular file is compressed once
+    per change rather than once per request.
+    """
+
+    def __init__(self, max_bytes=COMPRESSED_CACHE_BYTES):
+        from collections import OrderedDict
+        
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, resource, etag, encoding, load_body):
+        """Compressed body of one resource version; load_body() supplies the raw bytes"""
+        key = (resource, etag, encoding)
+        with self.lock:
+            compressed = self.entries.get(key)
+            if compressed is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return compressed
+            self.misses += 1
+        
+        compressed = compress_body(load_body(), encoding)
+        with self.lock:
+            if key not in self.entries and len(compressed) <= self.max_bytes:
+                self.entries[key] = compressed
+                self.total_bytes += len(compressed)
+                while self.total_bytes > self.max_bytes:
+                    old_key, old_body = self.entries.popitem(last=False)
+                    self.total_bytes -= len(old_body)
+        return compressed
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+
+COMPRESSED_BODIES = CompressedBodyCache()
+
+
+def parse_limit(value, default, maximum):
+    """A ?limit= query value as an int clamped to maximum; None gives default.
+
+    Raises ValueError (answered with 400) unless value is a positive integer.
+    """
+    if value is None:
+        return default
+    limit = int(value)
+    if limit < 1:
+        raise ValueError("limit must be a positive integer")
+    return min(limit, maximum)
+
+
+def search_tokens(text):
+    """Lower-case words of a name or query"""
+    import re
+    return re.findall(r'\w+', text.casefold())
+
+
+def edit_distance(a, b, limit):
+    """Levenshtein distance of a and b, or limit + 1 once it must exceed limit"""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+
+class NameSearchIndex:
+    """Inverted index from words to the bank, patch, note and control names using them.
+
+    Each distinct (kind, name) is stored once with the files using it, so
+    the thousands of files sharing General MIDI names cost one entry. Files
+    are numbered and each entry keeps its files as an array of those numbers,
+    four bytes per use instead of a set slot per path. Words map to the
+    entries; a sorted word list answers prefix queries with bisect and a
+    trigram map narrows the words compared for fuzzy matches. The catalog
+    index feeds it one file at a time as files change.
+    """
+
+    # Score of a query word matching an index word exactly, by prefix, or within the edit limit
+    EXACT, PREFIX, FUZZY = 3, 2, 1
+
+    def __init__(self):
+        self.entries = {}       # (kind, name) -> array of file ids
+        self.words = {}         # word -> set of (kind, name)
+        self.trigrams = {}      # trigram -> set of words
+        self.sorted_words = None
+        self.file_ids = {}      # path -> file id
+        self.file_paths = []    # file id -> path (None once removed)
+        self.free_ids = []
+
+    @staticmethod
+    def word_trigrams(word):
+        padded = f" {word} "
+        return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+    def add_file(self, path, names):
+        from array import array
+        
+        if self.free_ids:
+            file_id = self.free_ids.pop()
+            self.file_paths[file_id] = path
+        else:
+            file_id = len(self.file_paths)
+            self.file_paths.append(path)
+        self.file_ids[path] = file_id
+        
+        for kind, values in (names or {}).items():
+            for name in values:
+                key = (kind, name)
+                file_ids = self.entries.get(key)
+                if file_ids is None:
+                    file_ids = self.entries[key] = array('I')
+                    for word in search_tokens(name):
+                        if word not in self.words:
+                            self.words[word] = set()
+                            self.sorted_words = None
+                            for trigram in self.word_trigrams(word):
+                                self.trigrams.setdefault(trigram, set()).add(word)
+                        self.words[word].add(key)
+                file_ids.append(file_id)
+
+    def remove_file(self, path, names):
+        file_id = self.file_ids.pop(path, None)
+        if file_id is None:
+            return
+        self.file_paths[file_id] = None
+        self.free_ids.append(file_id)
+        
+        for kind, values in (names or {}).items():
+            for name in values:
+                key = (kind, name)
+                file_ids = self.entries.get(key)
+                if file_ids is None or file_id not in file_ids:
+                    continue
+                file_ids.remove(file_id)
+                if file_ids:
+                    continue
+                del self.entries[key]
+                for word in search_tokens(name):
+                    keys = self.words.get(word)
+                    if keys is None:
+                        continue
+                    keys.discard(key)
+                    if not keys:
+                        del self.words[word]
+                        self.sorted_words = None
+                        for trigram in self.word_trigrams(word):
+                            words = self.trigrams.get(trigram)
+                            if words is not None:
+                                words.discard(word)
+                                if not words:
+                                    del self.trigrams[trigram]
+
+    def match_word(self, query_word, prefix, fuzzy):
+        """Index words matching one query word, with the best score of each"""
+        import bisect
+        
+        matches = {}
+        if prefix:
+            if self.sorted_words is None:
+                self.sorted_words = sorted(self.words)
+            start = bisect.bisect_left(self.sorted_words, query_word)
+            for word in self.sorted_words[start:]:
+                if not word.startswith(query_word):
+                    break
+                matches[word] = self.EXACT if word == query_word else self.PREFIX
+        elif query_word in self.words:
+            matches[query_word] = self.EXACT
+        
+        if fuzzy:
+            # One edit for short words, two from six characters on
+            limit = 1 if len(query_word) < 6 else 2
+            trigrams = self.word_trigrams(query_word)
+            shared = {}
+            for trigram in trigrams:
+                for word in self.trigrams.get(trigram, ()):
+                    shared[word] = shared.get(word, 0) + 1
+            # Each edit destroys at most three trigrams
+            needed = len(trigrams) - 3 * limit
+            for word, count in shared.items():
+                if word not in matches and count >= needed and edit_distance(query_word, word, limit) <= limit:
+                    matches[word] = self.FUZZY
+        return matches
+
+    def search(self, query, kinds=None, fuzzy=False, limit=50):
+        """(score, kind, name, paths) of the names containing every query word, best first.
+
+        The last query word also matches as a prefix of longer words, so
+        results appear while the user is still typing.
+        """
+        query_words = search_tokens(query)
+        if not query_words:
+            return [], 0
+        
+        scores = None
+        for position, query_word in enumerate(query_words):
+            matches = self.match_word(query_word, position == len(query_words) - 1, fuzzy)
+            word_scores = {}
+            for word, score in matches.items():
+                for key in self.words[word]:
+                    if word_scores.get(key, 0) < score:
+                        word_scores[key] = score
+            if scores is None:
+                scores = word_scores
+            else:
+                scores = {key: scores[key] + score for key, score in word_scores.items() if key in scores}
+            if not scores:
+                return [], 0
+        
+        query_text = ' '.join(query_words)
+        results = []
+        for key, score in scores.items():
+            kind, name = key
+            if kinds and kind not in kinds:
+                continue
+            if ' '.join(search_tokens(name)) == query_text:
+                score += self.EXACT
+            results.append((score, kind, name, self.entries[key]))
+        results.sort(key=lambda result: (-result[0], -len(result[3]), result[2].casefold(), result[1]))
+        file_paths = self.file_paths
+        return [
+            (score, kind, name, [file_paths[file_id] for file_id in file_ids])
+            for score, kind, name, file_ids in results[:limit]
+        ], len(results)
+
+    def stats(self):
+        return {
+            'files': len(self.file_ids),
+            'names': len(self.entries),
+            'words': len(self.words),
+            'trigrams': len(self.trigrams)
+        }
+
+
+class CatalogSnapshot:
+    """Binary on-disk form of the catalog index, quick to load at startup.
+
+    The snapshot file is a small header followed by one marshal blob with the
+    core of every record (stat, hash, device), so loading it is a single
+    C-level decode, and a second blob with the device catalog, decoded only
+    when the catalog is first used. The bulky analysis and names of each file
+    live in an append-only details file, memory-mapped and decoded only when
+    a record needs them. A save appends the details of new records and
+    rewrites the core; the details file is rewritten once most of it is
+    garbage.
+    """
+
+    MAGIC = b'MNCS'
+    DETAILS_MAGIC = b'MNCD'
+    # magic, CATALOG_INDEX_VERSION, marshal.version, offset of the catalog blob
+    HEADER = '<4sIIQ'
+    # Rewrite the details file when garbage exceeds the live data plus this
+    COMPACT_SLACK = 1024 * 1024
+
+    def __init__(self, path):
+        self.path = path
+        self.details_path = path + '.details'
+        self.details_id = None
+        self.details_end = 0
+        self.details_map = None
+
+    def load(self):
+        """(core, catalog blob) of the saved index, or None when there is no usable snapshot.
+
+        core is {'files': {path: FileRecord}, ...}; pass the catalog blob to
+        decode() once the catalog is needed.
+        """
+        import marshal
+        import struct
+        
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+            magic, version, marshal_version, catalog_offset = struct.unpack_from(self.HEADER, data)
+        except (OSError, struct.error):
+            return None
+        if magic != self.MAGIC or version != CATALOG_INDEX_VERSION or marshal_version != marshal.version:
+            return None
+        
+        view = memoryview(data)
+        try:
+            core = self.decode(view[struct.calcsize(self.HEADER):catalog_offset], records=True)
+        except (ValueError, EOFError, TypeError, KeyError):
+            return None
+        if not self.open_details(core.get('details_id'), core.get('details_end')):
+            return None
+        return core, view[catalog_offset:]
+
+    @staticmethod
+    def decode(blob, records=False):
+        import gc
+        import marshal
+        
+        # Decoding creates a few containers per file; collecting in between only costs time
+        gc.disable()
+        try:
+            data = marshal.loads(blob)
+            if records:
+                data['files'] = {
+                    path: FileRecord(size, mtime, content_hash, device, None, None, details)
+                    for path, (size, mtime, content_hash, device, details) in data['files'].items()
+                }
+            return data
+        finally:
+            gc.enable()
+
+    def open_details(self, details_id, details_end):
+        """Map the details file if it is the one the core refers to"""
+        import mmap
+        
+        self.close()
+        if not isinstance(details_id, bytes) or not isinstance(details_end, int):
+            return False
+        try:
+            with open(self.details_path, 'rb') as f:
+                if f.read(len(self.DETAILS_MAGIC) + len(details_id)) != self.DETAILS_MAGIC + details_id:
+                    return False
+                if os.fstat(f.fileno()).st_size < details_end:
+                    return False
+                self.details_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return False
+        self.details_id = details_id
+        self.details_end = details_end
+        return True
+
+    def read(self, span):
+        """(analysis, names) stored at span"""
+        import marshal
+        
+        offset, length = span
+        if self.details_map is None or offset + length > len(self.details_map):
+            # Appended since the file was mapped
+            self.open_details(self.details_id, self.details_end)
+        return marshal.loads(self.details_map[offset:offset + length])
+
+    def raw(self, span):
+        offset, length = span
+        if self.details_map is None or offset + length > len(self.details_map):
+            self.open_details(self.details_id, self.details_end)
+        return self.details_map[offset:offset + length]
+
+    def save(self, core, files, catalog):
+        """Write files (path -> FileRecord), catalog and the rest of core.
+
+        Records not saved before get their details appended and dropped from memory.
+        """
+        import marshal
+        import struct
+        
+        live = sum(record.details[1] for record in files.values() if record.details is not None)
+        if self.details_id is None or self.details_end - live > live + self.COMPACT_SLACK:
+            self.compact(files)
+        
+        pending = [record for record in files.values() if record.details is None]
+        if pending:
+            with open(self.details_path, 'r+b') as f:
+                # Anything past details_end is left over from a save that did not finish
+                f.seek(self.details_end)
+                for record in pending:
+                    blob = marshal.dumps((record.analysis, record.names))
+                    f.write(blob)
+                    record.details = (self.details_end, len(blob))
+                    self.details_end += len(blob)
+                f.truncate()
+                f.flush()
+                os.fsync(f.fileno())
+            for record in pending:
+                record.analysis = record.names = None
+        
+        core = marshal.dumps(dict(core, details_id=self.details_id, details_end=self.details_end, files={
+            path: record.core() for path, record in files.items()
+        }))
+        catalog_offset = struct.calcsize(self.HEADER) + len(core)
+        with AtomicFile(self.path) as f:
+            f.write(struct.pack(self.HEADER, self.MAGIC, CATALOG_INDEX_VERSION, marshal.version, catalog_offset))
+            f.write(core)
+            marshal.dump(catalog, f)
+
+    def compact(self, files):
+        """Start a new details file holding only what records still use"""
+        import marshal
+        
+        details_id = os.urandom(16)
+        spans = {}
+        offset = len(self.DETAILS_MAGIC) + len(details_id)
+        with AtomicFile(self.details_path) as f:
+            f.write(self.DETAILS_MAGIC + details_id)
+            for path, record in files.items():
+                if record.details is not None:
+                    blob = self.raw(record.details)
+                else:
+                    blob = marshal.dumps((record.analysis, record.names))
+                f.write(blob)
+                spans[path] = (offset, len(blob))
+                offset += len(blob)
+            # The old file is replaced on exit, which some platforms refuse while it is mapped
+            self.close()
+        for path, span in spans.items():
+            record = files[path]
+            record.details = span
+            record.analysis = record.names = None
+        self.details_id = details_id
+        self.details_end = offset
+
+    def close(self):
+        if self.details_map is not None:
+            self.details_map.close()
+            self.details_map = None
+
+    def remove(self):
+        """Delete the snapshot files; True if there was one"""
+        self.close()
+        self.details_id = None
+        existed = False
+        for path in (self.path, self.details_path):
+            try:
+                os.remove(path)
+                existed = True
+            except FileNotFoundError:
+                pass
+        return existed
+
+
+class MidnamCatalogIndex:
+    """Per-file index of .midnam device info, refreshed incrementally.
+
+    Each file is recorded as (path, size, mtime, content hash, device info).
+    A refresh stats the tree and only re-parses files that were added or
+    changed, so the cost of a refresh follows the number of changed files
+    rather than the size of the library. .middev files are tracked the same
+    way for the manufacturer-ID lookup. When a CatalogWatcher keeps the index
+    live, it passes just the paths it saw change to update_paths() and
+    requests never refresh at all.
+    """
+
+    def __init__(self, patchfiles_dir=PATCHFILES_DIR, cache_file=CATALOG_CACHE_FILE, workers=None):
+        self.patchfiles_dir = patchfiles_dir
+        self.cache_file = cache_file
+        self.snapshot = CatalogSnapshot(cache_file)
+        # path -> FileRecord
+        self.files = {}
+        # Shared device dicts, see intern_device()
+        self.devices = {}
+        self.catalog = {}
+        # Catalog blob of a freshly loaded snapshot, decoded on first use of catalog
+        self.stored_catalog = None
+        self.manufacturer_ids = None
+        # .middev path -> {'size', 'mtime', 'hash', 'ids'}; None until first read
+        self.middev_ids = None
+        self.loaded = False
+        # Set while a CatalogWatcher applies changes as they happen
+        self.live = False
+        # Optional CatalogStore kept in step with every change
+        self.store = None
+        # Name search index, built on first search and then kept up to date
+        self.search_index = None
+        self.workers = workers or CATALOG_BUILD_WORKERS
+        self.last_build = None
+        # Serialized catalog and its validators, rebuilt only when the catalog changes
+        self.catalog_body = None
+        self.catalog_etag = None
+        self.catalog_modified = None
+        # /manufacturers response as (catalog_modified it was built for, body, ETag)
+        self.manufacturers_body = None
+        # (catalog_modified, [(manufacturer, model, device_key)]) in catalog order
+        self.catalog_order = None
+        # manufacturer -> {'devices': set of device keys, 'files': count}, kept
+        # up to date by update_catalog(); None until first needed after a rebuild
+        self.manufacturer_groups = None
+        # manufacturer -> (JSON body, ETag) of its devices, dropped when they change
+        self.manufacturer_bodies = {}
+        self.summary_body = None
+        # Serializes refreshes coming from concurrent request threads
+        self.lock = threading.RLock()
+
+    def load(self):
+        """Load the persisted index from the snapshot, if it is usable"""
+        self.loaded = True
+        try:
+            loaded = self.snapshot.load()
+            if loaded is None:
+                return
+            core, self.stored_catalog = loaded
+            self.files = core['files']
+            self.manufacturer_ids = core['manufacturer_ids']
+            self.middev_ids = core['middev_ids']
+            self.catalog_modified = core['timestamp']
+            self.catalog_body = None
+            self.search_index = None
+            self.manufacturer_groups = None
+        except Exception as e:
+            print(f"Ignoring unreadable catalog snapshot: {e}")
+            self.files = {}
+            self.catalog = {}
+
+    def save(self):
+        """Persist the index so a restarted server can reuse it"""
+        import time
+        try:
+            self.snapshot.save({
+                'timestamp': self.catalog_modified or time.time(),
+                'manufacturer_ids': self.manufacturer_ids,
+                'middev_ids': self.middev_ids
+            }, self.files, self.catalog)
+        except Exception as e:
+            print(f"Error writing catalog snapshot: {e}")
+
+    @property
+    def catalog(self):
+        """Device key -> device entry with its files"""
+        if self.stored_catalog is not None:
+            self._catalog = self.snapshot.decode(self.stored_catalog)
+            self.stored_catalog = None
+        return self._catalog
+
+    @catalog.setter
+    def catalog(self, catalog):
+        self._catalog = catalog
+        self.stored_catalog = None
+
+    def details(self, record):
+        """(analysis, names) of record, read from the snapshot once it has been saved there"""
+        if record.details is None:
+            return record.analysis, record.names
+        return self.snapshot.read(record.details)
+
+    def intern_device(self, device_info):
+        """One shared device dict per distinct device instead of one per file.
+
+        file_path is dropped (the index is keyed by path) and the strings are
+        interned, so files of the same device share everything.
+        """
+        import sys
+        
+        if not device_info:
+            return None
+        device = {
+            key: sys.intern(value) if isinstance(value, str) else value
+            for key, value in device_info.items() if key != 'file_path'
+        }
+        fingerprint = tuple((key, tuple(value) if isinstance(value, list) else value)
+                            for key, value in sorted(device.items()))
+        return self.devices.setdefault(fingerprint, device)
+
+    def clear(self):
+        """Forget everything, forcing the next refresh to rebuild"""
+        with self.lock:
+            self.files = {}
+            self.devices = {}
+            self.catalog = {}
+            self.manufacturer_ids = None
+            self.middev_ids = None
+            self.catalog_body = None
+            self.catalog_modified = None
+            self.search_index = None
+            self.manufacturer_groups = None
+            self.loaded = True
+
+    def scan(self):
+        """Stat every .midnam and .middev file under the patchfiles directory"""
+        stats = {}
+        for root, dirs, files in os.walk(self.patchfiles_dir):
+            for file in files:
+                if file.endswith('.midnam') or file.endswith('.middev'):
+                    file_path = os.path.join(root, file)
+                    relative_path = file_path.replace('\\', '/')  # Normalize path separators
+                    try:
+                        st = os.stat(file_path)
+                    except OSError:
+                        continue
+                    stats[relative_path] = (st.st_size, st.st_mtime, st.st_mtime_ns)
+        return stats
+
+    def refresh(self):
+        """Bring the index up to date and return (added, changed, removed)"""
+        with self.lock:
+            if not self.loaded:
+                self.load()
+            return self.apply(self.scan())
+
+    def update_paths(self, paths):
+        """Re-index only these files (added, changed or deleted) and return (added, changed, removed)"""
+        stats = {}
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            stats[path] = (st.st_size, st.st_mtime, st.st_mtime_ns)
+        with self.lock:
+            if not self.loaded:
+                self.load()
+            return self.apply(stats, set(paths))
+
+    def current(self):
+        """Make sure the index is usable: a no-op while a watcher keeps it live"""
+        if not self.live or self.middev_ids is None:
+            self.refresh()
+
+    def apply(self, stats, scope=None):
+        """Fold stats into the index; scope limits it to those paths (None = whole tree)"""
+        import functools
+        import time
+        
+        midnam_stats = {path: st for path, st in stats.items() if path.endswith('.midnam')}
+        middev_stats = {path: st for path, st in stats.items() if path.endswith('.middev')}
+        
+        added, changed, touched = [], [], []
+        candidates = self.files if scope is None else [path for path in scope if path in self.files]
+        removed = [path for path in candidates if path not in midnam_stats]
+        old_records = {path: self.files.pop(path) for path in removed}
+        
+        # Only files whose stat changed need to be read again
+        to_parse = [
+            path for path, (size, mtime, mtime_ns) in midnam_stats.items()
+            if path not in self.files
+            or self.files[path].size != size
+            or self.files[path].mtime != mtime
+        ]
+        
+        start_time = time.time()
+        
+        # Documents the editor just opened or saved are already in memory
+        cached_records = {}
+        for path in to_parse:
+            size, mtime, mtime_ns = midnam_stats[path]
+            entry = DOCUMENT_CACHE.peek(path, size, mtime_ns)
+            if entry is not None and entry.root is not None:
+                cached_records[path] = FileRecord(
+                    entry.size, None, hashlib.sha1(entry.content).hexdigest(),
+                    extract_device_info(entry.root, path),
+                    analysis=analyze_midnam_root(entry.root),
+                    names=collect_midnam_names((elem.tag, elem.get('Name')) for elem in entry.root.iter()),
+                    rows=midnam_table_rows(entry.root) if self.store is not None else None
+                )
+        to_read = [path for path in to_parse if path not in cached_records]
+        
+        # With a CatalogStore the same pass collects its rows, so no file is read twice
+        index_file = functools.partial(index_midnam_file, rows=self.store is not None)
+        new_records = dict(zip(to_read, run_in_pool(index_file, to_read, self.workers)))
+        new_records.update(cached_records)
+        
+        for path in to_parse:
+            new_record = new_records[path]
+            if new_record is None:
+                continue
+            mtime = midnam_stats[path][1]
+            new_record.mtime = mtime
+            new_record.device = self.intern_device(new_record.device)
+            record = self.files.get(path)
+            
+            if record is None:
+                added.append(path)
+            elif record.hash != new_record.hash:
+                changed.append(path)
+                old_records[path] = record
+            else:
+                # Touched but identical: keep the parsed info, adopt the new stat
+                touched.append(path)
+                old_records[path] = copy.copy(record)
+                record.mtime = mtime
+                record.size = new_record.size
+                continue
+            self.files[path] = new_record
+        
+        if self.search_index is not None:
+            for path in changed + removed:
+                self.search_index.remove_file(path, self.details(old_records[path])[1])
+            for path in added + changed:
+                self.search_index.add_file(path, self.files[path].names)
+        
+        ids_changed = self.update_middev(middev_stats, scope)
+        # A catalog still stored in the snapshot is not empty: no need to decode it here
+        if ids_changed or (self.stored_catalog is None and not self.catalog):
+            self.catalog = self.build_catalog()
+            self.manufacturer_groups = None
+        elif old_records or added:
+            self.update_catalog(old_records, added + changed + touched + removed)
+        
+        if added or changed or removed or touched or ids_changed:
+            self.catalog_body = None
+            self.catalog_modified = time.time()
+            elapsed = time.time() - start_time
+            self.last_build = {
+                'parsed_files': len(to_parse),
+                'workers': min(self.workers, len(to_parse)) if len(to_parse) >= PARALLEL_MIN_FILES else 1,
+                'seconds': round(elapsed, 3)
+            }
+            print(f"Catalog index refreshed: {len(added)} added, {len(changed)} changed, "
+                  f"{len(removed)} removed, {len(self.files)} files, {len(self.catalog)} devices "
+                  f"({len(to_parse)} parsed in {elapsed:.2f}s by {self.last_build['workers']} workers)")
+            self.save()
+            if self.store is not None:
+                rows = {path: self.files[path].rows for path in added + changed}
+                self.store.sync(self, added + changed + touched + removed, rows)
+            for path in added + changed:
+                self.files[path].rows = None
+        
+        return added, changed, removed
+
+    def search(self, query, kinds=None, fuzzy=False, limit=50):
+        """Names matching query with the devices using them, see NameSearchIndex.search()"""
+        self.current()
+        with self.lock:
+            if self.search_index is None:
+                self.search_index = NameSearchIndex()
+                for path, record in self.files.items():
+                    self.search_index.add_file(path, self.details(record)[1])
+            results, total = self.search_index.search(query, kinds, fuzzy, limit)
+            
+            matches = []
+            for score, kind, name, paths in results:
+                devices = {}
+                for path in sorted(paths):
+                    if len(devices) == SEARCH_MAX_DEVICES:
+                        break
+                    device = self.files[path].device or {}
+                    device_key = f"{device.get('manufacturer')}|{device.get('model')}" if device else None
+                    entry = devices.setdefault(device_key, {
+                        'device_key': device_key,
+                        'manufacturer': device.get('manufacturer'),
+                        'model': device.get('model'),
+                        'files': []
+                    })
+                    entry['files'].append(path)
+                matches.append({
+                    'kind': kind,
+                    'name': name,
+                    'score': score,
+                    'file_count': len(paths),
+                    'devices': list(devices.values())
+                })
+        return matches, total
+
+    def attach_store(self, store):
+        """Mirror the index into a CatalogStore, bringing its tables up to date first.
+
+        Files the store has no rows for are read without holding the index
+        lock; the lock is only taken to write the rows.
+        """
+        import functools
+        
+        self.refresh()
+        with self.lock:
+            stale = store.stale_paths(self)
+            to_read = [path for path in stale if path in self.files and self.files[path].device]
+        index_file = functools.partial(index_midnam_file, rows=True)
+        records = dict(zip(to_read, run_in_pool(index_file, to_read, self.workers)))
+        with self.lock:
+            # A file that changed meanwhile stays stale until its next change
+            rows = {
+                path: record.rows for path, record in records.items()
+                if record is not None and path in self.files and self.files[path].hash == record.hash
+            }
+            store.sync(self, stale, rows)
+            self.store = store
+
+    def update_middev(self, middev_stats, scope=None):
+        """Re-read added or changed .middev files; True when the manufacturer IDs changed"""
+        if self.middev_ids is None:
+            self.middev_ids = {}
+            scope = None
+        candidates = self.middev_ids if scope is None else [path for path in scope if path in self.middev_ids]
+        removed = [path for path in candidates if path not in middev_stats]
+        for path in removed:
+            del self.middev_ids[path]
+        
+        to_read = sorted(
+            path for path, (size, mtime, mtime_ns) in middev_stats.items()
+            if path not in self.middev_ids
+            or self.middev_ids[path]['size'] != size
+            or self.middev_ids[path]['mtime'] != mtime
+        )
+        for path, record in zip(to_read, run_in_pool(index_middev_file, to_read, self.workers)):
+            if record is None:
+                self.middev_ids.pop(path, None)
+                continue
+            size, mtime, mtime_ns = middev_stats[path]
+            record['size'] = size
+            record['mtime'] = mtime
+            self.middev_ids[path] = record
+        
+        # Later files (in path order) win when two define the same manufacturer
+        manufacturer_ids = {}
+        for path in sorted(self.middev_ids):
+            manufacturer_ids.update(self.middev_ids[path]['ids'])
+        if manufacturer_ids == self.manufacturer_ids:
+            return False
+        self.manufacturer_ids = manufacturer_ids
+        return True
+
+    def catalog_response(self):
+        """Return (JSON body, ETag, modification time) of the current catalog"""
+        import time
+        
+        with self.lock:
+            if self.catalog_body is None:
+                self.catalog_body = json.dumps(self.catalog).encode()
+                self.catalog_etag = '"' + hashlib.sha1(self.catalog_body).hexdigest() + '"'
+                if self.catalog_modified is None:
+                    self.catalog_modified = time.time()
+            return self.catalog_body, self.catalog_etag, self.catalog_modified
+
+    def manufacturers_response(self):
+        """Return (JSON body, ETag, modification time) of the manufacturer list.
+
+        Every manufacturer that has a SysEx ID in a .middev file or a device
+        in the catalog, with its ID (or null) and device and file counts.
+        Rebuilt only when the catalog changed.
+        """
+        with self.lock:
+            cached = self.manufacturers_body
+            if cached is None or cached[0] != self.catalog_modified:
+                groups = self.grouped_manufacturers()
+                ids = self.manufacturer_ids or {}
+                manufacturers = [
+                    {
+                        'name': name,
+                        'id': ids.get(name),
+                        'deviceCount': len(groups[name]['devices']) if name in groups else 0,
+                        'fileCount': groups[name]['files'] if name in groups else 0
+                    }
+                    for name in sorted(set(ids) | set(groups), key=str.lower)
+                ]
+                body = json.dumps(manufacturers).encode()
+                etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+                cached = self.manufacturers_body = (self.catalog_modified, body, etag)
+            return cached[1], cached[2], self.catalog_modified
+
+    def grouped_manufacturers(self):
+        """The catalog's devices and file counts per manufacturer (call with the lock held)"""
+        if self.manufacturer_groups is None:
+            groups = {}
+            for device_key, device in self.catalog.items():
+                group = groups.setdefault(device['manufacturer'], {'devices': set(), 'files': 0})
+                group['devices'].add(device_key)
+                group['files'] += len(device['files'])
+            self.manufacturer_groups = groups
+            self.manufacturer_bodies = {}
+        return self.manufacturer_groups
+
+    def summary_response(self):
+        """Return (JSON body, ETag, modification time) of the catalog's manufacturers.
+
+        Only manufacturers with catalogued devices, with their device and
+        file counts: a few KB however large the library is.
+        """
+        with self.lock:
+            cached = self.summary_body
+            if cached is None or cached[0] != self.catalog_modified:
+                groups = self.grouped_manufacturers()
+                body = json.dumps([
+                    {'name': name, 'deviceCount': len(group['devices']), 'fileCount': group['files']}
+                    for name, group in sorted(groups.items(), key=lambda item: item[0].lower())
+                ]).encode()
+                cached = self.summary_body = (self.catalog_modified, body, '"' + hashlib.sha1(body).hexdigest() + '"')
+            return cached[1], cached[2], self.catalog_modified
+
+    def manufacturer_response(self, manufacturer):
+        """Return (JSON body, ETag, modification time) of one manufacturer's devices, or None.
+
+        The body maps device keys to catalog entries like /midnam_catalog.
+        It is cached until one of the manufacturer's files changes.
+        """
+        with self.lock:
+            groups = self.grouped_manufacturers()
+            if manufacturer not in groups:
+                # Names typed by hand rarely match the catalog's case
+                matches = [name for name in groups if name.lower() == manufacturer.lower()]
+                if not matches:
+                    return None
+                manufacturer = matches[0]
+            cached = self.manufacturer_bodies.get(manufacturer)
+            if cached is None:
+                body = json.dumps({
+                    device_key: self.catalog[device_key]
+                    for device_key in sorted(groups[manufacturer]['devices'], key=str.lower)
+                }).encode()
+                cached = self.manufacturer_bodies[manufacturer] = (body, '"' + hashlib.sha1(body).hexdigest() + '"')
+            return cached[0], cached[1], self.catalog_modified
+
+    def regroup(self, device_info, device_key, files):
+        """Adjust the manufacturer groups for one file added (files=1) or removed (-1)"""
+        groups = self.manufacturer_groups
+        if groups is None:
+            return
+        manufacturer = device_info['manufacturer']
+        self.manufacturer_bodies.pop(manufacturer, None)
+        group = groups.setdefault(manufacturer, {'devices': set(), 'files': 0})
+        group['files'] += files
+        if device_key in self.catalog:
+            group['devices'].add(device_key)
+        else:
+            group['devices'].discard(device_key)
+        if not group['devices']:
+            del groups[manufacturer]
+
+    @staticmethod
+    def order_key(device_key):
+        manufacturer, _, model = device_key.partition('|')
+        return (manufacturer.lower(), model.lower(), device_key)
+
+    def ordered_keys(self, manufacturer=None):
+        """Device keys sorted by manufacturer and model, optionally of one manufacturer only"""
+        import bisect
+        
+        cached = self.catalog_order
+        if cached is None or cached[0] != self.catalog_modified:
+            cached = self.catalog_order = (self.catalog_modified, sorted(map(self.order_key, self.catalog)))
+        order = cached[1]
+        if manufacturer is None:
+            return order
+        manufacturer = manufacturer.lower()
+        # One manufacturer's devices are contiguous
+        start = bisect.bisect_left(order, (manufacturer,))
+        end = start
+        while end < len(order) and order[end][0] == manufacturer:
+            end += 1
+        return order[start:end]
+
+    def catalog_page(self, manufacturer=None, cursor=None, limit=None):
+        """One page of the catalog in manufacturer/model order.
+
+        cursor is the last device key of the previous page; it stays valid
+        when devices are added or removed in between. Returns the devices,
+        the cursor for the next page (None on the last one) and the total
+        number of devices matching the filter, as (JSON body, ETag,
+        modification time).
+        """
+        import bisect
+        
+        with self.lock:
+            order = self.ordered_keys(manufacturer)
+            start = bisect.bisect_right(order, self.order_key(cursor)) if cursor else 0
+            end = len(order) if limit is None else min(start + limit, len(order))
+            devices = {key: self.catalog[key] for _, _, key in order[start:end]}
+            body = json.dumps({
+                'devices': devices,
+                'next_cursor': order[end - 1][2] if end < len(order) else None,
+                'total': len(order)
+            }).encode()
+            modified = self.catalog_modified
+        return body, '"' + hashlib.sha1(body).hexdigest() + '"', modified
+
+    def iter_catalog_stream(self, manufacturer=None):
+        """The catalog as NDJSON records: the manufacturer counts first, then one device per record.
+
+        The manufacturer line is computed and sent before any device is
+        serialized, so a client can render its manufacturer list right away.
+        Devices are copied under the lock and serialized outside it.
+        """
+        with self.lock:
+            devices = [
+                (key, dict(self.catalog[key], files=list(self.catalog[key]['files'])))
+                for _, _, key in self.ordered_keys(manufacturer)
+            ]
+        
+        counts = {}
+        for key, device in devices:
+            entry = counts.setdefault(device['manufacturer'], {
+                'name': device['manufacturer'], 'deviceCount': 0, 'fileCount': 0
+            })
+            entry['deviceCount'] += 1
+            entry['fileCount'] += len(device['files'])
+        yield {'manufacturers': list(counts.values())}
+        
+        files = 0
+        for key, device in devices:
+            files += len(device['files'])
+            yield {'key': key, 'device': device}
+        yield {'summary': {'devices': len(devices), 'files': files, 'manufacturers': len(counts)}}
+
+    def get_record(self, path):
+        """Size, mtime and analysis of path as a dict, if the index describes the file as it is now"""
+        with self.lock:
+            if not self.loaded:
+                self.load()
+            record = self.files.get(os.path.normpath(path).replace('\\', '/'))
+            if record is None:
+                return None
+            size, mtime = record.size, record.mtime
+            analysis = self.details(record)[0]
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if size != st.st_size or mtime != st.st_mtime:
+            return None
+        return {'size': size, 'mtime': mtime, 'analysis': analysis}
+
+    def build_catalog(self):
+        """Group indexed files into the device catalog served to the editor"""
+        catalog = {}
+        
+        for path in sorted(self.files):
+            record = self.files[path]
+            device_info = record.device
+            if not device_info:
+                continue
+            
+            # Create device key from manufacturer + model
+            device_key = f"{device_info['manufacturer']}|{device_info['model']}"
+            
+            if device_key not in catalog:
+                catalog[device_key] = self.catalog_device(device_info)
+            
+            catalog[device_key]['files'].append(self.catalog_file(path, record))
+        
+        return catalog
+
+    def catalog_device(self, device_info):
+        return {
+            'manufacturer': device_info['manufacturer'],
+            'model': device_info['model'],
+            'manufacturer_id': (self.manufacturer_ids or {}).get(device_info['manufacturer']),
+            'family_id': device_info.get('family_id'),
+            'device_id': device_info.get('device_id'),
+            'type': device_info.get('type'),
+            'files': []
+        }
+
+    def catalog_file(self, path, record):
+        return {
+            'path': path,
+            'size': record.size,
+            'modified': record.mtime
+        }
+
+    def update_catalog(self, old_records, paths):
+        """Patch the catalog for just these paths instead of regrouping every file"""
+        import bisect
+        
+        for path in paths:
+            old_record = old_records.get(path)
+            old_info = old_record.device if old_record else None
+            if old_info:
+                device_key = f"{old_info['manufacturer']}|{old_info['model']}"
+                device = self.catalog.get(device_key)
+                if device is not None:
+                    device['files'] = [f for f in device['files'] if f['path'] != path]
+                    if not device['files']:
+                        del self.catalog[device_key]
+                    self.regroup(old_info, device_key, -1)
+            
+            record = self.files.get(path)
+            device_info = record.device if record else None
+            if device_info:
+                device_key = f"{device_info['manufacturer']}|{device_info['model']}"
+                device = self.catalog.get(device_key)
+                if device is None:
+                    device = self.catalog[device_key] = self.catalog_device(device_info)
+                # Keep each device's files in path order, as build_catalog() does
+                position = bisect.bisect([f['path'] for f in device['files']], path)
+                device['files'].insert(position, self.catalog_file(path, record))
+                self.regroup(device_info, device_key, 1)
+
+
+CATALOG_INDEX = MidnamCatalogIndex()
+
+
+class CatalogStore:
+    """SQLite mirror of the catalog index with device, file, bank, patch and note tables.
+
+    The index calls sync() with the paths it just re-indexed and their rows,
+    collected by the same pass that indexed them, so the store never parses
+    a file itself; the devices table is rewritten from the in-memory
+    catalog, which is small. query_devices() and query_patches()
+    serve the /catalog/ endpoints, so the editor can fetch one slice instead
+    of the whole catalog.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS devices (
+            device_key TEXT PRIMARY KEY, manufacturer TEXT, model TEXT,
+            manufacturer_id TEXT, family_id TEXT, device_id TEXT, type TEXT);
+        CREATE TABLE IF NOT EXISTS files (
+            path TEXT PRIMARY KEY, device_key TEXT, size INTEGER, mtime REAL, hash TEXT);
+        CREATE TABLE IF NOT EXISTS banks (
+            path TEXT, position INTEGER, name TEXT, patch_count INTEGER);
+        CREATE TABLE IF NOT EXISTS patches (
+            path TEXT, bank TEXT, number TEXT, name TEXT, program_change INTEGER);
+        CREATE TABLE IF NOT EXISTS notes (
+            path TEXT, note_list TEXT, number INTEGER, name TEXT);
+        CREATE INDEX IF NOT EXISTS devices_manufacturer ON devices (manufacturer COLLATE NOCASE);
+        CREATE INDEX IF NOT EXISTS devices_model ON devices (model COLLATE NOCASE);
+        CREATE INDEX IF NOT EXISTS files_device ON files (device_key);
+        CREATE INDEX IF NOT EXISTS banks_path ON banks (path);
+        CREATE INDEX IF NOT EXISTS patches_path ON patches (path);
+        CREATE INDEX IF NOT EXISTS patches_name ON patches (name COLLATE NOCASE);
+        CREATE INDEX IF NOT EXISTS notes_path ON notes (path);
+    """
+    DEVICE_FILTERS = ('manufacturer', 'model', 'family_id', 'device_id', 'manufacturer_id', 'type')
+
+    def __init__(self, db_path):
+        import sqlite3
+        
+        self.db_path = db_path
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(self.SCHEMA)
+        # One connection shared by the indexer and request threads
+        self.lock = threading.Lock()
+
+    def stale_paths(self, index):
+        """Paths whose rows do not match the index (after a restart, or a new database)"""
+        with self.lock:
+            stored = dict(self.db.execute('SELECT path, hash FROM files'))
+        paths = {path for path, record in index.files.items() if stored.get(path) != record.hash}
+        paths.update(path for path in stored if path not in index.files)
+        return sorted(paths)
+
+    def sync(self, index, paths, rows):
+        """Rewrite the rows of paths, then the devices table.
+
+        rows maps paths to the table rows of their current content, as
+        collected by the indexer (None for a document that did not parse).
+        Called with the index lock held, so nothing is parsed here.
+        """
+        with self.lock, self.db:
+            stored = dict(self.db.execute('SELECT path, hash FROM files'))
+            for path in paths:
+                record = index.files.get(path)
+                device = record.device if record else None
+                if device and stored.get(path) == record.hash:
+                    # Same content (touched file): only the stat changed
+                    self.db.execute('UPDATE files SET size = ?, mtime = ? WHERE path = ?',
+                                    (record.size, record.mtime, path))
+                    continue
+                if device and path not in rows:
+                    continue
+                for table in ('files', 'banks', 'patches', 'notes'):
+                    self.db.execute(f'DELETE FROM {table} WHERE path = ?', (path,))
+                if not device:
+                    continue
+                self.db.execute('INSERT INTO files VALUES (?, ?, ?, ?, ?)', (
+                    path, f"{device['manufacturer']}|{device['model']}",
+                    record.size, record.mtime, record.hash))
+                file_rows = rows[path] or {'banks': [], 'patches': [], 'notes': []}
+                self.db.executemany('INSERT INTO banks VALUES (?, ?, ?, ?)',
+                                    [(path,) + row for row in file_rows['banks']])
+                self.db.executemany('INSERT INTO patches VALUES (?, ?, ?, ?, ?)',
+                                    [(path,) + row for row in file_rows['patches']])
+                self.db.executemany('INSERT INTO notes VALUES (?, ?, ?, ?)',
+                                    [(path,) + row for row in file_rows['notes']])
+            
+            self.db.execute('DELETE FROM devices')
+            self.db.executemany('INSERT INTO devices VALUES (?, ?, ?, ?, ?, ?, ?)', [
+                (key, d['manufacturer'], d['model'], d['manufacturer_id'], d['family_id'], d['device_id'], d['type'])
+                for key, d in index.catalog.items()
+            ])
+
+    def query_devices(self, filters, limit=None):
+        """Catalog entries (with their files) matching every given filter, case-insensitive"""
+        where = []
+        params = []
+        for name in self.DEVICE_FILTERS:
+            if filters.get(name):
+                where.append(f'{name} = ? COLLATE NOCASE')
+                params.append(filters[name])
+        sql = 'SELECT * FROM devices'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY manufacturer COLLATE NOCASE, model COLLATE NOCASE'
+        if limit:
+            sql += ' LIMIT ?'
+            params.append(int(limit))
+        
+        with self.lock:
+            devices = {}
+            for row in self.db.execute(sql, params):
+                device = dict(row)
+                device['files'] = []
+                devices[device.pop('device_key')] = device
+            if devices:
+                placeholders = ', '.join('?' * len(devices))
+                for row in self.db.execute(
+                        f'SELECT path, device_key, size, mtime FROM files WHERE device_key IN ({placeholders}) '
+                        'ORDER BY path', list(devices)):
+                    devices[row['device_key']]['files'].append(
+                        {'path': row['path'], 'size': row['size'], 'modified': row['mtime']})
+        return devices
+
+    def query_patches(self, filters, limit=100):
+        """Patches whose name contains filters['name'], optionally within a manufacturer/model"""
+        where = []
+        params = []
+        if filters.get('name'):
+            where.append("p.name LIKE ? ESCAPE '\\'")
+            escaped = filters['name'].replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+            params.append(f'%{escaped}%')
+        for name in ('manufacturer', 'model', 'family_id', 'device_id'):
+            if filters.get(name):
+                where.append(f'd.{name} = ? COLLATE NOCASE')
+                params.append(filters[name])
+        if filters.get('bank'):
+            where.append('p.bank = ?')
+            params.append(filters['bank'])
+        sql = ('SELECT d.manufacturer, d.model, p.path, p.bank, p.number, p.name, p.program_change '
+               'FROM patches p JOIN files f ON f.path = p.path JOIN devices d ON d.device_key = f.device_key')
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY d.manufacturer, d.model, p.path, p.rowid LIMIT ?'
+        params.append(int(limit))
+        with self.lock:
+            return [dict(row) for row in self.db.execute(sql, params)]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class Inotify:
+    """Minimal Linux inotify binding (ctypes, no extra packages)"""
+
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ISDIR = 0x40000000
+    WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+        
+        if not sys.platform.startswith('linux'):
+            raise OSError("inotify is only available on Linux")
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.buffer = b''
+
+    def add_watch(self, path):
+        import ctypes
+        
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.WATCH_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {path}")
+        return wd
+
+    def read(self, timeout):
+        """Events as (wd, mask, name), waiting up to timeout seconds for the first"""
+        import select
+        import struct
+        
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            self.buffer += os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset + 16 <= len(self.buffer):
+            wd, mask, cookie, length = struct.unpack_from('iIII', self.buffer, offset)
+            if offset + 16 + length > len(self.buffer):
+                break
+            name = self.buffer[offset + 16:offset + 16 + length].rstrip(b'\0')
+            events.append((wd, mask, os.fsdecode(name)))
+            offset += 16 + length
+        self.buffer = self.buffer[offset:]
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class CatalogWatcher:
+    """Background thread that keeps a MidnamCatalogIndex live.
+
+    On Linux the patchfiles tree is watched with inotify and the paths named
+    by each burst of events are passed to update_paths(), so new, changed and
+    deleted files reach the catalog and manufacturer IDs well within a
+    second. Elsewhere (or when inotify fails) the tree is rescanned every
+    interval seconds. Either way requests read the index without refreshing.
+    """
+
+    def __init__(self, index, interval=WATCH_POLL_INTERVAL, debounce=WATCH_DEBOUNCE):
+        self.index = index
+        self.interval = interval
+        self.debounce = debounce
+        self.stopped = threading.Event()
+        self.thread = None
+        self.mode = None
+        self.inotify = None
+        self.watches = {}
+
+    def start(self):
+        """Build the index once, then follow changes in the background"""
+        self.index.refresh()
+        try:
+            self.inotify = Inotify()
+            self.watch_tree(self.index.patchfiles_dir)
+            self.mode = 'inotify'
+            target = self.run_inotify
+        except (OSError, AttributeError) as e:
+            print(f"inotify unavailable ({e}); polling {self.index.patchfiles_dir} every {self.interval}s")
+            if self.inotify is not None:
+                self.inotify.close()
+                self.inotify = None
+            self.mode = 'poll'
+            target = self.run_poll
+        self.index.live = True
+        self.thread = threading.Thread(target=target, name='midnam-watcher', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join(timeout=2)
+        self.index.live = False
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+
+    def run_poll(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.index.refresh()
+            except Exception as e:
+                print(f"Catalog watcher error: {e}")
+
+    def watch_tree(self, directory):
+        """Watch directory and its subdirectories; returns the indexable files inside"""
+        files = []
+        for root, dirs, names in os.walk(directory):
+            root = root.replace('\\', '/')
+            try:
+                self.watches[self.inotify.add_watch(root)] = root
+            except OSError as e:
+                if root == directory:
+                    raise
+                print(f"Not watching {root}: {e}")
+            files.extend(f"{root}/{name}" for name in names)
+        return files
+
+    def run_inotify(self):
+        while not self.stopped.is_set():
+            try:
+                events = self.inotify.read(0.5)
+                if not events:
+                    continue
+                # Let a burst of events (an atomic save, a copied folder) settle
+                while True:
+                    more = self.inotify.read(self.debounce)
+                    if not more:
+                        break
+                    events.extend(more)
+                self.handle(events)
+            except Exception as e:
+                if self.stopped.is_set():
+                    break
+                print(f"Catalog watcher error: {e}")
+
+    def handle(self, events):
+        paths = set()
+        for wd, mask, name in events:
+            if mask & Inotify.IN_Q_OVERFLOW:
+                # Events were lost; fall back to a full scan
+                self.index.refresh()
+                return
+            if mask & Inotify.IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            directory = self.watches.get(wd)
+            if directory is None or not name:
+                continue
+            path = f"{directory}/{name}"
+            if mask & Inotify.IN_ISDIR:
+                if mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO):
+                    paths.update(self.watch_tree(path))
+                elif mask & (Inotify.IN_DELETE | Inotify.IN_MOVED_FROM):
+                    # Everything that was indexed under the directory is gone
+                    prefix = path + '/'
+                    with self.index.lock:
+                        known = list(self.index.files) + list(self.index.middev_ids or {})
+                    paths.update(p for p in known if p.startswith(prefix))
+            else:
+                paths.add(path)
+        
+        paths = [p for p in paths if p.endswith('.midnam') or p.endswith('.middev')]
+        if paths:
+            self.index.update_paths(paths)
+
+
+CATALOG_WATCHER = CatalogWatcher(CATALOG_INDEX)
+
+
+class MIDINameServer(http.server.HTTPServer):
+    """HTTP server that handles requests on a bounded pool of worker threads.
+
+    A slow catalog rebuild or merge only occupies one worker, so static
+    assets and patchfile fetches from other editor tabs keep being served.
+    Connections only hold a worker while a request is being handled: new
+    and idle keep-alive connections wait in a selector (see run_idle) and
+    are closed after the handler's timeout, so a browser's open sockets
+    cannot starve the pool. That needs a KeepAliveRequestHandler; other
+    handlers keep their connection's worker until it closes.
+    On close the server stops accepting, closes idle connections, waits up
+    to shutdown_grace seconds for in-flight requests and then disconnects
+    the rest.
+    """
+
+    allow_reuse_address = True
+    request_queue_size = 64
+
+    def __init__(self, server_address, handler_class, max_workers=DEFAULT_MAX_WORKERS,
+                 shutdown_grace=SHUTDOWN_GRACE):
+        import selectors
+        from concurrent.futures import ThreadPoolExecutor
+        
+        # Set up before binding: a failed bind calls server_close()
+        self.max_workers = max_workers
+        self.shutdown_grace = shutdown_grace
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='midnam-http')
+        self.connections = set()
+        self.connections_changed = threading.Condition()
+        self.closing = False
+        # Connections waiting for their next request: socket -> (address, handler, deadline)
+        self.idle = {}
+        self.selector = selectors.DefaultSelector()
+        self.wakeup, self.wakeup_signal = socket.socketpair()
+        self.wakeup_signal.setblocking(False)
+        self.selector.register(self.wakeup, selectors.EVENT_READ)
+        self.idle_thread = threading.Thread(target=self.run_idle, name='midnam-http-idle', daemon=True)
+        self.idle_thread.start()
+        super().__init__(server_address, handler_class)
+
+    def process_request(self, request, client_address):
+        with self.connections_changed:
+            self.connections.add(request)
+        self.wait_for_request(request, client_address, None)
+
+    def finish_request(self, request, client_address):
+        return self.RequestHandlerClass(request, client_address, self)
+
+    def process_request_thread(self, request, client_address, handler=None):
+        try:
+            if handler is None:
+                handler = self.finish_request(request, client_address)
+            else:
+                handler.next_request()
+            # A pipelined request already in the read buffer is served right away
+            while getattr(handler, 'keep_alive', False) and handler.has_buffered_request():
+                handler.next_request()
+            if getattr(handler, 'keep_alive', False):
+                self.wait_for_request(request, client_address, handler)
+                return
+        except Exception:
+            self.handle_error(request, client_address)
+        self.close_connection(request, handler)
+
+    def wait_for_request(self, request, client_address, handler):
+        """Park a connection until it is readable, without holding a worker"""
+        import selectors
+        import time
+        
+        timeout = getattr(self.RequestHandlerClass, 'timeout', None) or KEEPALIVE_TIMEOUT
+        with self.connections_changed:
+            if not self.closing:
+                self.idle[request] = (client_address, handler, time.monotonic() + timeout)
+                self.selector.register(request, selectors.EVENT_READ)
+                self.wake()
+                return
+        self.close_connection(request, handler)
+
+    def wake(self):
+        """Interrupt run_idle's select() so it sees new or closed connections"""
+        try:
+            self.wakeup_signal.send(b'\0')
+        except OSError:
+            pass  # already pending
+
+    def run_idle(self):
+        """Hand readable idle connections to the pool; close expired ones"""
+        import time
+        
+        while True:
+            events = self.selector.select(timeout=1)
+            now = time.monotonic()
+            ready, expired = [], []
+            with self.connections_changed:
+                closing = self.closing
+                readable = set()
+                for key, _ in events:
+                    if key.fileobj is self.wakeup:
+                        try:
+                            self.wakeup.recv(4096)
+                        except OSError:
+                            pass
+                    else:
+                        readable.add(key.fileobj)
+                for request, (client_address, handler, deadline) in list(self.idle.items()):
+                    if closing or (request not in readable and deadline <= now):
+                        expired.append((request, handler))
+                    elif request in readable:
+                        ready.append((request, client_address, handler))
+                    else:
+                        continue
+                    self.selector.unregister(request)
+                    del self.idle[request]
+            for request, client_address, handler in ready:
+                self.pool.submit(self.process_request_thread, request, client_address, handler)
+            for request, handler in expired:
+                self.close_connection(request, handler)
+            if closing:
+                return
+
+    def close_connection(self, request, handler=None):
+        if handler is not None and getattr(handler, 'keep_alive', False):
+            handler.keep_alive = False
+            try:
+                handler.finish()
+            except OSError:
+                pass
+        self.shutdown_request(request)
+        with self.connections_changed:
+            self.connections.discard(request)
+            self.connections_changed.notify_all()
+
+    def server_close(self):
+        super().server_close()
+        with self.connections_changed:
+            self.closing = True
+            self.wake()
+        self.idle_thread.join()
+        with self.connections_changed:
+            self.connections_changed.wait_for(lambda: not self.connections, timeout=self.shutdown_grace)
+            for request in list(self.connections):
+                # Wakes handlers still blocked reading a request
+                try:
+                    request.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+        self.pool.shutdown(wait=True, cancel_futures=True)
+        self.selector.close()
+        self.wakeup.close()
+        self.wakeup_signal.close()
+
+
+class KeepAliveRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """Request handler whose keep-alive connections MIDINameServer can park.
+
+    Under MIDINameServer handle() serves a single request. If the connection
+    stays open, finish() leaves the socket and its read buffer as they are
+    and the server calls next_request() once the next request arrives.
+    Under any other server handle() loops over the connection as usual.
+    """
+
+    # HTTP/1.1 keeps browser connections open between requests; every
+    # response therefore carries a Content-Length (see send_body)
+    protocol_version = 'HTTP/1.1'
+    # Idle keep-alive connections are closed after this many seconds
+    timeout = KEEPALIVE_TIMEOUT
+    keep_alive = False
+
+    def handle(self):
+        if not isinstance(self.server, MIDINameServer):
+            super().handle()
+            return
+        self.close_connection = True
+        self.handle_one_request()
+        self.keep_alive = not self.close_connection
+
+    def finish(self):
+        if not self.keep_alive:
+            super().finish()
+
+    def next_request(self):
+        """Serve the next request on a parked connection"""
+        try:
+            self.handle()
+        finally:
+            self.finish()
+
+    def has_buffered_request(self):
+        """Whether the next request has already been read from the socket"""
+        self.connection.settimeout(0)
+        try:
+            return bool(self.rfile.peek(1))
+        except OSError:
+            return False
+        finally:
+            self.connection.settimeout(self.timeout)
+
+
+class MIDINameHandler(KeepAliveRequestHandler):
     def end_headers(self):
         # Add CORS headers
         self.send_header('Access-Control-Allow-Origin', '*')
@@ -23,7 +3818,239 @@ class MIDINameHandler(http.server.SimpleHTTPRequestHandler):
     def do_OPTIONS(self):
         # Handle preflight requests
         self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+    
+    def send_body(self, body, content_type, status=200, headers=None):
+        """Send a complete response with an explicit Content-Length"""
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def send_cacheable(self, body, content_type, etag, modified=None, resource=None):
+        """Send body with ETag/Last-Modified, or 304 when the client's copy is current.
+
+        When resource is given the body may be sent gzip or brotli encoded,
+        cached per (resource, etag) so each version is compressed only once.
+        """
+        encoding = None
+        if resource is not None and len(body) >= COMPRESS_MIN_BYTES:
+            encoding = self.negotiate_encoding()
+        
+        headers = self.validator_headers(etag, modified, encoding, vary=resource is not None)
+        if self.is_not_modified(headers['ETag'], modified):
+            self.send_not_modified(headers)
+            return
+        
+        if encoding is not None:
+            body = COMPRESSED_BODIES.get(resource, etag, encoding, lambda: body)
+            headers['Content-Encoding'] = encoding
+        
+        self.send_body(body, content_type, headers=headers)
+    
+    def send_file(self, file_path, content_type):
+        """Send a file as bytes straight from disk.
+
+        Identity responses go out with socket.sendfile(), so the kernel copies
+        from the page cache; single byte ranges are honoured. Clients that
+        accept gzip/brotli get the cached compressed body instead.
+        """
+        with open(file_path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            size = st.st_size
+            etag = f'"{size:x}-{st.st_mtime_ns:x}"'
+            modified = st.st_mtime
+            
+            # A range request asks for bytes of the identity representation
+            wants_range = self.headers.get('Range') is not None
+            encoding = None
+            if not wants_range and size >= COMPRESS_MIN_BYTES:
+                encoding = self.negotiate_encoding()
+            
+            headers = self.validator_headers(etag, modified, encoding, vary=True)
+            headers['Accept-Ranges'] = 'bytes'
+            if self.is_not_modified(headers['ETag'], modified):
+                self.send_not_modified(headers)
+                return
+            
+            if encoding is not None:
+                resource = os.path.normpath(file_path)
+                body = COMPRESSED_BODIES.get(resource, etag, encoding, f.read)
+                headers['Content-Encoding'] = encoding
+                self.send_body(body, content_type, headers=headers)
+                return
+            
+            status = 200
+            start, end = 0, size - 1
+            byte_range = self.requested_range(size, etag, modified) if wants_range else None
+            if byte_range == 'unsatisfiable':
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{size}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            if byte_range is not None:
+                status = 206
+                start, end = byte_range
+                headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+            
+            count = end - start + 1
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(count))
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            
+            if count > 0:
+                sent = self.connection.sendfile(f, start, count)
+                if sent < count:
+                    # File shrank underneath us; the client cannot trust this connection
+                    self.close_connection = True
+    
+    def requested_range(self, size, etag, modified):
+        """Parse a single-range Range header into (start, end).
+
+        Returns None to send the whole file (no usable range, several ranges
+        or a failed If-Range) and 'unsatisfiable' for ranges past the end.
+        """
+        from email.utils import parsedate_to_datetime
+        
+        header = self.headers.get('Range', '').strip()
+        if not header.startswith('bytes='):
+            return None
+        
+        if_range = self.headers.get('If-Range')
+        if if_range:
+            if_range = if_range.strip()
+            if if_range.startswith('"') or if_range.startswith('W/'):
+                if if_range != etag:
+                    return None
+            else:
+                try:
+                    if int(modified) > parsedate_to_datetime(if_range).timestamp():
+                        return None
+                except (TypeError, ValueError):
+                    return None
+        
+        spec = header[len('bytes='):].strip()
+        if ',' in spec:
+            return None
+        first, dash, last = spec.partition('-')
+        try:
+            if not first:
+                suffix = int(last)
+                if suffix <= 0 or size == 0:
+                    return 'unsatisfiable'
+                return max(0, size - suffix), size - 1
+            start = int(first)
+            end = int(last) if last else size - 1
+        except ValueError:
+            return None
+        if start >= size:
+            return 'unsatisfiable'
+        if end < start:
+            return None
+        return start, min(end, size - 1)
+    
+    def validator_headers(self, etag, modified, encoding=None, vary=False):
+        """ETag, Last-Modified and caching headers of one representation"""
+        from email.utils import formatdate
+        
+        # Each coding is its own representation and needs its own validator
+        representation_etag = etag if encoding is None else f'{etag[:-1]}-{encoding}"'
+        
+        # no-cache: browsers may keep the body but must revalidate it on each use
+        headers = {'ETag': representation_etag, 'Cache-Control': 'no-cache'}
+        if vary:
+            headers['Vary'] = 'Accept-Encoding'
+        if modified is not None:
+            headers['Last-Modified'] = formatdate(modified, usegmt=True)
+        return headers
+    
+    def send_not_modified(self, headers):
+        self.send_response(304)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+    
+    def negotiate_encoding(self):
+        """Pick br or gzip from Accept-Encoding, or None for identity"""
+        accepted = {}
+        for item in self.headers.get('Accept-Encoding', '').split(','):
+            coding, _, params = item.strip().partition(';')
+            coding = coding.strip().lower()
+            if not coding:
+                continue
+            quality = 1.0
+            params = params.strip()
+            if params.startswith('q='):
+                try:
+                    quality = float(params[2:])
+                except ValueError:
+                    quality = 0.0
+            accepted[coding] = quality
+        
+        candidates = ['br', 'gzip'] if BROTLI_AVAILABLE else ['gzip']
+        best = None
+        for coding in candidates:
+            quality = accepted.get(coding, accepted.get('*', 0.0))
+            if quality > 0 and (best is None or quality > best[1]):
+                best = (coding, quality)
+        return best[0] if best else None
+    
+    def is_not_modified(self, etag, modified):
+        """Evaluate If-None-Match, falling back to If-Modified-Since"""
+        from email.utils import parsedate_to_datetime
+        
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            # Weak comparison, as RFC 9110 prescribes for If-None-Match
+            tags = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+            return '*' in tags or etag in tags
+        
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since and modified is not None:
+            try:
+                since = parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+            # HTTP dates have one-second resolution
+            return int(modified) <= since
+        return False
+    
+    def send_json(self, data, status=200):
+        """Send data as a JSON response"""
+        self.send_body(json.dumps(data).encode(), 'application/json', status)
+    
+    def send_ndjson(self, records):
+        """Stream records as newline-delimited JSON while they are produced.
+
+        HTTP/1.1 clients get a chunked response and keep their connection;
+        HTTP/1.0 has no chunking, so the end of the body is the connection close.
+        """
+        chunked = self.protocol_version == 'HTTP/1.1' and self.request_version == 'HTTP/1.1'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Cache-Control', 'no-store')
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            self.send_header('Connection', 'close')
+            self.close_connection = True
         self.end_headers()
+        
+        for record in records:
+            line = (json.dumps(record) + '\n').encode()
+            if chunked:
+                line = b'%x\r\n%s\r\n' % (len(line), line)
+            self.wfile.write(line)
+        if chunked:
+            self.wfile.write(b'0\r\n\r\n')
     
     def do_GET(self):
         if self.path == '/load_d4.php':
@@ -32,10 +4059,22 @@ class MIDINameHandler(http.server.SimpleHTTPRequestHandler):
             self.serve_patchfile()
         elif self.path == '/manufacturers':
             self.serve_manufacturers()
-        elif self.path == '/midnam_catalog':
+        elif self.path.split('?')[0] == '/midnam_catalog':
             self.serve_midnam_catalog()
         elif self.path.startswith('/analyze_file/'):
             self.analyze_midnam_file()
+        elif self.path == '/cache_stats':
+            self.serve_cache_stats()
+        elif self.path.split('?')[0] == '/validate_all':
+            self.validate_all()
+        elif self.path.startswith('/search?') or self.path == '/search':
+            self.serve_search()
+        elif self.path.startswith('/catalog/'):
+            self.serve_catalog_query()
+        elif self.path.startswith('/revisions/'):
+            self.serve_revisions()
+        elif self.path.startswith('/revision_diff/'):
+            self.serve_revision_diff()
         else:
             super().do_GET()
     
@@ -52,18 +4091,18 @@ class MIDINameHandler(http.server.SimpleHTTPRequestHandler):
             self.merge_midnam_files()
         elif self.path == '/delete_file':
             self.delete_midnam_file()
+        elif self.path == '/analyze_files':
+            self.analyze_midnam_files()
+        elif self.path == '/restore_revision':
+            self.restore_revision()
+        elif self.path == '/patch_file':
+            self.patch_file()
         else:
             self.send_error(404)
     
     def serve_xml(self):
         try:
-            with open('Alesis/D4.midnam', 'r') as f:
-                xml_content = f.read()
-            
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/xml')
-            self.end_headers()
-            self.wfile.write(xml_content.encode())
+            self.send_file('Alesis/D4.midnam', 'application/xml')
         except Exception as e:
             self.send_error(500, f"Error reading XML: {str(e)}")
     
@@ -76,20 +4115,16 @@ class MIDINameHandler(http.server.SimpleHTTPRequestHandler):
             from urllib.parse import unquote
             xml_data = unquote(post_data.split('xml=')[1])
             
-            # Create backup
-            import shutil
-            from datetime import datetime
-            backup_name = f'Alesis/D4.midnam.backup.{datetime.now().strftime("%Y-%m-%d-%H-%M-%S")}'
-            shutil.copy('Alesis/D4.midnam', backup_name)
-            
-            # Save new content
-            with open('Alesis/D4.midnam', 'w') as f:
-                f.write(xml_data)
+            # Back up the current file and replace it atomically
+            saved = FILE_SAVER.save('Alesis/D4.midnam', xml_data.encode('utf-8'))
+            DOCUMENT_CACHE.invalidate('Alesis/D4.midnam')
             
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
-            self.wfile.write(b'{"success": true, "backup": "' + backup_name.encode() + b'"}')
+            self.send_json({
+                'success': True,
+                'backup': saved['backup'],
+                'revision': saved['revision'],
+                'unchanged': saved['unchanged']
+            })
             
         except Exception as e:
             self.send_error(500, f"Error saving XML: {str(e)}")
@@ -109,28 +4144,79 @@ class MIDINameHandler(http.server.SimpleHTTPRequestHandler):
                 self.send_error(400, "Missing file_path or xml_content")
                 return
             
-            # Create backup
-            import shutil
-            from datetime import datetime
-            backup_name = f'{file_path}.backup.{datetime.now().strftime("%Y-%m-%d-%H-%M-%S")}'
-            shutil.copy(file_path, backup_name)
-            
-            # Save new content
-            with open(file_path, 'w', encoding='utf-8') as f:
-                f.write(xml_content)
+            # Back up the current file and replace it atomically
+            saved = FILE_SAVER.save(file_path, xml_content.encode('utf-8'))
+            DOCUMENT_CACHE.invalidate(file_path)
             
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps({
+            self.send_json({
                 'success': True, 
-                'backup': backup_name,
+                'backup': saved['backup'],
+                'revision': saved['revision'],
+                'unchanged': saved['unchanged'],
                 'file_path': file_path
-            }).encode())
+            })
             
         except Exception as e:
             self.send_error(500, f"Error saving file: {str(e)}")
     
+    def patch_file(self):
+        """Apply targeted operations to a document instead of resending all of it.
+
+        Body: {"file_path", "operations": [...], "base": optional sha1 of the
+        content the client edited}. The operations (see
+        apply_patch_operations) run on an EditableDocument of the current
+        content and are saved together or not at all; a stale base gives 409.
+        Comments, the prolog and namespace prefixes are kept, and a patch that
+        changes nothing leaves the bytes exactly as they were.
+        """
+        try:
+            content_length = int(self.headers['Content-Length'])
+            data = json.loads(self.rfile.read(content_length).decode('utf-8'))
+            file_path = data.get('file_path', '')
+            operations = data.get('operations')
+            
+            if not file_path or not isinstance(operations, list):
+                self.send_error(400, "Missing file_path or operations")
+                return
+            if not os.path.exists(file_path):
+                self.send_error(404, f"File not found: {file_path}")
+                return
+            
+            with PATCH_LOCK:
+                entry = DOCUMENT_CACHE.get(file_path)
+                current = hashlib.sha1(entry.content).hexdigest()
+                base = data.get('base')
+                if base and base != current:
+                    self.send_json({'success': False, 'error': 'File changed since base', 'revision': current}, 409)
+                    return
+                
+                # Parsed apart from the shared cached tree, which has no
+                # comments, so the saved file keeps them and its prefixes
+                document = EditableDocument(entry.content)
+                before = document.serialize()
+                try:
+                    apply_patch_operations(document.root, operations)
+                except PatchError as e:
+                    self.send_json({'success': False, 'error': str(e)}, 400)
+                    return
+                
+                content = document.serialize()
+                if content == before:
+                    content = entry.content
+                saved = FILE_SAVER.save(file_path, content)
+                DOCUMENT_CACHE.put(file_path, content)
+            
+            self.send_json({
+                'success': True,
+                'file_path': file_path,
+                'applied': len(operations),
+                'revision': hashlib.sha1(content).hexdigest(),
+                'unchanged': saved['unchanged']
+            })
+            
+        except Exception as e:
+            self.send_error(500, f"Error patching file: {str(e)}")
+    
     def validate_xml(self):
         try:
             content_length = int(self.headers['Content-Length'])
@@ -139,43 +4225,27 @@ class MIDINameHandler(http.server.SimpleHTTPRequestHandler):
             from urllib.parse import unquote
             xml_data = unquote(post_data.split('xml=')[1])
             
-            # Simple XML validation
-            import xml.etree.ElementTree as ET
-            try:
-                root = ET.fromstring(xml_data)
-                errors = []
-                
-                # Check for duplicate note numbers within each drumset
-                for note_list in root.findall('.//NoteNameList'):
-                    numbers = []
-                    for note in note_list.findall('Note'):
-                        num = note.get('Number')
-                        name = note.get('Name')
-                        
-                        if not num or not name:
-                            errors.append(f"Missing number or name in {note_list.get('Name')}")
-                        
-                        if num in numbers:
-                            errors.append(f"Duplicate note number {num} in {note_list.get('Name')}")
-                        numbers.append(num)
-                
-                if errors:
-                    result = {"valid": False, "errors": errors}
-                else:
-                    result = {"valid": True, "errors": []}
-                    
-            except ET.ParseError as e:
-                result = {"valid": False, "errors": [f"XML Parse Error: {str(e)}"]}
+            errors = validate_midnam(xml_data)
+            result = {"valid": not errors, "errors": errors}
             
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
-            import json
-            self.wfile.write(json.dumps(result).encode())
+            self.send_json(result)
             
         except Exception as e:
             self.send_error(500, f"Error validating XML: {str(e)}")
     
+    def validate_all(self):
+        """Validate the whole patchfiles tree, streaming one NDJSON line per file.
+
+        Add ?force=1 to revalidate files that passed last time.
+        """
+        query = parse_qs(urlparse(self.path).query)
+        force = query.get('force', ['0'])[0] not in ('0', 'false', '')
+        try:
+            self.send_ndjson(BULK_VALIDATOR.run(force=force))
+        except (BrokenPipeError, ConnectionResetError):
+            # Client went away mid-stream; nothing left to send it
+            self.close_connection = True
+    
     def serve_patchfile(self):
         """Serve patchfiles from the patchfiles directory"""
         try:
@@ -194,273 +4264,59 @@ class MIDINameHandler(http.server.SimpleHTTPRequestHandler):
             else:
                 content_type = 'text/plain'
             
-            with open(file_path, 'r') as f:
-                content = f.read()
-            
-            self.send_response(200)
-            self.send_header('Content-Type', content_type)
-            self.end_headers()
-            self.wfile.write(content.encode())
+            self.send_file(file_path, content_type)
             
         except Exception as e:
             self.send_error(500, f"Error serving file: {str(e)}")
     
     def serve_manufacturers(self):
-        """Serve manufacturer data"""
-        try:
-            # For now, return a static list of manufacturers
-            # In a real implementation, this would fetch from the npm package
-            manufacturers = [
-                {"name": "Alesis Studio Electronics", "id": "00 00 0E"},
-                {"name": "Yamaha Corporation", "id": "43"},
-                {"name": "Roland Corporation", "id": "41"},
-                {"name": "Korg Inc", "id": "42"},
-                {"name": "Kawai Musical Instruments", "id": "40"},
-                {"name": "Casio Computer Co Ltd", "id": "44"},
-                {"name": "Akai Electric Co Ltd", "id": "47"},
-                {"name": "Sony Corporation", "id": "4C"},
-                {"name": "Behringer GmbH", "id": "00 20 32"},
-                {"name": "Arturia", "id": "00 20 6B"},
-                {"name": "Novation", "id": "00 20 29"},
-                {"name": "M-Audio", "id": "00 20 0D"}
-            ]
-            
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps(manufacturers).encode())
-            
-        except Exception as e:
-            self.send_error(500, f"Error serving manufacturers: {str(e)}")
-
-    def build_manufacturer_id_lookup(self):
-        """Build a lookup table of manufacturer names to IDs from .middev files"""
-        manufacturer_ids = {}
-        
+        """Serve every known manufacturer with its SysEx ID and device/file counts"""
         try:
-            import xml.etree.ElementTree as ET
-            
-            # Find all .middev files
-            for root, dirs, files in os.walk('patchfiles'):
-                for file in files:
-                    if file.endswith('.middev'):
-                        file_path = os.path.join(root, file)
-                        try:
-                            with open(file_path, 'r', encoding='utf-8') as f:
-                                content = f.read()
-                            
-                            # Parse XML
-                            root_elem = ET.fromstring(content)
-                            
-                            # Find all MIDIDeviceType elements
-                            for device_type in root_elem.findall('.//MIDIDeviceType'):
-                                manufacturer_name = device_type.get('Manufacturer')
-                                inquiry_response = device_type.find('InquiryResponse')
-                                
-                                if manufacturer_name and inquiry_response is not None:
-                                    manufacturer_id = inquiry_response.get('Manufacturer')
-                                    if manufacturer_id:
-                                        # Convert hex to three-byte format (e.g., "06" -> "00 00 06")
-                                        try:
-                                            hex_val = int(manufacturer_id, 16)
-                                            three_byte_id = f"00 00 {manufacturer_id.zfill(2).upper()}"
-                                            manufacturer_ids[manufacturer_name] = three_byte_id
-                                            print(f"Found manufacturer ID: {manufacturer_name} = {three_byte_id}")
-                                        except ValueError:
-                                            print(f"Invalid hex manufacturer ID: {manufacturer_id}")
-                            
-                        except Exception as e:
-                            print(f"Error parsing {file_path}: {e}")
-                            continue
-            
-            print(f"Built manufacturer ID lookup with {len(manufacturer_ids)} entries")
-            return manufacturer_ids
+            CATALOG_INDEX.current()
+            body, etag, modified = CATALOG_INDEX.manufacturers_response()
+            self.send_cacheable(body, 'application/json', etag, modified, resource='/manufacturers')
             
         except Exception as e:
-            print(f"Error building manufacturer ID lookup: {e}")
-            return {}
+            self.send_error(500, f"Error serving manufacturers: {str(e)}")
 
     def serve_midnam_catalog(self):
-        """Build and serve a catalog of all .midnam files with device information"""
-        try:
-            import xml.etree.ElementTree as ET
-            import time
-            
-            # Check if we have a cached catalog
-            cache_file = 'midnam_catalog_cache.json'
-            catalog = None
-            cache_valid = False
-            
-            if os.path.exists(cache_file):
-                try:
-                    with open(cache_file, 'r') as f:
-                        cache_data = json.load(f)
-                        # Check if cache is less than 1 hour old
-                        if time.time() - cache_data.get('timestamp', 0) < 3600:
-                            catalog = cache_data.get('catalog', {})
-                            cache_valid = True
-                except:
-                    pass
-            
-            if not cache_valid:
-                # Build catalog by scanning all .midnam files
-                catalog = {}
-                
-                # First, build a manufacturer ID lookup from .middev files
-                manufacturer_ids = self.build_manufacturer_id_lookup()
-                
-                # Find all .midnam files
-                print("Scanning for .midnam files...")
-                file_count = 0
-                for root, dirs, files in os.walk('patchfiles'):
-                    for file in files:
-                        if file.endswith('.midnam'):
-                            file_count += 1
-                            file_path = os.path.join(root, file)
-                            relative_path = file_path.replace('\\', '/')  # Normalize path separators
-                            print(f"Processing {relative_path}")
-                            
-                            try:
-                                with open(file_path, 'r', encoding='utf-8') as f:
-                                    content = f.read()
-                                
-                                # Parse XML
-                                root_elem = ET.fromstring(content)
-                                
-                                # Extract device information
-                                device_info = self.extract_device_info(root_elem, relative_path)
-                                if device_info:
-                                    # Look up manufacturer ID from .middev files
-                                    manufacturer_id = manufacturer_ids.get(device_info['manufacturer'])
-                                    if manufacturer_id:
-                                        device_info['manufacturer_id'] = manufacturer_id
-                                    
-                                    print(f"  Extracted: {device_info['manufacturer']} {device_info['model']} (ID: {manufacturer_id or 'unknown'})")
-                                    # Create device key from manufacturer + model
-                                    device_key = f"{device_info['manufacturer']}|{device_info['model']}"
-                                    
-                                    if device_key not in catalog:
-                                        catalog[device_key] = {
-                                            'manufacturer': device_info['manufacturer'],
-                                            'model': device_info['model'],
-                                            'manufacturer_id': device_info.get('manufacturer_id'),
-                                            'family_id': device_info.get('family_id'),
-                                            'device_id': device_info.get('device_id'),
-                                            'type': device_info.get('type'),
-                                            'files': []
-                                        }
-                                    
-                                    catalog[device_key]['files'].append({
-                                        'path': relative_path,
-                                        'size': len(content),
-                                        'modified': os.path.getmtime(file_path)
-                                    })
-                                else:
-                                    print(f"  No device info extracted")
-                                    
-                            except Exception as e:
-                                print(f"Error parsing {file_path}: {e}")
-                                continue
-                
-                print(f"Scanned {file_count} .midnam files, found {len(catalog)} devices")
-                
-                # Cache the catalog
-                try:
-                    with open(cache_file, 'w') as f:
-                        json.dump({
-                            'timestamp': time.time(),
-                            'catalog': catalog
-                        }, f, indent=2)
-                except:
-                    pass
-            
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps(catalog).encode())
-            
-        except Exception as e:
-            self.send_error(500, f"Error building midnam catalog: {str(e)}")
+        """Serve the catalog of all .midnam files with device information.
 
-    def extract_device_info(self, root_elem, file_path):
-        """Extract device information from MIDINameDocument"""
+        Without parameters this is the whole catalog as one cached object.
+        ?manufacturer= limits it to one manufacturer, ?limit= and ?cursor=
+        page through it, and ?stream=1 (or Accept: application/x-ndjson)
+        streams it as NDJSON, manufacturer list first.
+        """
         try:
-            # The root element should be MIDINameDocument
-            if root_elem.tag != 'MIDINameDocument':
-                return None
-            
-            midnam_doc = root_elem
-            
-            # Try to find MasterDeviceNames first
-            master_device = midnam_doc.find('.//MasterDeviceNames')
-            if master_device is not None:
-                # Extract manufacturer and model
-                manufacturer_elem = master_device.find('Manufacturer')
-                model_elem = master_device.find('Model')
-                
-                if manufacturer_elem is None or model_elem is None:
-                    return None
-                
-                manufacturer = manufacturer_elem.text or ''
-                model = model_elem.text or ''
-                
-                # Try to extract family and device IDs from DeviceID elements
-                family_id = None
-                device_id = None
-                
-                device_id_elem = master_device.find('DeviceID')
-                if device_id_elem is not None:
-                    family_id = device_id_elem.get('Family')
-                    device_id = device_id_elem.get('Member')
-                
-                return {
-                    'manufacturer': manufacturer.strip(),
-                    'model': model.strip(),
-                    'family_id': family_id,
-                    'device_id': device_id,
-                    'file_path': file_path,
-                    'type': 'master'
-                }
+            params = parse_qs(urlparse(self.path).query)
+            manufacturer = params.get('manufacturer', [None])[0]
+            cursor = params.get('cursor', [None])[0]
+            limit = params.get('limit', [None])[0]
+            stream = (params.get('stream', ['0'])[0] not in ('0', 'false', '')
+                      or 'application/x-ndjson' in self.headers.get('Accept', ''))
             
-            # Try to find ExtendingDeviceNames
-            extending_device = midnam_doc.find('.//ExtendingDeviceNames')
-            if extending_device is not None:
-                # Extract manufacturer
-                manufacturer_elem = extending_device.find('Manufacturer')
-                if manufacturer_elem is None:
-                    return None
-                
-                manufacturer = manufacturer_elem.text or ''
-                
-                # Get all models
-                model_elems = extending_device.findall('Model')
-                if not model_elems:
-                    return None
-                
-                # Use the first model as the primary model
-                model = model_elems[0].text or ''
-                
-                return {
-                    'manufacturer': manufacturer.strip(),
-                    'model': model.strip(),
-                    'family_id': None,
-                    'device_id': None,
-                    'file_path': file_path,
-                    'type': 'extending',
-                    'all_models': [m.text.strip() for m in model_elems if m.text]
-                }
+            # The watcher keeps the index live; without it, stat the tree and
+            # re-parse only files that were added or changed
+            CATALOG_INDEX.current()
             
-            return None
+            if stream:
+                self.send_ndjson(CATALOG_INDEX.iter_catalog_stream(manufacturer))
+            elif manufacturer is not None or cursor is not None or limit is not None:
+                limit = parse_limit(limit, None, CATALOG_PAGE_MAX)
+                body, etag, modified = CATALOG_INDEX.catalog_page(manufacturer, cursor, limit)
+                self.send_cacheable(body, 'application/json', etag, modified, resource=self.path)
+            else:
+                body, etag, modified = CATALOG_INDEX.catalog_response()
+                self.send_cacheable(body, 'application/json', etag, modified, resource='/midnam_catalog')
             
+        except ValueError as e:
+            self.send_error(400, f"Bad catalog query: {str(e)}")
         except Exception as e:
-            print(f"Error extracting device info from {file_path}: {e}")
-            return None
+            self.send_error(500, f"Error building midnam catalog: {str(e)}")
 
     def analyze_midnam_file(self):
         """Analyze a .midnam file and return bank/patch counts"""
         try:
-            import xml.etree.ElementTree as ET
-            
             # Extract file path from URL
             file_path = self.path.replace('/analyze_file/', '')
             if not file_path.endswith('.midnam'):
@@ -471,87 +4327,111 @@ class MIDINameHandler(http.server.SimpleHTTPRequestHandler):
                 self.send_error(404, f"File not found: {file_path}")
                 return
             
-            # Read and parse the file
-            with open(file_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-            
-            root = ET.fromstring(content)
-            
-            # Find MIDINameDocument
-            midnam_doc = root.find('.//MIDINameDocument')
-            if midnam_doc is None:
-                midnam_doc = root
-            
-            # Count banks and patches
-            banks = midnam_doc.findall('.//PatchBank')
-            patches = midnam_doc.findall('.//Patch')
-            note_lists = midnam_doc.findall('.//NoteNameList')
-            
-            # Get file info
-            file_size = os.path.getsize(file_path)
-            file_modified = os.path.getmtime(file_path)
-            
-            # Extract device info
-            manufacturer = "Unknown"
-            model = "Unknown"
-            author = "Unknown"
-            
-            master_device = midnam_doc.find('.//MasterDeviceNames')
-            if master_device is not None:
-                manufacturer_elem = master_device.find('Manufacturer')
-                model_elem = master_device.find('Model')
-                if manufacturer_elem is not None:
-                    manufacturer = manufacturer_elem.text or "Unknown"
-                if model_elem is not None:
-                    model = model_elem.text or "Unknown"
-            
-            # Extract Author information - try multiple approaches
-            author = "Unknown"
-            author_elem = midnam_doc.find('Author')
-            if author_elem is not None and author_elem.text:
-                author = author_elem.text.strip()
-            else:
-                # Try alternative approach - look for Author anywhere in the document
-                author_elem = root.find('.//Author')
-                if author_elem is not None and author_elem.text:
-                    author = author_elem.text.strip()
-            
-            # Count patches per bank
-            bank_patch_counts = []
-            for bank in banks:
-                bank_name = bank.get('Name', 'Unnamed Bank')
-                bank_patches = bank.findall('.//Patch')
-                bank_patch_counts.append({
-                    'name': bank_name,
-                    'patch_count': len(bank_patches)
-                })
+            self.send_json(self.build_analysis(file_path))
             
-            analysis = {
-                'file_path': file_path,
-                'file_size': file_size,
-                'file_modified': file_modified,
-                'manufacturer': manufacturer,
-                'model': model,
-                'author': author,
-                'total_banks': len(banks),
-                'total_patches': len(patches),
-                'total_note_lists': len(note_lists),
-                'bank_details': bank_patch_counts
-            }
+        except Exception as e:
+            self.send_error(500, f"Error analyzing file: {str(e)}")
+
+    def analyze_midnam_files(self):
+        """Analyze several .midnam files in one request.
+
+        Accepts {"paths": [...]}, {"device_key": "Manufacturer|Model"} (or a
+        list of keys) or {"manufacturer": "..."} and returns every analysis
+        in one response. Files the catalog index has not summarized yet are
+        parsed concurrently in worker processes.
+        """
+        try:
+            content_length = int(self.headers['Content-Length'])
+            data = json.loads(self.rfile.read(content_length).decode('utf-8'))
             
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps(analysis).encode())
+            paths = list(data.get('paths') or [])
+            device_keys = data.get('device_key') or data.get('device_keys') or []
+            if isinstance(device_keys, str):
+                device_keys = [device_keys]
+            manufacturer = data.get('manufacturer')
+            
+            if device_keys or manufacturer:
+                CATALOG_INDEX.current()
+                catalog = CATALOG_INDEX.catalog
+                for device_key in device_keys:
+                    if device_key not in catalog:
+                        self.send_error(404, f"Unknown device: {device_key}")
+                        return
+                    paths.extend(f['path'] for f in catalog[device_key]['files'])
+                if manufacturer:
+                    for device in catalog.values():
+                        if device['manufacturer'] == manufacturer:
+                            paths.extend(f['path'] for f in device['files'])
+            
+            if not paths:
+                self.send_error(400, "Missing paths, device_key or manufacturer")
+                return
+            
+            # Keep the request order, drop duplicates
+            paths = list(dict.fromkeys(paths))
+            analyses, errors = self.build_analyses(paths)
+            
+            self.send_json({'analyses': analyses, 'errors': errors})
             
         except Exception as e:
-            self.send_error(500, f"Error analyzing file: {str(e)}")
+            self.send_error(500, f"Error analyzing files: {str(e)}")
+
+    def build_analyses(self, paths):
+        """Analyses of many files: indexed ones directly, the rest parsed in parallel"""
+        analyses = {}
+        errors = {}
+        pending = []
+        
+        for file_path in paths:
+            if not os.path.exists(file_path):
+                errors[file_path] = "File not found"
+                continue
+            record = CATALOG_INDEX.get_record(file_path)
+            if record is not None and record.get('analysis') is not None:
+                analyses[file_path] = self.analysis_payload(file_path, record)
+            else:
+                pending.append(file_path)
+        
+        records = run_in_pool(summarize_midnam_file, pending, CATALOG_INDEX.workers,
+                              min_items=ANALYZE_PARALLEL_MIN_FILES)
+        for file_path, record in zip(pending, records):
+            if record is None:
+                errors[file_path] = "File not found"
+            elif record.get('analysis') is None:
+                errors[file_path] = "XML parse error"
+            else:
+                analyses[file_path] = self.analysis_payload(file_path, record)
+        
+        # Answer in the order the paths were asked for
+        analyses = {path: analyses[path] for path in paths if path in analyses}
+        return analyses, errors
+
+    def analysis_payload(self, file_path, record):
+        """Analysis response for a file from its index record"""
+        analysis = {
+            'file_path': file_path,
+            'file_size': record['size'],
+            'file_modified': record['mtime']
+        }
+        analysis.update(record['analysis'])
+        return analysis
+
+    def build_analysis(self, file_path):
+        """Analysis payload of one file, from the catalog index when it is current"""
+        record = CATALOG_INDEX.get_record(file_path)
+        if record is None or record.get('analysis') is None:
+            # Not indexed yet (or changed since): parse it, reusing a cached tree
+            document = DOCUMENT_CACHE.get(file_path)
+            record = {
+                'size': document.size,
+                'mtime': document.modified,
+                'analysis': analyze_midnam_root(DOCUMENT_CACHE.parse(document))
+            }
+        return self.analysis_payload(file_path, record)
 
     def merge_midnam_files(self):
         """Merge multiple .midnam files into one"""
         try:
-            import xml.etree.ElementTree as ET
-            
             # Get POST data
             content_length = int(self.headers['Content-Length'])
             post_data = self.rfile.read(content_length)
@@ -564,56 +4444,25 @@ class MIDINameHandler(http.server.SimpleHTTPRequestHandler):
                 self.send_error(400, "Missing source_files or output_file")
                 return
             
-            # Read first file as base
-            with open(source_files[0], 'r', encoding='utf-8') as f:
-                base_content = f.read()
-            
-            base_root = ET.fromstring(base_content)
-            base_midnam = base_root.find('.//MIDINameDocument')
-            if base_midnam is None:
-                base_midnam = base_root
+            conflict = data.get('conflict', 'keep')
+            if conflict not in MERGE_CONFLICT_MODES:
+                self.send_error(400, f"conflict must be one of {', '.join(MERGE_CONFLICT_MODES)}")
+                return
             
-            # Merge additional files
+            # Cached trees are shared; the merger works on its own copy of the base
+            merger = MidnamMerger(DOCUMENT_CACHE.get_root(source_files[0]), conflict)
             for source_file in source_files[1:]:
-                with open(source_file, 'r', encoding='utf-8') as f:
-                    source_content = f.read()
-                
-                source_root = ET.fromstring(source_content)
-                source_midnam = source_root.find('.//MIDINameDocument')
-                if source_midnam is None:
-                    source_midnam = source_root
-                
-                # Find ChannelNameSet in base
-                base_channel_set = base_midnam.find('.//ChannelNameSet')
-                source_channel_set = source_midnam.find('.//ChannelNameSet')
-                
-                if base_channel_set is not None and source_channel_set is not None:
-                    # Merge PatchBanks
-                    for bank in source_channel_set.findall('.//PatchBank'):
-                        # Check if bank already exists
-                        bank_name = bank.get('Name')
-                        existing_bank = base_channel_set.find(f'.//PatchBank[@Name="{bank_name}"]')
-                        
-                        if existing_bank is None:
-                            # Add new bank
-                            base_channel_set.append(bank)
-                        else:
-                            # Merge patches from existing bank
-                            for patch in bank.findall('.//Patch'):
-                                patch_num = patch.get('Number')
-                                existing_patch = existing_bank.find(f'.//Patch[@Number="{patch_num}"]')
-                                if existing_patch is None:
-                                    existing_bank.append(patch)
-            
-            # Write merged file
-            merged_xml = ET.tostring(base_root, encoding='unicode')
-            with open(output_file, 'w', encoding='utf-8') as f:
-                f.write(merged_xml)
-            
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps({'success': True, 'message': f'Merged {len(source_files)} files into {output_file}'}).encode())
+                merger.merge(DOCUMENT_CACHE.get_root(source_file))
+            
+            # Stream the merged tree to disk under the base file's DOCTYPE
+            write_xml_document(merger.root, output_file, read_doctype(source_files[0]) or MIDNAM_DOCTYPE)
+            DOCUMENT_CACHE.invalidate(output_file)
+            
+            self.send_json({
+                'success': True,
+                'message': f'Merged {len(source_files)} files into {output_file}',
+                'stats': merger.stats
+            })
             
         except Exception as e:
             self.send_error(500, f"Error merging files: {str(e)}")
@@ -639,41 +4488,257 @@ class MIDINameHandler(http.server.SimpleHTTPRequestHandler):
             
             # Delete the file
             os.remove(file_path)
+            DOCUMENT_CACHE.invalidate(file_path)
             
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps({'success': True, 'message': f'Deleted {file_path}'}).encode())
+            self.send_json({'success': True, 'message': f'Deleted {file_path}'})
             
         except Exception as e:
             self.send_error(500, f"Error deleting file: {str(e)}")
 
+    def serve_search(self):
+        """Bank, patch, note and control names matching q, with the devices using them"""
+        import time
+        
+        try:
+            params = parse_qs(urlparse(self.path).query)
+            query = params.get('q', [''])[0]
+            kinds = {kind for value in params.get('kind', []) for kind in value.split(',') if kind}
+            unknown = kinds - set(SEARCH_NAME_KINDS.values())
+            if unknown:
+                self.send_error(400, f"Unknown kind: {', '.join(sorted(unknown))}")
+                return
+            fuzzy = params.get('fuzzy', ['0'])[0] not in ('0', 'false', '')
+            limit = parse_limit(params.get('limit', [None])[0], SEARCH_DEFAULT_RESULTS, SEARCH_MAX_RESULTS)
+            
+            start_time = time.perf_counter()
+            matches, total = CATALOG_INDEX.search(query, kinds or None, fuzzy, limit)
+            self.send_json({
+                'query': query,
+                'total': total,
+                'results': matches,
+                'elapsed_ms': round((time.perf_counter() - start_time) * 1000, 2)
+            })
+        except ValueError as e:
+            self.send_error(400, f"Bad search query: {str(e)}")
+        except Exception as e:
+            self.send_error(500, f"Error searching names: {str(e)}")
+
+    def serve_catalog_query(self):
+        """Slices of the catalog: manufacturer summary and devices, filtered devices and patches"""
+        from urllib.parse import unquote
+        
+        try:
+            url = urlparse(self.path)
+            filters = {name: values[0] for name, values in parse_qs(url.query).items()}
+            CATALOG_INDEX.current()
+            store = CATALOG_INDEX.store
+            
+            if url.path == '/catalog/manufacturers':
+                body, etag, modified = CATALOG_INDEX.summary_response()
+                self.send_cacheable(body, 'application/json', etag, modified, resource=url.path)
+            elif url.path.startswith('/catalog/manufacturers/'):
+                manufacturer = unquote(url.path[len('/catalog/manufacturers/'):])
+                response = CATALOG_INDEX.manufacturer_response(manufacturer)
+                if response is None:
+                    self.send_error(404, f"Unknown manufacturer: {manufacturer}")
+                    return
+                body, etag, modified = response
+                self.send_cacheable(body, 'application/json', etag, modified, resource=url.path)
+            elif url.path == '/catalog/devices':
+                limit = parse_limit(filters.get('limit'), None, CATALOG_PAGE_MAX)
+                if store is not None:
+                    devices = store.query_devices(filters, limit)
+                else:
+                    from itertools import islice
+                    
+                    # Without the SQLite store, filter the in-memory catalog
+                    with CATALOG_INDEX.lock:
+                        devices = dict(islice((
+                            (key, device) for key, device in CATALOG_INDEX.catalog.items()
+                            if all(str(device.get(name) or '').lower() == filters[name].lower()
+                                   for name in CatalogStore.DEVICE_FILTERS if filters.get(name))
+                        ), limit))
+                self.send_json(devices)
+            elif url.path == '/catalog/patches':
+                if store is None:
+                    self.send_error(501, "Patch queries need the SQLite catalog store (--catalog-db)")
+                    return
+                self.send_json(store.query_patches(filters, parse_limit(filters.get('limit'), 100, CATALOG_PAGE_MAX)))
+            else:
+                self.send_error(404)
+        except ValueError as e:
+            self.send_error(400, f"Bad catalog query: {str(e)}")
+        except Exception as e:
+            self.send_error(500, f"Error querying catalog: {str(e)}")
+
+    def serve_revisions(self):
+        """List the saved revisions of a file, newest first"""
+        try:
+            from urllib.parse import unquote
+            file_path = unquote(urlparse(self.path).path[len('/revisions/'):])
+            revisions = [
+                {'id': r['id'], 'time': r['time'], 'size': r['size']}
+                for r in reversed(REVISIONS.revisions(file_path))
+            ]
+            self.send_json({'file_path': file_path, 'revisions': revisions})
+        except Exception as e:
+            self.send_error(500, f"Error listing revisions: {str(e)}")
+
+    def serve_revision_diff(self):
+        """Unified diff between two revisions (?from=&to=); to defaults to the file on disk"""
+        try:
+            from urllib.parse import unquote
+            url = urlparse(self.path)
+            file_path = unquote(url.path[len('/revision_diff/'):])
+            query = parse_qs(url.query)
+            
+            versions = []
+            for name in ('from', 'to'):
+                revision_id = query.get(name, [None])[0]
+                if revision_id is None and name == 'to':
+                    if not os.path.exists(file_path):
+                        self.send_error(404, f"File not found: {file_path}")
+                        return
+                    with open(file_path, 'rb') as f:
+                        versions.append((f.read(), 'current'))
+                    continue
+                revision = REVISIONS.find(file_path, revision_id)
+                if revision is None:
+                    self.send_error(404, f"No revision {revision_id} of {file_path}")
+                    return
+                versions.append((REVISIONS.content(revision), revision['id'][:10]))
+            
+            (from_data, from_label), (to_data, to_label) = versions
+            diff = REVISIONS.diff(file_path, from_data, to_data, from_label, to_label)
+            self.send_body(diff.encode('utf-8'), 'text/plain; charset=utf-8')
+        except Exception as e:
+            self.send_error(500, f"Error diffing revisions: {str(e)}")
+
+    def restore_revision(self):
+        """Save an earlier revision of a file as its current content"""
+        try:
+            content_length = int(self.headers['Content-Length'])
+            data = json.loads(self.rfile.read(content_length).decode('utf-8'))
+            file_path = data.get('file_path', '')
+            revision_id = data.get('revision', '')
+            
+            revision = REVISIONS.find(file_path, revision_id)
+            if revision is None:
+                self.send_error(404, f"No revision {revision_id} of {file_path}")
+                return
+            
+            saved = FILE_SAVER.save(file_path, REVISIONS.content(revision))
+            DOCUMENT_CACHE.invalidate(file_path)
+            self.send_json({
+                'success': True,
+                'file_path': file_path,
+                'revision': revision['id'],
+                'unchanged': saved['unchanged']
+            })
+        except Exception as e:
+            self.send_error(500, f"Error restoring revision: {str(e)}")
+
+    def serve_cache_stats(self):
+        """Serve hit/miss counters of the shared caches and the last catalog refresh"""
+        try:
+            self.send_json({
+                'documents': DOCUMENT_CACHE.stats(),
+                'compressed_bodies': COMPRESSED_BODIES.stats(),
+                'catalog_build': CATALOG_INDEX.last_build
+            })
+        except Exception as e:
+            self.send_error(500, f"Error reading cache stats: {str(e)}")
+
     def clear_cache(self):
         """Clear the midnam catalog cache"""
         try:
-            cache_file = 'midnam_catalog_cache.json'
-            if os.path.exists(cache_file):
-                os.remove(cache_file)
-                self.send_response(200)
-                self.send_header('Content-Type', 'application/json')
-                self.end_headers()
-                self.wfile.write(b'{"success": true, "message": "Cache cleared"}')
+            # One lock hold, so no refresh can save a snapshot in between
+            with CATALOG_INDEX.lock:
+                CATALOG_INDEX.clear()
+                removed = CATALOG_INDEX.snapshot.remove()
+            DOCUMENT_CACHE.clear()
+            COMPRESSED_BODIES.clear()
+            if removed:
+                self.send_body(b'{"success": true, "message": "Cache cleared"}', 'application/json')
             else:
-                self.send_response(200)
-                self.send_header('Content-Type', 'application/json')
-                self.end_headers()
-                self.wfile.write(b'{"success": true, "message": "No cache to clear"}')
+                self.send_body(b'{"success": true, "message": "No cache to clear"}', 'application/json')
         except Exception as e:
             self.send_error(500, f"Error clearing cache: {str(e)}")
 
-if __name__ == "__main__":
-    PORT = 8000
+def main():
+    import argparse
+    import signal
+    
+    parser = argparse.ArgumentParser(description="MIDI Name Editor server")
+    parser.add_argument("--port", type=int, default=8000, help="Port to listen on")
+    parser.add_argument("--workers", type=int, default=DEFAULT_MAX_WORKERS,
+                        help="Maximum number of requests handled concurrently")
+    parser.add_argument("--keepalive-timeout", type=float, default=KEEPALIVE_TIMEOUT,
+                        help="Seconds an idle keep-alive connection is kept open")
+    parser.add_argument("--single-threaded", action="store_true",
+                        help="Handle one connection at a time (previous behaviour)")
+    parser.add_argument("--backup-keep", type=int, default=BACKUP_KEEP,
+                        help="Backups kept per saved file (0 = unlimited)")
+    parser.add_argument("--backup-max-age", type=float, default=BACKUP_MAX_AGE_DAYS,
+                        help="Delete backups older than this many days (0 = never)")
+    parser.add_argument("--full-backups", action="store_true",
+                        help="Keep <file>.backup.* copies on save instead of the revision store")
+    parser.add_argument("--catalog-db", default=CATALOG_DB,
+                        help="Also keep the catalog in this SQLite database for /catalog/ queries")
+    parser.add_argument("--no-watch", action="store_true",
+                        help="Do not watch patchfiles/; refresh the catalog on each request instead")
+    parser.add_argument("--validate", action="store_true",
+                        help="Validate every file under patchfiles/ as NDJSON on stdout and exit")
+    parser.add_argument("--force", action="store_true",
+                        help="With --validate, also revalidate files that passed last run")
+    args = parser.parse_args()
     
-    with socketserver.TCPServer(("", PORT), MIDINameHandler) as httpd:
-        print(f"Server running at http://localhost:{PORT}/")
-        print(f"Open: http://localhost:{PORT}/midi_name_editor.html")
+    load_dtd_schemas()
+    if args.validate:
+        failed = 0
+        for result in BULK_VALIDATOR.run(force=args.force):
+            print(json.dumps(result), flush=True)
+            failed = result.get('summary', {}).get('failed', failed)
+        sys.exit(1 if failed else 0)
+    
+    MIDINameHandler.timeout = args.keepalive_timeout
+    FILE_SAVER.keep = args.backup_keep
+    FILE_SAVER.max_age_days = args.backup_max_age
+    if args.full_backups:
+        FILE_SAVER.revisions = None
+    
+    if args.single_threaded:
+        # HTTP/1.0 closes each connection so one client cannot hold the server
+        MIDINameHandler.protocol_version = 'HTTP/1.0'
+        httpd = socketserver.TCPServer(("", args.port), MIDINameHandler)
+    else:
+        httpd = MIDINameServer(("", args.port), MIDINameHandler, max_workers=args.workers)
+    
+    # Treat SIGTERM like Ctrl+C so in-flight requests can finish
+    def handle_sigterm(signum, frame):
+        threading.Thread(target=httpd.shutdown, daemon=True).start()
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    
+    if args.catalog_db:
+        CATALOG_INDEX.attach_store(CatalogStore(args.catalog_db))
+    if not args.no_watch:
+        CATALOG_WATCHER.start()
+    
+    with httpd:
+        print(f"Server running at http://localhost:{args.port}/")
+        print(f"Open: http://localhost:{args.port}/midi_name_editor.html")
+        if not args.single_threaded:
+            print(f"Handling up to {args.workers} requests concurrently")
         print("Press Ctrl+C to stop")
         try:
             httpd.serve_forever()
         except KeyboardInterrupt:
-            print("\nServer stopped.")
+            pass
+        CATALOG_WATCHER.stop()
+        if CATALOG_INDEX.store is not None:
+            CATALOG_INDEX.store.close()
+        print("\nServer stopped.")
+
+
+if __name__ == "__main__":
+    main()
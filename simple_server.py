@@ -3,14 +3,14 @@
 Simple HTTP server for the D4 Editor
 """
 
-import http.server
-import socketserver
 import os
 import json
+import threading
 from urllib.parse import unquote
-from datetime import datetime
 
-class D4Handler(http.server.SimpleHTTPRequestHandler):
+from server import MIDINameServer, KeepAliveRequestHandler, DEFAULT_MAX_WORKERS, FILE_SAVER, validate_midnam
+
+class D4Handler(KeepAliveRequestHandler):
     def end_headers(self):
         self.send_header('Access-Control-Allow-Origin', '*')
         self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
@@ -19,7 +19,15 @@ class D4Handler(http.server.SimpleHTTPRequestHandler):
     
     def do_OPTIONS(self):
         self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+    
+    def send_body(self, body, content_type, status=200):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
         self.end_headers()
+        self.wfile.write(body)
     
     def do_GET(self):
         if self.path == '/load_d4.php':
@@ -40,10 +48,7 @@ class D4Handler(http.server.SimpleHTTPRequestHandler):
             with open('Alesis/D4.midnam', 'r', encoding='utf-8') as f:
                 xml_content = f.read()
             
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/xml; charset=utf-8')
-            self.end_headers()
-            self.wfile.write(xml_content.encode('utf-8'))
+            self.send_body(xml_content.encode('utf-8'), 'application/xml; charset=utf-8')
         except Exception as e:
             self.send_error(500, f"Error reading XML: {str(e)}")
     
@@ -58,21 +63,11 @@ class D4Handler(http.server.SimpleHTTPRequestHandler):
             else:
                 raise ValueError("No XML data in request")
             
-            # Create backup
-            backup_name = f'Alesis/D4.midnam.backup.{datetime.now().strftime("%Y-%m-%d-%H-%M-%S")}'
-            if os.path.exists('Alesis/D4.midnam'):
-                import shutil
-                shutil.copy('Alesis/D4.midnam', backup_name)
+            # Back up the current file and replace it atomically
+            saved = FILE_SAVER.save('Alesis/D4.midnam', xml_data.encode('utf-8'))
             
-            # Save new content
-            with open('Alesis/D4.midnam', 'w', encoding='utf-8') as f:
-                f.write(xml_data)
-            
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
-            response = json.dumps({'success': True, 'backup': backup_name})
-            self.wfile.write(response.encode('utf-8'))
+            response = json.dumps({'success': True, 'backup': saved['backup'], 'revision': saved['revision'], 'unchanged': saved['unchanged']})
+            self.send_body(response.encode('utf-8'), 'application/json')
             
         except Exception as e:
             self.send_error(500, f"Error saving XML: {str(e)}")
@@ -87,55 +82,38 @@ class D4Handler(http.server.SimpleHTTPRequestHandler):
             else:
                 raise ValueError("No XML data in request")
             
-            # Simple XML validation
-            import xml.etree.ElementTree as ET
-            try:
-                root = ET.fromstring(xml_data)
-                errors = []
-                
-                # Check for duplicate note numbers within each drumset
-                for note_list in root.findall('.//NoteNameList'):
-                    numbers = []
-                    for note in note_list.findall('Note'):
-                        num = note.get('Number')
-                        name = note.get('Name')
-                        
-                        if not num or not name:
-                            errors.append(f"Missing number or name in {note_list.get('Name')}")
-                        
-                        if num in numbers:
-                            errors.append(f"Duplicate note number {num} in {note_list.get('Name')}")
-                        numbers.append(num)
-                
-                if errors:
-                    result = {"valid": False, "errors": errors}
-                else:
-                    result = {"valid": True, "errors": []}
-                    
-            except ET.ParseError as e:
-                result = {"valid": False, "errors": [f"XML Parse Error: {str(e)}"]}
+            errors = validate_midnam(xml_data)
+            result = {"valid": not errors, "errors": errors}
             
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
             response = json.dumps(result)
-            self.wfile.write(response.encode('utf-8'))
+            self.send_body(response.encode('utf-8'), 'application/json')
             
         except Exception as e:
             self.send_error(500, f"Error validating XML: {str(e)}")
 
 if __name__ == "__main__":
-    PORT = 8000
+    import argparse
+    import signal
+    
+    parser = argparse.ArgumentParser(description="D4 Editor server")
+    parser.add_argument("--port", type=int, default=8000, help="Port to listen on")
+    parser.add_argument("--workers", type=int, default=DEFAULT_MAX_WORKERS,
+                        help="Maximum number of requests handled concurrently")
+    args = parser.parse_args()
     
     if not os.path.exists('Alesis/D4.midnam'):
         print("Error: Alesis/D4.midnam not found!")
         exit(1)
     
-    with socketserver.TCPServer(("", PORT), D4Handler) as httpd:
-        print(f"Server running at http://localhost:{PORT}/")
-        print(f"Open: http://localhost:{PORT}/d4_editor.html")
+    httpd = MIDINameServer(("", args.port), D4Handler, max_workers=args.workers)
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=httpd.shutdown, daemon=True).start())
+    
+    with httpd:
+        print(f"Server running at http://localhost:{args.port}/")
+        print(f"Open: http://localhost:{args.port}/d4_editor.html")
         print("Press Ctrl+C to stop")
         try:
             httpd.serve_forever()
         except KeyboardInterrupt:
-            print("\nServer stopped.")
+            pass
+        print("\nServer stopped.")
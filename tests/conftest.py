@@ -0,0 +1,84 @@
+"""Shared fixtures for the server tests"""
+
+import json
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+import server
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """Run in an empty directory with the process-wide caches reset"""
+    monkeypatch.chdir(tmp_path)
+    server.DOCUMENT_CACHE.clear()
+    server.COMPRESSED_BODIES.clear()
+    yield tmp_path
+    server.DOCUMENT_CACHE.clear()
+    server.COMPRESSED_BODIES.clear()
+
+
+@pytest.fixture
+def catalog(workdir, monkeypatch):
+    """A fresh MidnamCatalogIndex over workdir/patchfiles, installed as CATALOG_INDEX"""
+    (workdir / 'patchfiles').mkdir()
+    index = server.MidnamCatalogIndex('patchfiles', 'midnam_catalog.snapshot', workers=1)
+    monkeypatch.setattr(server, 'CATALOG_INDEX', index)
+    yield index
+    index.snapshot.close()
+
+
+@pytest.fixture
+def write_midnam(workdir):
+    """write_midnam(path, manufacturer, model, patches) writes a one-bank .midnam under patchfiles/"""
+    def write(path, manufacturer, model, patches=(), notes=()):
+        patch_xml = ''.join(f'<Patch Number="{i}" Name="{name}" ProgramChange="{i}"/>'
+                            for i, name in enumerate(patches))
+        note_xml = ''.join(f'<Note Number="{36 + i}" Name="{name}"/>' for i, name in enumerate(notes))
+        content = (f'<?xml version="1.0" encoding="UTF-8"?>\n{server.MIDNAM_DOCTYPE}\n'
+                   '<MIDINameDocument><Author/><MasterDeviceNames>'
+                   f'<Manufacturer>{manufacturer}</Manufacturer><Model>{model}</Model>'
+                   '<CustomDeviceMode Name="Default"><ChannelNameSetAssignments>'
+                   '<ChannelNameSetAssign Channel="1" NameSet="Set"/></ChannelNameSetAssignments></CustomDeviceMode>'
+                   '<ChannelNameSet Name="Set"><AvailableForChannels><AvailableChannel Channel="1" Available="true"/>'
+                   '</AvailableForChannels><UsesNoteNameList Name="Drums"/>'
+                   f'<PatchBank Name="Presets"><PatchNameList Name="Presets">{patch_xml}</PatchNameList></PatchBank>'
+                   f'</ChannelNameSet><NoteNameList Name="Drums">{note_xml}</NoteNameList>'
+                   '</MasterDeviceNames></MIDINameDocument>\n')
+        target = workdir / 'patchfiles' / path
+        target.parent.mkdir(parents=True, exist_ok=True)
+        target.write_text(content, encoding='utf-8')
+        return target
+    return write
+
+
+@pytest.fixture
+def http_server(workdir):
+    """A MIDINameServer on a free port serving workdir; yields its base URL"""
+    httpd = server.MIDINameServer(('127.0.0.1', 0), server.MIDINameHandler, max_workers=4, shutdown_grace=1)
+    thread = threading.Thread(target=httpd.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{httpd.server_address[1]}'
+    httpd.shutdown()
+    httpd.server_close()
+    thread.join()
+
+
+@pytest.fixture
+def fetch():
+    """fetch(url, data=None) -> (status, body bytes); data is sent as a JSON POST"""
+    return request
+
+
+def request(url, data=None, method=None):
+    body = None if data is None else json.dumps(data).encode('utf-8')
+    req = urllib.request.Request(url, data=body, method=method,
+                                 headers={'Content-Type': 'application/json'} if body else {})
+    try:
+        with urllib.request.urlopen(req, timeout=10) as response:
+            return response.status, response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read()
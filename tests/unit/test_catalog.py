@@ -0,0 +1,204 @@
+"""Tests for the catalog index and its endpoints"""
+
+import json
+import sys
+
+import pytest
+
+import server
+
+
+@pytest.fixture
+def devices(catalog, write_midnam):
+    write_midnam('Acme/Box.midnam', 'Acme', 'Box', ['Piano'])
+    write_midnam('Acme/Drum.midnam', 'Acme', 'Drum', notes=['Kick'])
+    write_midnam('Zeta/Synth.midnam', 'Zeta', 'Synth', ['Pad'])
+    write_midnam('Zeta/Synth 2.midnam', 'Zeta', 'Synth', ['Pad 2'])
+    return catalog
+
+
+def get_json(fetch, url):
+    status, body = fetch(url)
+    assert status == 200, body
+    return json.loads(body)
+
+
+def test_full_catalog(devices, http_server, fetch):
+    catalog = get_json(fetch, http_server + '/midnam_catalog')
+    assert sorted(catalog) == ['Acme|Box', 'Acme|Drum', 'Zeta|Synth']
+    assert [f['path'] for f in catalog['Zeta|Synth']['files']] == [
+        'patchfiles/Zeta/Synth 2.midnam', 'patchfiles/Zeta/Synth.midnam']
+
+
+def test_catalog_pages(devices, http_server, fetch):
+    keys, cursor = [], None
+    while True:
+        url = http_server + '/midnam_catalog?limit=2' + (f'&cursor={cursor}' if cursor else '')
+        page = get_json(fetch, url)
+        assert page['total'] == 3
+        keys += list(page['devices'])
+        cursor = page['next_cursor']
+        if cursor is None:
+            break
+    assert keys == ['Acme|Box', 'Acme|Drum', 'Zeta|Synth']
+
+
+def test_catalog_manufacturer_filter(devices, http_server, fetch):
+    page = get_json(fetch, http_server + '/midnam_catalog?manufacturer=Zeta')
+    assert list(page['devices']) == ['Zeta|Synth']
+    assert page['next_cursor'] is None
+
+
+@pytest.mark.parametrize('limit', ['0', '-2', 'ten', '1.5'])
+def test_catalog_bad_limit(devices, http_server, fetch, limit):
+    status, body = fetch(http_server + '/midnam_catalog?limit=' + limit)
+    assert status == 400
+
+
+def test_catalog_large_limit_is_capped(devices, http_server, fetch):
+    page = get_json(fetch, http_server + '/midnam_catalog?limit=99999999')
+    assert len(page['devices']) == 3
+
+
+def test_catalog_stream(devices, http_server, fetch):
+    status, body = fetch(http_server + '/midnam_catalog?stream=1')
+    assert status == 200
+    records = [json.loads(line) for line in body.decode().splitlines() if line]
+    assert records[0] == {'manufacturers': [
+        {'name': 'Acme', 'deviceCount': 2, 'fileCount': 2},
+        {'name': 'Zeta', 'deviceCount': 1, 'fileCount': 2}]}
+    assert [record['key'] for record in records[1:-1]] == ['Acme|Box', 'Acme|Drum', 'Zeta|Synth']
+    assert records[-1] == {'summary': {'devices': 3, 'files': 4, 'manufacturers': 2}}
+
+
+def test_manufacturer_summary_and_devices(devices, http_server, fetch):
+    summary = get_json(fetch, http_server + '/catalog/manufacturers')
+    assert [(m['name'], m['deviceCount'], m['fileCount']) for m in summary] == [('Acme', 2, 2), ('Zeta', 1, 2)]
+    assert list(get_json(fetch, http_server + '/catalog/manufacturers/acme')) == ['Acme|Box', 'Acme|Drum']
+    status, _ = fetch(http_server + '/catalog/manufacturers/Nobody')
+    assert status == 404
+
+
+def test_catalog_follows_changes(devices, write_midnam, http_server, fetch, workdir):
+    assert len(get_json(fetch, http_server + '/midnam_catalog')) == 3
+    write_midnam('New/One.midnam', 'New', 'One', ['Lead'])
+    (workdir / 'patchfiles' / 'Acme' / 'Drum.midnam').unlink()
+    catalog = get_json(fetch, http_server + '/midnam_catalog')
+    assert sorted(catalog) == ['Acme|Box', 'New|One', 'Zeta|Synth']
+    summary = get_json(fetch, http_server + '/catalog/manufacturers')
+    assert [(m['name'], m['deviceCount']) for m in summary] == [('Acme', 1), ('New', 1), ('Zeta', 1)]
+
+
+def test_device_query_without_store(devices, http_server, fetch):
+    assert list(get_json(fetch, http_server + '/catalog/devices?manufacturer=zeta')) == ['Zeta|Synth']
+    assert len(get_json(fetch, http_server + '/catalog/devices?limit=2')) == 2
+    status, _ = fetch(http_server + '/catalog/devices?limit=-1')
+    assert status == 400
+    status, _ = fetch(http_server + '/catalog/patches?name=pad')
+    assert status == 501
+
+
+def test_store_queries(devices, http_server, fetch, workdir):
+    devices.current()
+    devices.attach_store(server.CatalogStore(str(workdir / 'catalog.db')))
+    try:
+        assert list(get_json(fetch, http_server + '/catalog/devices?model=synth')) == ['Zeta|Synth']
+        assert len(get_json(fetch, http_server + '/catalog/devices?limit=1')) == 1
+        patches = get_json(fetch, http_server + '/catalog/patches?name=pad')
+        assert sorted(patch['name'] for patch in patches) == ['Pad', 'Pad 2']
+        assert len(get_json(fetch, http_server + '/catalog/patches?name=pad&limit=1')) == 1
+        for query in ('/catalog/patches?limit=0', '/catalog/patches?limit=-1', '/catalog/devices?limit=x'):
+            status, _ = fetch(http_server + query)
+            assert status == 400, query
+    finally:
+        devices.store.close()
+        devices.store = None
+
+
+def test_manufacturers_without_middev(devices, http_server, fetch):
+    manufacturers = get_json(fetch, http_server + '/manufacturers')
+    assert manufacturers == [
+        {'name': 'Acme', 'id': None, 'deviceCount': 2, 'fileCount': 2},
+        {'name': 'Zeta', 'id': None, 'deviceCount': 1, 'fileCount': 2},
+    ]
+
+
+ROWS_DOCUMENT = b'''<MIDINameDocument><MasterDeviceNames><Manufacturer>A</Manufacturer><Model>B</Model>
+<ChannelNameSet Name="Set">
+<PatchBank Name="One"><PatchNameList Name="One">
+<Patch Number="1" Name="Attr" ProgramChange="3"/>
+<Patch Number="2" Name="Nested"><PatchMIDICommands><ControlChange Control="0" Value="1"/>
+<ProgramChange Number="7"/></PatchMIDICommands></Patch>
+<Patch Number="3" Name="Empty" ProgramChange=""><PatchMIDICommands><ProgramChange/></PatchMIDICommands></Patch>
+</PatchNameList></PatchBank>
+<PatchBank><PatchNameList Name="Two"><Patch Number="x" Name="NoProgram"/></PatchNameList></PatchBank>
+</ChannelNameSet>
+<NoteNameList Name="Drums"><Note Number="36" Name="Kick"/><NoteGroup Name="G"><Note Number="x" Name="Odd"/></NoteGroup>
+</NoteNameList><NoteNameList Name="Empty"/></MasterDeviceNames></MIDINameDocument>'''
+
+
+def test_indexer_rows_match_tree_rows(workdir):
+    import xml.etree.ElementTree as ET
+    
+    path = workdir / 'rows.midnam'
+    path.write_bytes(ROWS_DOCUMENT)
+    record = server.index_midnam_file(str(path), feed_size=9, rows=True)
+    assert record.rows == server.midnam_table_rows(ET.fromstring(ROWS_DOCUMENT))
+    assert [row[3] for row in record.rows['patches']] == [3, 7, None, None]
+    assert server.index_midnam_file(str(path)).rows is None
+
+
+def test_store_rows_come_from_the_index_pass(devices, write_midnam, workdir, monkeypatch):
+    devices.attach_store(server.CatalogStore(str(workdir / 'catalog.db')))
+    reads = []
+    index_midnam_file = server.index_midnam_file
+    
+    def counted(path, *args, **kwargs):
+        reads.append(path)
+        return index_midnam_file(path, *args, **kwargs)
+    
+    monkeypatch.setattr(server, 'index_midnam_file', counted)
+    # Only documents already in the document cache are turned into rows from a tree
+    monkeypatch.setattr(server, 'midnam_table_rows', None)
+    try:
+        write_midnam('New/One.midnam', 'New', 'One', ['Lead', 'Bass'])
+        devices.refresh()
+        assert reads == ['patchfiles/New/One.midnam']
+        assert devices.files['patchfiles/New/One.midnam'].rows is None
+        patches = devices.store.query_patches({'model': 'one'})
+        assert [patch['name'] for patch in patches] == ['Lead', 'Bass']
+    finally:
+        devices.store.close()
+        devices.store = None
+
+
+def wait_for(condition, timeout=3):
+    import time
+
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.02)
+    return True
+
+
+@pytest.mark.parametrize('inotify', [True, False])
+def test_watcher_follows_changes(devices, write_midnam, workdir, monkeypatch, inotify):
+    if not inotify:
+        def unavailable():
+            raise OSError('no inotify here')
+        monkeypatch.setattr(server, 'Inotify', unavailable)
+    watcher = server.CatalogWatcher(devices, interval=0.1, debounce=0.05)
+    watcher.start()
+    try:
+        assert devices.live
+        assert watcher.mode == ('inotify' if inotify and sys.platform.startswith('linux') else 'poll')
+        write_midnam('New/One.midnam', 'New', 'One', ['Lead'])
+        assert wait_for(lambda: 'New|One' in devices.catalog)
+        (workdir / 'patchfiles' / 'Acme' / 'Drum.midnam').unlink()
+        assert wait_for(lambda: 'Acme|Drum' not in devices.catalog)
+        assert 'patchfiles/Acme/Drum.midnam' not in devices.files
+    finally:
+        watcher.stop()
+    assert not devices.live
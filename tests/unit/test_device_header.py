@@ -0,0 +1,103 @@
+"""Parity of the streamed device header with extract_device_info()"""
+
+import xml.etree.ElementTree as ET
+from pathlib import Path
+
+import pytest
+
+import server
+
+DOCUMENTS = {
+    'master': '''<MIDINameDocument><Author>A</Author>
+        <MasterDeviceNames><Manufacturer> Alesis </Manufacturer><Model>D4</Model>
+        <DeviceID Family="1" Member="2"/></MasterDeviceNames></MIDINameDocument>''',
+    'model after other children': '''<MIDINameDocument><MasterDeviceNames>
+        <Manufacturer>Roland</Manufacturer><CustomDeviceMode Name="Default"/>
+        <ChannelNameSetAssignments/><Model>JV-1080</Model></MasterDeviceNames>
+        </MIDINameDocument>''',
+    'device id last': '''<MIDINameDocument><MasterDeviceNames><Model>M1</Model>
+        <Manufacturer>Korg</Manufacturer><CustomDeviceMode Name="Default"/>
+        <DeviceID Family="5" Member="6"/></MasterDeviceNames></MIDINameDocument>''',
+    'extending before master': '''<MIDINameDocument>
+        <ExtendingDeviceNames><Manufacturer>Yamaha</Manufacturer><Model>DX7</Model>
+        </ExtendingDeviceNames><MasterDeviceNames><Manufacturer>Yamaha</Manufacturer>
+        <Model>TX802</Model></MasterDeviceNames></MIDINameDocument>''',
+    'master missing model': '''<MIDINameDocument><MasterDeviceNames>
+        <Manufacturer>Korg</Manufacturer></MasterDeviceNames><ExtendingDeviceNames>
+        <Manufacturer>Korg</Manufacturer><Model>M1</Model></ExtendingDeviceNames>
+        </MIDINameDocument>''',
+    'nested master': '''<MIDINameDocument><Wrapper><MasterDeviceNames>
+        <Manufacturer>E-mu</Manufacturer><Model><!-- c -->Proteus</Model>
+        </MasterDeviceNames></Wrapper></MIDINameDocument>''',
+    'first master wins': '''<MIDINameDocument><MasterDeviceNames>
+        <Manufacturer>A</Manufacturer><Model>One</Model></MasterDeviceNames>
+        <MasterDeviceNames><Manufacturer>B</Manufacturer><Model>Two</Model>
+        <DeviceID Family="9"/></MasterDeviceNames></MIDINameDocument>''',
+    'grandchild fields ignored': '''<MIDINameDocument><MasterDeviceNames>
+        <CustomDeviceMode><Model>Inner</Model></CustomDeviceMode>
+        <Manufacturer>Akai</Manufacturer><Model>S900</Model></MasterDeviceNames>
+        </MIDINameDocument>''',
+    'extending models': '''<MIDINameDocument><ExtendingDeviceNames>
+        <Manufacturer>Casio</Manufacturer><Model>CZ-1</Model><Model/>
+        <Model> CZ-101 </Model></ExtendingDeviceNames></MIDINameDocument>''',
+    'extending missing manufacturer': '''<MIDINameDocument><ExtendingDeviceNames>
+        <Model>CZ-1</Model></ExtendingDeviceNames></MIDINameDocument>''',
+    'empty texts': '''<MIDINameDocument><MasterDeviceNames><Manufacturer/>
+        <Model></Model></MasterDeviceNames></MIDINameDocument>''',
+    'no header': '<MIDINameDocument><Author>A</Author></MIDINameDocument>',
+    'wrong root': '''<Other><MasterDeviceNames><Manufacturer>A</Manufacturer>
+        <Model>B</Model></MasterDeviceNames></Other>''',
+}
+
+
+def read_header(content, step):
+    reader = server.MidnamSummaryReader('x.midnam')
+    for offset in range(0, len(content), step):
+        if reader.feed(content[offset:offset + step]):
+            break
+    reader.close()
+    return reader.device_info
+
+
+@pytest.mark.parametrize('name', sorted(DOCUMENTS))
+@pytest.mark.parametrize('step', [1, 7, 4096])
+def test_header_reader_matches_tree(name, step):
+    content = DOCUMENTS[name].encode()
+    expected = server.extract_device_info(ET.fromstring(content), 'x.midnam')
+    assert read_header(content, step) == expected
+
+
+@pytest.mark.parametrize('name', sorted(DOCUMENTS))
+def test_indexed_device_matches_tree(tmp_path, name):
+    path = tmp_path / 'x.midnam'
+    path.write_text(DOCUMENTS[name])
+    expected = server.extract_device_info(ET.parse(path).getroot(), str(path))
+    assert server.index_midnam_file(str(path), feed_size=5).device == expected
+
+
+def test_settled_header_does_not_stop_the_summary():
+    content = (b'<MIDINameDocument><MasterDeviceNames><Manufacturer>Alesis</Manufacturer>'
+               b'<Model>D4</Model><DeviceID Family="1"/><Model>Later</Model>'
+               b'<PatchBank Name="B"><PatchNameList Name="B"><Patch Number="1" Name="Kit"/>'
+               b'</PatchNameList></PatchBank></MasterDeviceNames></MIDINameDocument>')
+    reader = server.MidnamSummaryReader('x.midnam')
+    assert not reader.feed(content)
+    reader.close()
+    assert reader.device_info['model'] == 'D4'
+    assert reader.summary()['total_patches'] == 1
+    assert reader.names() == {'bank': ['B'], 'patch': ['Kit']}
+
+
+def test_unparseable_document_has_no_device(tmp_path):
+    path = tmp_path / 'x.midnam'
+    path.write_text(DOCUMENTS['extending models'].replace('</MIDINameDocument>', ''))
+    record = server.index_midnam_file(str(path))
+    assert record.device is None
+    assert record.analysis is None
+
+
+def test_shipped_patchfile():
+    path = Path(__file__).resolve().parents[2] / 'patchfiles' / 'Alesis' / 'D4.midnam'
+    expected = server.extract_device_info(ET.parse(path).getroot(), str(path))
+    assert expected is not None
+    assert server.index_midnam_file(str(path), feed_size=100).device == expected
@@ -0,0 +1,86 @@
+"""Tests for the shared parsed-document cache"""
+
+import json
+import os
+
+import server
+
+
+def write(path, content):
+    path.write_bytes(content)
+    return str(path)
+
+
+def test_hits_and_misses(workdir):
+    cache = server.ParsedDocumentCache()
+    path = write(workdir / 'a.midnam', b'<MIDINameDocument/>')
+
+    first = cache.get(path)
+    assert cache.get(path) is first
+    assert cache.stats()['bytes'] == 19
+    assert cache.get_root(path) is cache.get_root(path)
+    # The parsed tree counts against the budget too
+    assert cache.stats()['bytes'] == 19 + server.PARSED_ELEMENT_COST
+    assert cache.stats()['misses'] == 1
+    assert cache.stats()['hits'] == 3
+    assert cache.stats()['entries'] == 1
+
+
+def test_file_changed_on_disk_is_reread(workdir):
+    cache = server.ParsedDocumentCache()
+    path = write(workdir / 'a.midnam', b'<MIDINameDocument/>')
+    assert cache.get_root(path).tag == 'MIDINameDocument'
+
+    write(workdir / 'a.midnam', b'<MIDIDeviceTypes/>')
+    os.utime(path, ns=(1, 1))
+    assert cache.get_root(path).tag == 'MIDIDeviceTypes'
+    assert cache.stats()['misses'] == 2
+
+
+def test_least_recently_used_is_evicted(workdir):
+    cache = server.ParsedDocumentCache(max_bytes=250)
+    paths = [write(workdir / f'{name}.midnam', b'<x>' + b' ' * 90 + b'</x>') for name in 'abc']
+    cache.get(paths[0])
+    cache.get(paths[1])
+    cache.get(paths[0])
+    cache.get(paths[2])
+
+    stats = cache.stats()
+    assert stats['evictions'] == 1
+    assert stats['bytes'] <= 250
+    assert cache.peek(paths[1], 97, os.stat(paths[1]).st_mtime_ns) is None
+    assert cache.peek(paths[0], 97, os.stat(paths[0]).st_mtime_ns) is not None
+
+
+def test_oversized_document_is_not_kept(workdir):
+    cache = server.ParsedDocumentCache(max_bytes=10)
+    path = write(workdir / 'a.midnam', b'<MIDINameDocument/>')
+    assert cache.get(path).content == b'<MIDINameDocument/>'
+    assert cache.stats()['entries'] == 0
+
+
+def test_writes_invalidate(workdir, http_server, fetch):
+    (workdir / 'a.midnam').write_bytes(b'<MIDINameDocument/>')
+    server.DOCUMENT_CACHE.get('a.midnam')
+
+    status, _ = fetch(http_server + '/save_file', {'file_path': 'a.midnam', 'xml_content': '<MIDIDeviceTypes/>'})
+    assert status == 200
+    assert server.DOCUMENT_CACHE.stats()['entries'] == 0
+    assert server.DOCUMENT_CACHE.get_root('a.midnam').tag == 'MIDIDeviceTypes'
+
+    status, _ = fetch(http_server + '/delete_file', {'file_path': 'a.midnam'})
+    assert status == 200
+    assert server.DOCUMENT_CACHE.stats()['entries'] == 0
+
+
+def test_cache_stats_endpoint(workdir, http_server, fetch):
+    (workdir / 'a.midnam').write_bytes(b'<MIDINameDocument/>')
+    before = server.DOCUMENT_CACHE.stats()
+    server.DOCUMENT_CACHE.get('a.midnam')
+    server.DOCUMENT_CACHE.get('a.midnam')
+    status, body = fetch(http_server + '/cache_stats')
+    assert status == 200
+    documents = json.loads(body)['documents']
+    assert documents['entries'] == 1
+    assert documents['misses'] == before['misses'] + 1
+    assert documents['hits'] == before['hits'] + 1
@@ -0,0 +1,235 @@
+"""Tests for MIDINameServer connection handling, validators and content coding"""
+
+import http.client
+import json
+import socket
+import threading
+import time
+
+import pytest
+
+import server
+
+
+@pytest.fixture
+def small_server(workdir, monkeypatch):
+    """A two-worker server with a one second keep-alive timeout; yields its port"""
+    (workdir / 'hello.txt').write_bytes(b'hello')
+    monkeypatch.setattr(server.MIDINameHandler, 'timeout', 1)
+    httpd = server.MIDINameServer(('127.0.0.1', 0), server.MIDINameHandler, max_workers=2, shutdown_grace=1)
+    thread = threading.Thread(target=httpd.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    yield httpd.server_address[1]
+    httpd.shutdown()
+    httpd.server_close()
+    thread.join()
+
+
+def get(connection, path='/hello.txt'):
+    connection.request('GET', path)
+    response = connection.getresponse()
+    return response.status, response.read()
+
+
+def test_idle_connections_do_not_hold_workers(small_server):
+    idle = []
+    for _ in range(2):
+        connection = http.client.HTTPConnection('127.0.0.1', small_server, timeout=5)
+        assert get(connection) == (200, b'hello')
+        idle.append(connection)
+    # A connection that never sent anything must not take a worker either
+    silent = socket.create_connection(('127.0.0.1', small_server))
+    
+    started = time.monotonic()
+    third = http.client.HTTPConnection('127.0.0.1', small_server, timeout=5)
+    assert get(third) == (200, b'hello')
+    assert time.monotonic() - started < 0.5
+    
+    # The parked connections are still usable
+    for connection in idle:
+        assert get(connection) == (200, b'hello')
+    for connection in idle + [third]:
+        connection.close()
+    silent.close()
+
+
+def test_idle_connection_closed_after_timeout(small_server):
+    connection = socket.create_connection(('127.0.0.1', small_server), timeout=5)
+    connection.sendall(b'GET /hello.txt HTTP/1.1\r\nHost: x\r\n\r\n')
+    response = b''
+    while not response.endswith(b'hello'):
+        response += connection.recv(4096)
+    assert response.startswith(b'HTTP/1.1 200')
+    started = time.monotonic()
+    assert connection.recv(4096) == b''
+    assert 0.5 < time.monotonic() - started < 3
+    connection.close()
+
+
+def test_pipelined_requests(small_server):
+    connection = socket.create_connection(('127.0.0.1', small_server), timeout=5)
+    connection.sendall(b'GET /hello.txt HTTP/1.1\r\nHost: x\r\n\r\n' * 2
+                       + b'GET /hello.txt HTTP/1.1\r\nHost: x\r\nConnection: close\r\n\r\n')
+    response = b''
+    while True:
+        data = connection.recv(4096)
+        if not data:
+            break
+        response += data
+    assert response.count(b' 200 ') == 3
+    assert response.endswith(b'hello')
+    connection.close()
+
+
+def test_close_with_idle_connections_is_prompt(workdir):
+    httpd = server.MIDINameServer(('127.0.0.1', 0), server.MIDINameHandler, max_workers=2, shutdown_grace=5)
+    thread = threading.Thread(target=httpd.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    (workdir / 'hello.txt').write_bytes(b'hello')
+    connection = http.client.HTTPConnection('127.0.0.1', httpd.server_address[1], timeout=5)
+    assert get(connection) == (200, b'hello')
+    
+    started = time.monotonic()
+    httpd.shutdown()
+    httpd.server_close()
+    thread.join()
+    assert time.monotonic() - started < 2
+    connection.close()
+
+
+def fetch_with(base_url, path, headers=None):
+    """(status, headers, body) of a GET sent with the given request headers"""
+    host, port = base_url.rsplit('/', 1)[-1].split(':')
+    connection = http.client.HTTPConnection(host, int(port), timeout=5)
+    try:
+        connection.request('GET', path, headers=headers or {})
+        response = connection.getresponse()
+        return response.status, response.headers, response.read()
+    finally:
+        connection.close()
+
+
+@pytest.mark.parametrize('path', ['/patchfiles/Acme/Box.midnam', '/load_d4.php', '/midnam_catalog'])
+def test_conditional_get(catalog, write_midnam, workdir, http_server, path):
+    write_midnam('Acme/Box.midnam', 'Acme', 'Box', ['Piano'])
+    (workdir / 'Alesis').mkdir()
+    (workdir / 'Alesis' / 'D4.midnam').write_bytes(b'<MIDINameDocument/>')
+    
+    status, headers, body = fetch_with(http_server, path)
+    assert status == 200 and body
+    etag = headers['ETag']
+    assert etag.startswith('"')
+    
+    status, headers, body = fetch_with(http_server, path, {'If-None-Match': etag})
+    assert (status, body) == (304, b'')
+    assert headers['ETag'] == etag
+    status, _, _ = fetch_with(http_server, path, {'If-None-Match': '"other", ' + etag})
+    assert status == 304
+    status, _, _ = fetch_with(http_server, path, {'If-Modified-Since': headers['Last-Modified']})
+    assert status == 304
+    status, _, _ = fetch_with(http_server, path, {'If-Modified-Since': 'Thu, 01 Jan 1970 00:00:00 GMT'})
+    assert status == 200
+
+
+def test_changed_file_gets_new_etag(catalog, write_midnam, http_server):
+    target = write_midnam('Acme/Box.midnam', 'Acme', 'Box', ['Piano'])
+    status, headers, _ = fetch_with(http_server, '/patchfiles/Acme/Box.midnam')
+    etag = headers['ETag']
+    target.write_text(target.read_text().replace('Piano', 'Organ 2'))
+    
+    status, headers, body = fetch_with(http_server, '/patchfiles/Acme/Box.midnam', {'If-None-Match': etag})
+    assert status == 200
+    assert b'Organ' in body
+    assert headers['ETag'] != etag
+
+
+def test_gzip_responses_are_cached_per_version(catalog, write_midnam, http_server, monkeypatch):
+    import gzip
+    
+    monkeypatch.setattr(server, 'BROTLI_AVAILABLE', False)
+    target = write_midnam('Acme/Box.midnam', 'Acme', 'Box', [f'Patch {i}' for i in range(50)])
+    path = '/patchfiles/Acme/Box.midnam'
+    before = server.COMPRESSED_BODIES.stats()
+    
+    status, headers, body = fetch_with(http_server, path, {'Accept-Encoding': 'br;q=0.9, gzip'})
+    assert status == 200
+    assert headers['Content-Encoding'] == 'gzip'
+    assert headers['Vary'] == 'Accept-Encoding'
+    assert headers['ETag'].endswith('-gzip"')
+    assert gzip.decompress(body) == target.read_bytes()
+    assert len(body) < target.stat().st_size
+    
+    assert fetch_with(http_server, path, {'Accept-Encoding': 'gzip'})[2] == body
+    stats = server.COMPRESSED_BODIES.stats()
+    assert stats['misses'] == before['misses'] + 1
+    assert stats['hits'] == before['hits'] + 1
+    
+    status, _, _ = fetch_with(http_server, path, {'Accept-Encoding': 'gzip', 'If-None-Match': headers['ETag']})
+    assert status == 304
+    
+    status, headers, body = fetch_with(http_server, path, {'Accept-Encoding': 'gzip;q=0'})
+    assert 'Content-Encoding' not in headers
+    assert body == target.read_bytes()
+
+
+def test_small_bodies_and_catalog_compression(catalog, write_midnam, workdir, http_server):
+    import gzip
+    
+    (workdir / 'patchfiles' / 'tiny.midnam').write_bytes(b'<MIDINameDocument/>')
+    status, headers, body = fetch_with(http_server, '/patchfiles/tiny.midnam', {'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in headers
+    assert body == b'<MIDINameDocument/>'
+    
+    for number in range(20):
+        write_midnam(f'Acme/Box {number}.midnam', 'Acme', f'Box {number}')
+    status, headers, body = fetch_with(http_server, '/midnam_catalog', {'Accept-Encoding': 'gzip'})
+    assert headers['Content-Encoding'] == 'gzip'
+    assert len(json.loads(gzip.decompress(body))) == 20
+
+
+@pytest.fixture
+def binary_file(workdir):
+    """A non-UTF-8 patchfile of 2000 bytes; yields its URL path and content"""
+    content = bytes(range(256)) * 7 + b'\xff' * 208
+    (workdir / 'patchfiles').mkdir()
+    (workdir / 'patchfiles' / 'raw.midnam').write_bytes(content)
+    return '/patchfiles/raw.midnam', content
+
+
+def test_files_are_served_as_bytes(binary_file, http_server):
+    path, content = binary_file
+    status, headers, body = fetch_with(http_server, path)
+    assert status == 200
+    assert body == content
+    assert headers['Content-Length'] == '2000'
+    assert headers['Accept-Ranges'] == 'bytes'
+
+
+@pytest.mark.parametrize('header, start, end', [
+    ('bytes=0-99', 0, 99),
+    ('bytes=1990-', 1990, 1999),
+    ('bytes=-10', 1990, 1999),
+    ('bytes=1500-9999', 1500, 1999),
+])
+def test_range_requests(binary_file, http_server, header, start, end):
+    path, content = binary_file
+    status, headers, body = fetch_with(http_server, path, {'Range': header, 'Accept-Encoding': 'gzip'})
+    assert status == 206
+    assert body == content[start:end + 1]
+    assert headers['Content-Range'] == f'bytes {start}-{end}/2000'
+    assert 'Content-Encoding' not in headers
+
+
+def test_unusable_ranges(binary_file, http_server):
+    path, content = binary_file
+    status, headers, body = fetch_with(http_server, path, {'Range': 'bytes=2000-'})
+    assert status == 416
+    assert headers['Content-Range'] == 'bytes */2000'
+    # Several ranges, or an If-Range that no longer matches, get the whole file
+    for extra in ({'Range': 'bytes=0-1,5-6'}, {'Range': 'bytes=0-1', 'If-Range': '"stale"'}):
+        status, _, body = fetch_with(http_server, path, extra)
+        assert (status, body) == (200, content)
+    
+    etag = fetch_with(http_server, path)[1]['ETag']
+    status, _, body = fetch_with(http_server, path, {'Range': 'bytes=0-1', 'If-Range': etag})
+    assert (status, body) == (206, content[:2])
@@ -0,0 +1,134 @@
+"""Tests for MidnamMerger and /merge_files"""
+
+import json
+import xml.etree.ElementTree as ET
+from collections import Counter
+
+import pytest
+
+import server
+
+
+def document(body):
+    return ET.fromstring(
+        '<MIDINameDocument><Author/><MasterDeviceNames>'
+        '<Manufacturer>Acme</Manufacturer><Model>Box</Model>'
+        f'{body}</MasterDeviceNames></MIDINameDocument>')
+
+
+def channel_set(bank_patches, name='Set', bank='Bank'):
+    return (f'<ChannelNameSet Name="{name}"><AvailableForChannels/><UsesNoteNameList Name="Drums"/>'
+            f'<PatchBank Name="{bank}"><PatchNameList Name="{bank}">{bank_patches}</PatchNameList></PatchBank>'
+            '</ChannelNameSet>')
+
+
+def drums(*names):
+    notes = ''.join(f'<Note Number="{36 + i}" Name="{name}"/>' for i, name in enumerate(names))
+    return f'<NoteNameList Name="Drums">{notes}</NoteNameList>'
+
+
+BASE = document(channel_set('<Patch Number="0" Name="Piano" ProgramChange="0"/>') + drums('Kick', 'Snare'))
+SOURCE = document(channel_set('<Patch Number="0" Name="Organ" ProgramChange="0"/>') + drums('Kick 2', 'Snare 2'))
+
+
+def merged(base, source, conflict):
+    merger = server.MidnamMerger(base, conflict)
+    merger.merge(source)
+    return merger
+
+
+def names(root, tag):
+    return [element.get('Name') for element in root.iter(tag)]
+
+
+def test_unknown_conflict_mode():
+    with pytest.raises(ValueError):
+        server.MidnamMerger(BASE, 'replace')
+
+
+def test_base_is_not_modified():
+    before = ET.tostring(BASE)
+    merged(BASE, SOURCE, 'overwrite')
+    assert ET.tostring(BASE) == before
+
+
+def test_keep_leaves_base_items():
+    merger = merged(BASE, SOURCE, 'keep')
+    assert merger.stats == {'added': 0, 'overwritten': 0, 'kept': 3, 'renamed': 0}
+    assert names(merger.root, 'Note') == ['Kick', 'Snare']
+    assert names(merger.root, 'Patch') == ['Piano']
+
+
+def test_used_list_is_merged_once():
+    # Drums is reached through the channel set's UsesNoteNameList and as a
+    # document-level list; each incoming item must only count once
+    merger = merged(BASE, SOURCE, 'overwrite')
+    assert merger.stats == {'added': 0, 'overwritten': 3, 'kept': 0, 'renamed': 0}
+    assert names(merger.root, 'Note') == ['Kick 2', 'Snare 2']
+    assert names(merger.root, 'Patch') == ['Organ']
+
+
+def test_new_items_are_added_in_place():
+    source = document(drums('Kick', 'Snare', 'Hat'))
+    merger = merged(BASE, source, 'keep')
+    assert merger.stats['added'] == 1
+    assert names(merger.root, 'Note') == ['Kick', 'Snare', 'Hat']
+
+
+def test_note_groups_merge_by_name():
+    base = document('<NoteNameList Name="Drums"><NoteGroup Name="Kicks"><Note Number="36" Name="Kick"/></NoteGroup></NoteNameList>')
+    source = document('<NoteNameList Name="Drums"><NoteGroup Name="Kicks"><Note Number="35" Name="Kick 2"/></NoteGroup>'
+                      '<NoteGroup Name="Toms"><Note Number="41" Name="Tom"/></NoteGroup></NoteNameList>')
+    root = merged(base, source, 'keep').root
+    groups = {group.get('Name'): names(group, 'Note') for group in root.iter('NoteGroup')}
+    assert groups == {'Kicks': ['Kick', 'Kick 2'], 'Toms': ['Tom']}
+
+
+def test_rename_keeps_list_names_unique():
+    merger = merged(BASE, SOURCE, 'rename')
+    for tag in server.MERGE_LIST_ITEMS:
+        counts = Counter(names(merger.root, tag))
+        assert all(count == 1 for count in counts.values()), (tag, counts)
+    assert names(merger.root, 'ChannelNameSet') == ['Set', 'Set (2)']
+    assert names(merger.root, 'PatchNameList') == ['Bank', 'Bank (2)']
+    assert names(merger.root, 'NoteNameList') == ['Drums', 'Drums (2)']
+    # The copied channel set follows its renamed note list
+    assert names(merger.root, 'UsesNoteNameList') == ['Drums', 'Drums (2)']
+
+
+def test_rename_drops_identical_copies():
+    merger = merged(BASE, BASE, 'rename')
+    assert merger.stats == {'added': 0, 'overwritten': 0, 'kept': 0, 'renamed': 0}
+    assert ET.tostring(merger.root) == ET.tostring(BASE)
+
+
+def test_rename_merging_same_source_twice():
+    merger = server.MidnamMerger(BASE, 'rename')
+    merger.merge(SOURCE)
+    merger.merge(SOURCE)
+    assert names(merger.root, 'ChannelNameSet') == ['Set', 'Set (2)']
+    assert names(merger.root, 'NoteNameList') == ['Drums', 'Drums (2)']
+
+
+def test_added_inline_list_gets_unique_name():
+    # A new channel set is added as is, but its bank's list may not reuse a taken Name
+    source = document(channel_set('<Patch Number="0" Name="Organ" ProgramChange="0"/>', name='Other'))
+    merger = merged(BASE, source, 'keep')
+    assert names(merger.root, 'ChannelNameSet') == ['Set', 'Other']
+    assert names(merger.root, 'PatchBank') == ['Bank', 'Bank']
+    assert names(merger.root, 'PatchNameList') == ['Bank', 'Bank (2)']
+
+
+def test_merge_files_endpoint(http_server, fetch, workdir):
+    for name, root in (('base.midnam', BASE), ('source.midnam', SOURCE)):
+        server.write_xml_document(root, str(workdir / name))
+    status, body = fetch(http_server + '/merge_files', {
+        'source_files': ['base.midnam', 'source.midnam'], 'output_file': 'out.midnam', 'conflict': 'overwrite'})
+    assert status == 200
+    assert json.loads(body)['stats']['overwritten'] == 3
+    root = ET.parse(workdir / 'out.midnam').getroot()
+    assert names(root, 'Note') == ['Kick 2', 'Snare 2']
+    
+    status, _ = fetch(http_server + '/merge_files', {
+        'source_files': ['base.midnam'], 'output_file': 'out.midnam', 'conflict': 'bogus'})
+    assert status == 400
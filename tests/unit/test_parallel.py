@@ -0,0 +1,48 @@
+"""Tests for the worker process pool used by catalog builds and bulk validation"""
+
+import json
+import os
+
+import server
+
+
+def parent_pid(item):
+    return os.getppid()
+
+
+def test_small_batches_run_inline():
+    # A lambda cannot be pickled, so this only works without worker processes
+    assert server.run_in_pool(lambda x: x * 2, [1, 2, 3], workers=4) == [2, 4, 6]
+    assert server.run_in_pool(lambda x: x * 2, [1, 2, 3], workers=1, min_items=1) == [2, 4, 6]
+
+
+def test_pool_indexes_files_like_inline(catalog, write_midnam, workdir):
+    paths = []
+    for number in range(6):
+        write_midnam(f'Acme/Box {number}.midnam', 'Acme', f'Box {number}', [f'Patch {number}'])
+        paths.append(f'patchfiles/Acme/Box {number}.midnam')
+    
+    pooled = server.run_in_pool(server.index_midnam_file, paths, workers=2, min_items=1)
+    inline = [server.index_midnam_file(path) for path in paths]
+    
+    assert [record.core() for record in pooled] == [record.core() for record in inline]
+    assert [record.names for record in pooled] == [record.names for record in inline]
+    assert pooled[3].device['model'] == 'Box 3'
+
+
+def test_workers_are_not_forked_from_the_server():
+    # Forking the multithreaded server could copy a held lock into a worker;
+    # forkserver/spawn workers are children of a separate process
+    assert set(server.run_in_pool(parent_pid, list(range(4)), workers=2, min_items=1)) != {os.getpid()}
+
+
+def test_cache_stats_report_last_catalog_build(catalog, write_midnam, http_server, fetch):
+    for number in range(3):
+        write_midnam(f'Acme/Box {number}.midnam', 'Acme', f'Box {number}')
+    assert fetch(http_server + '/midnam_catalog')[0] == 200
+    status, body = fetch(http_server + '/cache_stats')
+    assert status == 200
+    build = json.loads(body)['catalog_build']
+    assert build['parsed_files'] == 3
+    assert build['workers'] == 1
+    assert build['seconds'] >= 0
@@ -0,0 +1,115 @@
+"""Tests for /patch_file and the operations it applies"""
+
+import hashlib
+import json
+
+import pytest
+
+import server
+
+
+COMMENTED = b'''<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE MIDINameDocument PUBLIC "-//MIDI Manufacturers Association//DTD MIDINameDocument 1.0//EN" "http://www.midi.org/dtds/MIDINameDocument10.dtd">
+<!-- Written by hand -->
+<MIDINameDocument xmlns:ed="urn:example:editor">
+\t<Author>Someone</Author>
+\t<MasterDeviceNames>
+\t\t<Manufacturer>Acme</Manufacturer>
+\t\t<Model>Box</Model>
+\t\t<!-- kit names follow -->
+\t\t<NoteNameList Name="Drums" ed:color="red">
+\t\t\t<?editor fold?>
+\t\t\t<Note Number="36" Name="Kick"></Note>
+\t\t\t<Note Number="38" Name="Snare &amp; Rim"/>
+\t\t</NoteNameList>
+\t\t<note xmlns="http://www.w3.org/1999/xhtml" number="1" name="x"></note>
+\t</MasterDeviceNames>
+</MIDINameDocument>
+'''
+
+DRUMS = [{'tag': 'NoteNameList', 'Name': 'Drums'}]
+
+
+@pytest.fixture
+def commented(workdir):
+    path = workdir / 'acme.midnam'
+    path.write_bytes(COMMENTED)
+    return path
+
+
+def patch(fetch, url, path, operations, **extra):
+    status, body = fetch(url + '/patch_file', dict(file_path=str(path), operations=operations, **extra))
+    return status, json.loads(body) if body.startswith(b'{') else body
+
+
+def test_noop_patch_keeps_bytes(http_server, fetch, commented):
+    operations = [{'op': 'set', 'target': DRUMS + [{'tag': 'Note', 'Number': 36}], 'attrs': {'Name': 'Kick'}}]
+    status, result = patch(fetch, http_server, commented, operations)
+    assert status == 200
+    assert result['unchanged'] is True
+    assert result['revision'] == hashlib.sha1(COMMENTED).hexdigest()
+    assert commented.read_bytes() == COMMENTED
+
+
+def test_patch_keeps_comments_pis_and_prefixes(http_server, fetch, commented):
+    operations = [
+        {'op': 'set', 'target': DRUMS + [{'tag': 'Note', 'Number': 38}], 'attrs': {'Name': 'Snare'}},
+        {'op': 'add', 'target': DRUMS, 'xml': '<Note Number="42" Name="Hat"/>'},
+    ]
+    status, result = patch(fetch, http_server, commented, operations)
+    assert status == 200 and result['applied'] == 2
+    saved = commented.read_bytes()
+    assert saved.startswith(COMMENTED[:COMMENTED.index(b'<MIDINameDocument')])
+    assert b'<!-- kit names follow -->' in saved
+    assert b'<?editor fold?>' in saved
+    assert b'<MIDINameDocument xmlns:ed="urn:example:editor">' in saved
+    assert b'ed:color="red"' in saved
+    assert b'<note xmlns="http://www.w3.org/1999/xhtml" number="1" name="x"/>' in saved
+    assert b'ns0' not in saved
+    assert b'<Note Number="38" Name="Snare"/>\n\t\t\t<Note Number="42" Name="Hat"/>\n\t\t</NoteNameList>' in saved
+
+
+def test_stale_base_conflicts(http_server, fetch, commented):
+    operations = [{'op': 'remove', 'target': DRUMS + [{'tag': 'Note', 'Number': 36}]}]
+    status, result = patch(fetch, http_server, commented, operations, base='0' * 40)
+    assert status == 409
+    assert result['revision'] == hashlib.sha1(COMMENTED).hexdigest()
+    assert commented.read_bytes() == COMMENTED
+
+
+def test_failed_operation_saves_nothing(http_server, fetch, commented):
+    operations = [
+        {'op': 'remove', 'target': DRUMS + [{'tag': 'Note', 'Number': 36}]},
+        {'op': 'remove', 'target': DRUMS + [{'tag': 'Note', 'Number': 99}]},
+    ]
+    status, result = patch(fetch, http_server, commented, operations)
+    assert status == 400
+    assert result['error'].startswith('Operation 1:')
+    assert commented.read_bytes() == COMMENTED
+
+
+def test_editable_document_round_trip_after_edit():
+    document = server.EditableDocument(COMMENTED)
+    server.apply_patch_operations(document.root, [{'op': 'remove', 'target': DRUMS + [{'tag': 'Note', 'Number': 36}]}])
+    reparsed = server.EditableDocument(document.serialize())
+    assert reparsed.serialize() == document.serialize()
+    names = [note.get('Name') for note in reparsed.root.iter('Note')]
+    assert names == ['Snare & Rim']
+
+
+def test_added_element_in_new_namespace_is_declared():
+    document = server.EditableDocument(b'<Root><Child/></Root>')
+    server.apply_patch_operations(document.root, [{'op': 'add', 'target': [], 'xml': '<x:Extra xmlns:x="urn:x" x:a="1"/>'}])
+    out = document.serialize()
+    assert server.EditableDocument(out).root.find('{urn:x}Extra').get('{urn:x}a') == '1'
+
+
+@pytest.mark.parametrize('operation, message', [
+    ({'op': 'frobnicate'}, "Unknown op"),
+    ({'op': 'remove'}, "Cannot remove the document element"),
+    ({'op': 'add', 'target': DRUMS, 'xml': '<Note'}, "invalid operation"),
+])
+def test_invalid_operations(operation, message):
+    document = server.EditableDocument(COMMENTED)
+    with pytest.raises(server.PatchError, match=message):
+        server.apply_patch_operations(document.root, [operation])
@@ -0,0 +1,192 @@
+"""Tests for the revision store, backup saves and the revision endpoints"""
+
+import json
+import os
+import urllib.parse
+
+import pytest
+
+import server
+
+
+def document(names):
+    notes = ''.join(f'<Note Number="{i}" Name="{name}"/>\n' for i, name in enumerate(names))
+    return f'<MIDINameDocument>\n<NoteNameList Name="Drums">\n{notes}</NoteNameList>\n</MIDINameDocument>\n'.encode()
+
+
+NAMES = [f'Drum {i:03}' for i in range(120)]
+
+
+@pytest.fixture
+def store(workdir):
+    return server.RevisionStore(str(workdir / 'revisions'))
+
+
+def test_split_chunks_is_lossless_and_local():
+    data = document(NAMES)
+    chunks = server.split_chunks(data)
+    assert b''.join(chunks) == data
+    assert len(chunks) > 1
+    assert all(len(chunk) <= server.REVISION_CHUNK_MAX for chunk in chunks)
+
+    edited = server.split_chunks(document(NAMES[:60] + ['Renamed'] + NAMES[61:]))
+    assert len(set(chunks) - set(edited)) <= 2
+
+
+def test_record_find_and_content(store):
+    first = document(NAMES)
+    second = document(['Kick'] + NAMES[1:])
+    first_id = store.record('patchfiles/a.midnam', first)
+    second_id = store.record('./patchfiles//a.midnam', second)
+
+    assert store.record('patchfiles/a.midnam', second) == second_id
+    revisions = store.revisions('patchfiles/a.midnam')
+    assert [r['id'] for r in revisions] == [first_id, second_id]
+    assert revisions[0]['size'] == len(first)
+    assert store.revisions('patchfiles/b.midnam') == []
+
+    assert store.content(store.find('patchfiles/a.midnam', first_id[:6])) == first
+    assert store.content(store.find('patchfiles/a.midnam', second_id)) == second
+    assert store.find('patchfiles/a.midnam', first_id[:5]) is None
+    assert store.find('patchfiles/a.midnam', 'ffffffff') is None
+
+
+def test_revisions_share_unchanged_chunks(store):
+    store.record('a.midnam', document(NAMES))
+    objects = store.stats()['objects']
+    store.record('a.midnam', document(NAMES[:60] + ['Renamed'] + NAMES[61:]))
+    # One chunk list plus the one or two chunks around the edit
+    assert store.stats()['objects'] - objects <= 3
+
+
+def test_corrupt_revision_is_detected(store):
+    import zlib
+
+    revision_id = store.record('a.midnam', document(NAMES))
+    revision = store.find('a.midnam', revision_id)
+    chunk_id = store.get_object(revision['chunks']).decode('ascii').split('\n')[0]
+    with open(store.object_path(chunk_id), 'wb') as f:
+        f.write(zlib.compress(b'garbage'))
+    with pytest.raises(ValueError):
+        store.content(revision)
+
+
+def test_diff(store):
+    diff = store.diff('./a.midnam', b'one\ntwo\n', b'one\nthree\n', 'abc', 'current')
+    assert diff.splitlines() == ['--- a.midnam@abc', '+++ a.midnam@current', '@@ -1,2 +1,2 @@',
+                                 ' one', '-two', '+three']
+
+
+def test_saver_records_previous_content(store, workdir):
+    path = str(workdir / 'a.midnam')
+    with open(path, 'wb') as f:
+        f.write(b'before')
+    saver = server.FileSaver(revisions=store)
+
+    result = saver.save(path, b'after')
+    assert result['revision'] == store.revisions(path)[-1]['id']
+    assert [store.content(r) for r in store.revisions(path)] == [b'before', b'after']
+    assert saver.save(path, b'after')['unchanged']
+    assert not [name for name in os.listdir(workdir) if '.backup.' in name]
+
+
+def test_saver_backups_are_deduplicated_and_pruned(workdir):
+    path = str(workdir / 'a.midnam')
+    with open(path, 'wb') as f:
+        f.write(b'v0')
+    saver = server.FileSaver(keep=2, max_age_days=0)
+
+    first = saver.save(path, b'v1')
+    assert first['backup'] and open(first['backup'], 'rb').read() == b'v0'
+    assert saver.save(path, b'v1')['unchanged']
+
+    # v0 is already backed up: no second backup of it
+    assert saver.backup(path, saver.file_hash(first['backup'])) is None
+
+    saver.save(path, b'v2')
+    saver.save(path, b'v3')
+    assert open(path, 'rb').read() == b'v3'
+    backups = saver.list_backups(path)
+    assert len(backups) == 2
+    assert sorted(open(p, 'rb').read() for _, p in backups) == [b'v1', b'v2']
+
+
+def test_atomic_file_keeps_old_content_on_failure(workdir):
+    path = workdir / 'a.midnam'
+    path.write_bytes(b'old')
+    path.chmod(0o640)
+    with pytest.raises(RuntimeError):
+        with server.AtomicFile(str(path)) as f:
+            f.write(b'half')
+            raise RuntimeError('crash mid-write')
+    assert path.read_bytes() == b'old'
+    assert os.listdir(workdir) == ['a.midnam']
+
+    with server.AtomicFile(str(path)) as f:
+        f.write(b'new')
+    assert path.read_bytes() == b'new'
+    assert path.stat().st_mode & 0o777 == 0o640
+    assert os.listdir(workdir) == ['a.midnam']
+
+
+def test_old_backups_are_pruned_by_age(workdir):
+    import time
+
+    path = str(workdir / 'a.midnam')
+    with open(path, 'wb') as f:
+        f.write(b'v0')
+    # A backup named with a timestamp from a year ago
+    old = time.strftime(server.BACKUP_TIME_FORMATS[1], time.localtime(time.time() - 365 * 86400))
+    with open(f'{path}.backup.{old}', 'wb') as f:
+        f.write(b'ancient')
+    saver = server.FileSaver(keep=0, max_age_days=30)
+
+    result = saver.save(path, b'v1')
+    assert result['pruned'] == [f'{path}.backup.{old}']
+    assert [open(p, 'rb').read() for _, p in saver.list_backups(path)] == [b'v0']
+
+
+def test_save_endpoint_keeps_bounded_backups(workdir, monkeypatch, http_server, fetch):
+    monkeypatch.setattr(server, 'FILE_SAVER', server.FileSaver(keep=2, max_age_days=0))
+    (workdir / 'a.midnam').write_bytes(b'<a/>')
+    for version in ('<b/>', '<c/>', '<c/>', '<d/>'):
+        status, body = fetch(http_server + '/save_file', {'file_path': 'a.midnam', 'xml_content': version})
+        assert status == 200
+    assert json.loads(body)['backup'].startswith('a.midnam.backup.')
+    assert (workdir / 'a.midnam').read_bytes() == b'<d/>'
+    backups = sorted(path.read_bytes() for path in workdir.glob('a.midnam.backup.*'))
+    assert backups == [b'<b/>', b'<c/>']
+
+
+@pytest.fixture
+def revisions(workdir, monkeypatch, store):
+    monkeypatch.setattr(server, 'REVISIONS', store)
+    monkeypatch.setattr(server, 'FILE_SAVER', server.FileSaver(revisions=store))
+    (workdir / 'patchfiles').mkdir()
+    (workdir / 'patchfiles' / 'a.midnam').write_bytes(b'one\ntwo\n')
+    server.FILE_SAVER.save('patchfiles/a.midnam', b'one\nthree\n')
+    return store
+
+
+def test_revision_endpoints(revisions, http_server, fetch, workdir):
+    status, body = fetch(http_server + '/revisions/' + urllib.parse.quote('patchfiles/a.midnam'))
+    assert status == 200
+    listed = json.loads(body)['revisions']
+    assert [r['size'] for r in listed] == [10, 8]
+    oldest = listed[1]['id']
+
+    status, body = fetch(f'{http_server}/revision_diff/patchfiles/a.midnam?from={oldest[:8]}')
+    assert status == 200
+    assert b'-two\n+three\n' in body
+
+    status, body = fetch(f'{http_server}/revision_diff/patchfiles/a.midnam?from=abcdef12')
+    assert status == 404
+
+    status, body = fetch(http_server + '/restore_revision', {'file_path': 'patchfiles/a.midnam', 'revision': oldest})
+    assert status == 200
+    assert json.loads(body)['unchanged'] is False
+    assert (workdir / 'patchfiles' / 'a.midnam').read_bytes() == b'one\ntwo\n'
+    assert revisions.revisions('patchfiles/a.midnam')[-1]['id'] == oldest
+
+    status, body = fetch(http_server + '/restore_revision', {'file_path': 'patchfiles/a.midnam', 'revision': 'abc'})
+    assert status == 404
@@ -0,0 +1,160 @@
+"""Tests for the name search index and /search"""
+
+import json
+
+import pytest
+
+import server
+
+
+def index_of(files):
+    index = server.NameSearchIndex()
+    for path, names in files.items():
+        index.add_file(path, names)
+    return index
+
+
+@pytest.fixture
+def index():
+    return index_of({
+        'a.midnam': {'patch': ['Fretless Bass', 'Acoustic Bass'], 'note': ['Kick']},
+        'b.midnam': {'patch': ['Fretless Bass', 'Bass & Lead'], 'bank': ['Basses']},
+        'c.midnam': {'patch': ['Fretted Guitar'], 'control': ['Bass Boost']},
+    })
+
+
+def found(results):
+    return [(kind, name) for score, kind, name, paths in results]
+
+
+@pytest.mark.parametrize('a, b, limit, distance', [
+    ('bass', 'bass', 1, 0),
+    ('bass', 'base', 1, 1),
+    ('fretless', 'fretles', 2, 1),
+    ('bass', 'b', 1, 2),
+    ('kitten', 'sitting', 3, 3),
+    ('kitten', 'sitting', 2, 3),
+])
+def test_edit_distance(a, b, limit, distance):
+    assert server.edit_distance(a, b, limit) == distance
+
+
+def test_search_tokens():
+    assert server.search_tokens('Bass & Lead (Fretless)') == ['bass', 'lead', 'fretless']
+
+
+def test_exact_name_ranks_first(index):
+    results, total = index.search('fretless bass')
+    assert total == 1
+    score, kind, name, paths = results[0]
+    assert (kind, name) == ('patch', 'Fretless Bass')
+    assert sorted(paths) == ['a.midnam', 'b.midnam']
+
+
+def test_every_word_must_match(index):
+    results, total = index.search('bass acoustic')
+    assert found(results) == [('patch', 'Acoustic Bass')]
+    assert index.search('bass nothing') == ([], 0)
+    assert index.search('  &  ') == ([], 0)
+
+
+def test_last_word_matches_as_prefix(index):
+    results, total = index.search('fret')
+    assert found(results) == [('patch', 'Fretless Bass'), ('patch', 'Fretted Guitar')]
+    # Earlier words must match whole words
+    assert index.search('fret bass') == ([], 0)
+
+
+def test_more_files_rank_higher_on_equal_score(index):
+    results, total = index.search('bass')
+    assert total == 5
+    assert found(results)[0] == ('patch', 'Fretless Bass')
+    assert ('bank', 'Basses') in found(results)
+
+
+def test_kinds_filter(index):
+    results, total = index.search('bass', kinds={'control'})
+    assert found(results) == [('control', 'Bass Boost')]
+    assert total == 1
+
+
+def test_fuzzy_matches_typos(index):
+    assert index.search('fretles bas') == ([], 0)
+    results, total = index.search('fretles bas', fuzzy=True)
+    assert found(results)[0] == ('patch', 'Fretless Bass')
+    results, total = index.search('fertless', fuzzy=True)
+    assert found(results) == [('patch', 'Fretless Bass')]
+
+
+def test_limit_cuts_results_but_not_total(index):
+    results, total = index.search('bass', limit=2)
+    assert len(results) == 2
+    assert total == 5
+
+
+def test_remove_file_drops_unused_names(index):
+    index.remove_file('b.midnam', {'patch': ['Fretless Bass', 'Bass & Lead'], 'bank': ['Basses']})
+    results, total = index.search('bass')
+    assert ('patch', 'Bass & Lead') not in found(results)
+    assert dict(((kind, name), paths) for score, kind, name, paths in results)[('patch', 'Fretless Bass')] == ['a.midnam']
+    assert 'lead' not in index.words
+    assert index.search('basses') == ([], 0)
+    # Removing twice or an unknown file is harmless, and freed ids are reused
+    index.remove_file('b.midnam', {'patch': ['Fretless Bass']})
+    index.add_file('d.midnam', {'patch': ['Lead']})
+    assert index.file_ids['d.midnam'] == 1
+    assert found(index.search('lead')[0]) == [('patch', 'Lead')]
+
+
+def test_postings_are_file_id_arrays(index):
+    from array import array
+
+    postings = index.entries[('patch', 'Fretless Bass')]
+    assert isinstance(postings, array) and postings.typecode == 'I'
+    assert list(postings) == [0, 1]
+    assert index.file_paths == ['a.midnam', 'b.midnam', 'c.midnam']
+
+
+def test_stats(index):
+    assert index.stats() == {'files': 3, 'names': 7, 'words': 9, 'trigrams': len(index.trigrams)}
+
+
+def test_search_endpoint(catalog, write_midnam, http_server, fetch):
+    write_midnam('Acme/Box.midnam', 'Acme', 'Box', ['Fretless Bass', 'Piano'], ['Kick'])
+    write_midnam('Other/Synth.midnam', 'Other', 'Synth', ['Fretless Bass'])
+    
+    status, body = fetch(http_server + '/search?q=fretless&kind=patch')
+    assert status == 200
+    result = json.loads(body)
+    assert result['total'] == 1
+    match = result['results'][0]
+    assert (match['kind'], match['name'], match['file_count']) == ('patch', 'Fretless Bass', 2)
+    assert [device['manufacturer'] for device in match['devices']] == ['Acme', 'Other']
+    
+    status, body = fetch(http_server + '/search?q=kick&kind=note')
+    assert [match['name'] for match in json.loads(body)['results']] == ['Kick']
+
+
+@pytest.mark.parametrize('query, status, count', [
+    ('limit=1', 200, 1),
+    ('limit=100000', 200, 2),
+    ('limit=0', 400, None),
+    ('limit=-1', 400, None),
+    ('limit=abc', 400, None),
+    ('kind=bogus', 400, None),
+])
+def test_search_endpoint_parameters(catalog, write_midnam, http_server, fetch, query, status, count):
+    write_midnam('Acme/Box.midnam', 'Acme', 'Box', ['Bass One', 'Bass Two'])
+    got, body = fetch(http_server + '/search?q=bass&' + query)
+    assert got == status
+    if count is not None:
+        assert len(json.loads(body)['results']) == count
+
+
+def test_parse_limit():
+    assert server.parse_limit(None, 50, 500) == 50
+    assert server.parse_limit('7', 50, 500) == 7
+    assert server.parse_limit('501', 50, 500) == 500
+    for value in ('0', '-3', 'x', ''):
+        with pytest.raises(ValueError):
+            server.parse_limit(value, 50, 500)
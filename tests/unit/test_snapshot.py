@@ -0,0 +1,121 @@
+"""Tests for the catalog snapshot and clearing the caches"""
+
+import json
+import marshal
+import os
+import struct
+
+import pytest
+
+import server
+
+
+@pytest.fixture
+def built(catalog, write_midnam):
+    write_midnam('Acme/Box.midnam', 'Acme', 'Box', ['Piano', 'Organ'], ['Kick'])
+    write_midnam('Acme/Box 2.midnam', 'Acme', 'Box', ['Piano'])
+    write_midnam('Zeta/Synth.midnam', 'Zeta', 'Synth', ['Pad'])
+    catalog.current()
+    return catalog
+
+
+def reloaded():
+    index = server.MidnamCatalogIndex('patchfiles', 'midnam_catalog.snapshot', workers=1)
+    index.load()
+    return index
+
+
+def test_snapshot_round_trip(built):
+    index = reloaded()
+    try:
+        assert index.files.keys() == built.files.keys()
+        assert index.catalog == built.catalog
+        for path, record in built.files.items():
+            assert index.details(index.files[path]) == built.details(record)
+        assert index.search('piano')[1] == 1
+    finally:
+        index.snapshot.close()
+
+
+def test_snapshot_details_are_appended(built, write_midnam):
+    size = os.path.getsize(built.snapshot.details_path)
+    write_midnam('New/One.midnam', 'New', 'One', ['Lead'])
+    built.current()
+    assert os.path.getsize(built.snapshot.details_path) > size
+    index = reloaded()
+    try:
+        assert index.details(index.files['patchfiles/New/One.midnam'])[1]['patch'] == ['Lead']
+    finally:
+        index.snapshot.close()
+
+
+def test_records_are_compact(built):
+    first = built.files['patchfiles/Acme/Box.midnam']
+    second = built.files['patchfiles/Acme/Box 2.midnam']
+    assert not hasattr(first, '__dict__')
+    # Files of the same device share one device dict without their own path
+    assert first.device is second.device
+    assert 'file_path' not in first.device
+    assert first.device is not built.files['patchfiles/Zeta/Synth.midnam'].device
+
+    # Once saved, analysis and names live in the snapshot's details file
+    assert first.analysis is None and first.names is None
+    assert first.details is not None
+    analysis, names = built.details(first)
+    assert sorted(names['patch']) == ['Organ', 'Piano']
+    assert analysis['total_patches'] == 2
+
+
+def test_open_details_rejects_missing_id(built):
+    assert built.snapshot.open_details(None, None) is False
+    assert built.snapshot.open_details(b'x' * 16, 10) is False
+
+
+def write_snapshot(path, core):
+    blob = marshal.dumps(core)
+    header = struct.pack(server.CatalogSnapshot.HEADER, server.CatalogSnapshot.MAGIC,
+                         server.CATALOG_INDEX_VERSION, marshal.version, struct.calcsize(server.CatalogSnapshot.HEADER) + len(blob))
+    with open(path, 'wb') as f:
+        f.write(header + blob + marshal.dumps({}))
+
+
+@pytest.mark.parametrize('core', [
+    {'files': {}, 'details_id': None, 'details_end': 0},
+    {'files': {}},
+    {'files': {'a.midnam': (1, 2)}},
+])
+def test_unusable_snapshot_is_ignored(workdir, core):
+    write_snapshot('broken.snapshot', core)
+    assert server.CatalogSnapshot('broken.snapshot').load() is None
+
+
+def test_truncated_snapshot_is_ignored(built):
+    with open('midnam_catalog.snapshot', 'rb') as f:
+        data = f.read()
+    with open('midnam_catalog.snapshot', 'wb') as f:
+        f.write(data[:len(data) // 2])
+    assert server.CatalogSnapshot('midnam_catalog.snapshot').load() is None
+
+
+def test_clear_forgets_interned_devices(built):
+    assert built.devices
+    built.clear()
+    assert built.devices == {}
+    assert built.files == {} and built.catalog == {}
+
+
+def test_clear_cache_endpoint(built, http_server, fetch, workdir):
+    assert (workdir / 'midnam_catalog.snapshot').exists()
+    status, body = fetch(http_server + '/clear_cache', {})
+    assert status == 200 and json.loads(body)['message'] == 'Cache cleared'
+    assert not (workdir / 'midnam_catalog.snapshot').exists()
+    assert not (workdir / 'midnam_catalog.snapshot.details').exists()
+    assert built.devices == {}
+    
+    status, body = fetch(http_server + '/clear_cache', {})
+    assert json.loads(body)['message'] == 'No cache to clear'
+    
+    # The next request rebuilds the catalog and the snapshot
+    status, body = fetch(http_server + '/midnam_catalog')
+    assert sorted(json.loads(body)) == ['Acme|Box', 'Zeta|Synth']
+    assert (workdir / 'midnam_catalog.snapshot').exists()
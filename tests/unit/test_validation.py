@@ -0,0 +1,199 @@
+"""Tests for the DTD validator, duplicate number checks and the validation endpoints"""
+
+import json
+import os
+from pathlib import Path
+
+import pytest
+
+import server
+
+REPO = Path(__file__).resolve().parents[2]
+
+DOCUMENT = '''<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE MIDINameDocument SYSTEM "midnam.dtd">
+<MIDINameDocument>
+<Author/>
+<MasterDeviceNames>
+<Manufacturer>Alesis</Manufacturer>
+<Model>D4</Model>
+<CustomDeviceMode Name="Default">
+<ChannelNameSetAssignments><ChannelNameSetAssign Channel="1" NameSet="Set"/></ChannelNameSetAssignments>
+</CustomDeviceMode>
+<ChannelNameSet Name="Set">
+<AvailableForChannels><AvailableChannel Channel="1" Available="true"/></AvailableForChannels>
+<PatchBank Name="Presets"><PatchNameList Name="Presets">
+<Patch Number="1" Name="Kit 1" ProgramChange="0"><UsesNoteNameList Name="Drums"/></Patch>
+<Patch Number="2" Name="Kit 2" ProgramChange="1"/>
+</PatchNameList></PatchBank>
+</ChannelNameSet>
+<NoteNameList Name="Drums">
+<Note Number="36" Name="Kick"/>
+<Note Number="38" Name="Snare"/>
+</NoteNameList>
+</MasterDeviceNames>
+</MIDINameDocument>
+'''
+
+
+@pytest.fixture(autouse=True)
+def dtds(monkeypatch):
+    """Resolve the DTDs from the repository whatever the working directory"""
+    monkeypatch.setattr(server, 'DTD_FILES', {name: str(REPO / path) for name, path in server.DTD_FILES.items()})
+    monkeypatch.setattr(server, 'DTD_SCHEMAS', {})
+
+
+def edited(old, new):
+    assert old in DOCUMENT
+    return DOCUMENT.replace(old, new, 1)
+
+
+def test_valid_document():
+    assert server.validate_midnam(DOCUMENT) == []
+    assert server.validate_midnam(DOCUMENT.encode('utf-8')) == []
+
+
+def test_default_dtd_without_doctype():
+    assert server.validate_midnam(edited('<!DOCTYPE MIDINameDocument SYSTEM "midnam.dtd">\n', '')) == []
+
+
+def test_parse_error():
+    errors = server.validate_midnam(DOCUMENT.replace('</MIDINameDocument>', ''))
+    assert len(errors) == 1
+    assert errors[0].startswith('XML Parse Error:')
+
+
+def test_unknown_dtd_and_root():
+    assert server.validate_midnam(edited('"midnam.dtd"', '"other.dtd"')) == ['Line 1: Unknown DTD other.dtd']
+    assert server.validate_midnam('<Other/>') == ['Line 1: Unknown document type <Other>']
+
+
+def test_undeclared_element_reports_its_line():
+    errors = server.validate_midnam(edited('<Note Number="38" Name="Snare"/>', '<note Number="38" Name="Snare"/>'))
+    assert 'Line 20: Element <note> is not declared in the DTD' in errors
+
+
+def test_content_model_order():
+    errors = server.validate_midnam(edited('<Manufacturer>Alesis</Manufacturer>\n<Model>D4</Model>',
+                                           '<Model>D4</Model>\n<Manufacturer>Alesis</Manufacturer>'))
+    assert any(e.startswith('Line 5: Content of <MasterDeviceNames> does not match') for e in errors)
+
+
+def test_attribute_checks():
+    # Enumerated values are declared in MIDINameDocument10.dtd, the default without a DOCTYPE
+    errors = server.validate_midnam(edited('<!DOCTYPE MIDINameDocument SYSTEM "midnam.dtd">\n', '')
+                                    .replace('Available="true"', 'Available="maybe"'))
+    assert any('Attribute Available="maybe" of <AvailableChannel> must be one of' in e for e in errors)
+
+    errors = server.validate_midnam(edited('<Patch Number="2" Name="Kit 2"', '<Patch Number="2" Name="Kit 2" Colour="red"'))
+    assert 'Line 15: Attribute Colour is not declared for <Patch>' in errors
+
+    errors = server.validate_midnam(edited('<UsesNoteNameList Name="Drums"/>', '<UsesNoteNameList/>'))
+    assert 'Line 14: <UsesNoteNameList> is missing required attribute Name' in errors
+
+
+def test_empty_element_with_text():
+    errors = server.validate_midnam(edited('<UsesNoteNameList Name="Drums"/>',
+                                           '<UsesNoteNameList Name="Drums">x</UsesNoteNameList>'))
+    assert 'Line 14: <UsesNoteNameList> must be empty' in errors
+
+
+def test_schema_compiles_content_models():
+    schema = server.DTDSchema(server.DTD_FILES['MIDINameDocument10.dtd'])
+    rule = schema.elements['NoteNameList']
+    assert rule.kind == 'children'
+    assert rule.pattern.fullmatch('<Note><NoteGroup><Note>')
+    assert not rule.pattern.fullmatch('<Patch>')
+    assert schema.elements['UsesNoteNameList'].attributes['Name']['required']
+
+
+def check(xml):
+    root, system_id = server.parse_with_lines(xml)
+    errors = []
+    server.check_unique_numbers(root, errors)
+    return errors
+
+
+def test_duplicate_note_numbers():
+    errors = check('<NoteNameList Name="Drums"><Note Number="36" Name="Kick"/>'
+                   '<NoteGroup Name="G"><Note Number="36" Name="Kick 2"/></NoteGroup>'
+                   '<Note Number="128" Name="High"/><Note Name="Nameless"/></NoteNameList>')
+    assert sorted(errors) == [
+        'Line 1: Duplicate note number 36 in Drums',
+        'Line 1: Missing number or name in Drums',
+        'Line 1: Note number 128 in Drums is outside 0-127',
+    ]
+
+
+def test_duplicate_patch_and_program_numbers():
+    errors = check('<PatchNameList Name="P">'
+                   '<Patch Number="1" Name="A"><PatchMIDICommands><ControlChange Control="0" Value="1"/>'
+                   '<ProgramChange Number="5"/></PatchMIDICommands></Patch>'
+                   '<Patch Number="1" Name="B"><PatchMIDICommands><ControlChange Control="0" Value="1"/>'
+                   '<ProgramChange Number="5"/></PatchMIDICommands></Patch>'
+                   '<Patch Number="2" Name="C"><PatchMIDICommands><ControlChange Control="0" Value="2"/>'
+                   '<ProgramChange Number="5"/></PatchMIDICommands></Patch>'
+                   '</PatchNameList>')
+    assert errors == ['Line 1: Duplicate patch number 1 in P', 'Line 1: Duplicate program change 5 in P']
+
+
+def test_validate_endpoint(http_server):
+    import urllib.request
+    from urllib.parse import quote
+
+    for xml, valid in ((DOCUMENT, True), (edited('Number="38"', 'Number="36"'), False)):
+        data = ('xml=' + quote(xml)).encode('utf-8')
+        with urllib.request.urlopen(http_server + '/validate_d4.php', data=data, timeout=10) as response:
+            result = json.loads(response.read())
+        assert result['valid'] is valid
+        assert bool(result['errors']) is not valid
+
+
+@pytest.fixture
+def validator(workdir):
+    (workdir / 'patchfiles' / 'A').mkdir(parents=True)
+    (workdir / 'patchfiles' / 'A' / 'good.midnam').write_text(DOCUMENT)
+    (workdir / 'patchfiles' / 'A' / 'bad.midnam').write_text(edited('<Model>D4</Model>', ''))
+    (workdir / 'patchfiles' / 'A' / 'notes.txt').write_text('ignored')
+    return server.BulkValidator('patchfiles', 'validation_cache.json', workers=1)
+
+
+def test_bulk_validation_skips_files_that_passed(validator, workdir):
+    records = list(validator.run())
+    assert {r['path']: r['valid'] for r in records[:-1]} == {
+        'patchfiles/A/bad.midnam': False, 'patchfiles/A/good.midnam': True}
+    assert records[-1]['summary']['validated'] == 2
+    assert records[-1]['summary']['failed'] == 1
+
+    records = list(server.BulkValidator('patchfiles', 'validation_cache.json', workers=1).run())
+    assert [r['path'] for r in records[:-1] if r.get('skipped')] == ['patchfiles/A/good.midnam']
+    assert records[-1]['summary']['validated'] == 1
+
+    # Touched but unchanged: skipped after hashing
+    good = workdir / 'patchfiles' / 'A' / 'good.midnam'
+    os.utime(good, ns=(1, 1))
+    records = list(validator.run())
+    assert [r['path'] for r in records[:-1] if r.get('skipped')] == ['patchfiles/A/good.midnam']
+    assert records[-1]['summary']['skipped'] == 1
+
+    records = list(validator.run(force=True))
+    assert records[-1]['summary']['validated'] == 2
+
+
+def test_bulk_validation_rechecks_changed_file(validator, workdir):
+    list(validator.run())
+    good = workdir / 'patchfiles' / 'A' / 'good.midnam'
+    good.write_text(edited('Number="38"', 'Number="36"'))
+    records = list(validator.run())
+    result = next(r for r in records if r.get('path') == 'patchfiles/A/good.midnam')
+    assert not result['valid']
+    assert not result.get('skipped')
+
+
+def test_validate_all_endpoint(validator, http_server, fetch, monkeypatch):
+    monkeypatch.setattr(server, 'BULK_VALIDATOR', validator)
+    status, body = fetch(http_server + '/validate_all?force=1')
+    assert status == 200
+    records = [json.loads(line) for line in body.splitlines()]
+    assert records[-1]['summary']['total'] == 2
+    assert records[-1]['summary']['passed'] == 1